@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Command agent for the operator.
+#
+# Every command exec'd into a container is a websocket through the API server to the kubelet, set up and torn
+# down again. With JETCI_EXEC_MODE=agent a container gets one exec instead, running the shell script below. The
+# operator writes commands to its stdin, a batch at a time, and it runs them one after another and frames their
+# output on stdout:
+#
+#   operator -> agent    {batch} {id} {command, quoted for the shell}\n
+#   agent -> operator    \n{token} ready\n             once, when it starts
+#                        ...output of the command...
+#                        \n{token} end {id} {status}\n  after every command
+#                        \n{token} skip {id}\n          for the rest of a batch after a command failed
+#
+# The token is random for every agent, so nothing a command prints can pass for a frame. The newline in front of
+# a frame isn't part of the output. Commands run in a subshell of their own with stdin from /dev/null, so they
+# can't eat the commands after them and a `cd` doesn't carry over, same as with exec. The agent only needs
+# /bin/sh, containers without it fall back to exec.
+import shlex
+
+AGENT_SCRIPT = """
+token=$1
+nl='
+'
+failed=
+printf '\\n%s ready\\n' "$token"
+while IFS= read -r line; do
+  batch=${line%% *}
+  line=${line#* }
+  id=${line%% *}
+  command=${line#* }
+  if [ "$batch" = "$failed" ]; then
+    printf '\\n%s skip %s\\n' "$token" "$id"
+    continue
+  fi
+  ( eval "$command" ) </dev/null 2>&1
+  status=$?
+  [ "$status" -eq 0 ] || failed=$batch
+  printf '\\n%s end %s %s\\n' "$token" "$id" "$status"
+done
+"""
+
+# The command the agent is exec'd with.
+def agent_command(token):
+    return [ "/bin/sh", "-c", AGENT_SCRIPT, "jetci-agent", token ]
+
+# Quotes a command, as a list of arguments, onto one line. Newlines in arguments come from $nl in the agent.
+def command_line(batch, command_id, argv):
+    words = []
+    for arg in argv:
+        words.append("\"$nl\"".join(shlex.quote(part) for part in arg.split("\n")))
+    return str(batch) + " " + str(command_id) + " " + " ".join(words) + "\n"
+
+
+# Splits what an agent writes to stdout into output and frames.
+class AgentStream:
+    def __init__(self, token):
+        self.marker = "\n" + token + " "
+        self.buffer = ""
+
+    # Takes the next piece of stdout. Returns events in order, ("output", text), ("ready",), ("end", id, status)
+    # or ("skip", id). Text that could be the start of a frame is held back until the rest of it comes in.
+    def feed(self, data):
+        self.buffer += data
+        events = []
+        while True:
+            start = self.buffer.find(self.marker)
+            if start == -1:
+                held = self.held_back()
+                if len(self.buffer) > held:
+                    events.append(("output", self.buffer[:len(self.buffer) - held]))
+                    self.buffer = self.buffer[len(self.buffer) - held:]
+                return events
+
+            if start > 0:
+                events.append(("output", self.buffer[:start]))
+                self.buffer = self.buffer[start:]
+                start = 0
+
+            end = self.buffer.find("\n", len(self.marker))
+            if end == -1:
+                return events
+            events.append(tuple(self.buffer[len(self.marker):end].split(" ")))
+            self.buffer = self.buffer[end + 1:]
+
+    # How much of the end of the buffer is the start of a frame.
+    def held_back(self):
+        for length in range(min(len(self.marker) - 1, len(self.buffer)), 0, -1):
+            if self.buffer.endswith(self.marker[:length]):
+                return length
+        return 0
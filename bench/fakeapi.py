@@ -0,0 +1,720 @@
+#!/usr/bin/env python3
+# A fake Kubernetes API server for benchmarking jetci without a cluster.
+#
+# Everything is kept in memory and only as much of the API is implemented as jetci uses: Builds and Repositories,
+# pods that go from Pending to Running on their own, exec over websockets, the command agent of agent.py, log
+# streaming, leases, configmaps, secrets and daemonsets. It also stands in for a registry at /v2/, every tag has a
+# digest made from its name. Lists, watches, resourceVersions, JSON patches with "test" operations
+# and merge patches behave like the real thing as far as jetci can tell. CRD defaults from deploy/crds.yaml are
+# filled in on create.
+#
+# Every request is counted per client, verb and resource. The client is the bearer token of the request, so
+# processes given kubeconfigs with different tokens are counted apart. The times builds and pods reach each phase
+# are kept in FakeCluster.timeline and FakeCluster.pod_timeline. Image pulls are counted as client "kubelet" and
+# registry requests as client "registry".
+#
+# Running this file serves an empty cluster and writes a kubeconfig for it:
+#   python3 bench/fakeapi.py {kubeconfig path} [port]
+import os
+import re
+import sys
+import shlex
+import copy
+import json
+import time
+import heapq
+import base64
+import bisect
+import struct
+import hashlib
+import datetime
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+API_GROUP   = "future.jetci.xyz"
+API_VERSION = "v1alpha1"
+
+# resource -> (apiVersion, kind)
+KINDS = {
+    "pods":         ("v1", "Pod"),
+    "secrets":      ("v1", "Secret"),
+    "configmaps":   ("v1", "ConfigMap"),
+    "leases":       ("coordination.k8s.io/v1", "Lease"),
+    "daemonsets":   ("apps/v1", "DaemonSet"),
+    "builds":       (API_GROUP + "/" + API_VERSION, "Build"),
+    "repositories": (API_GROUP + "/" + API_VERSION, "Repository")
+}
+
+# Watches are closed after this many seconds when the client didn't ask for a timeout, like the API server does.
+WATCH_MAX_SECONDS = 300
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+STDIN_CHANNEL  = 0
+STDOUT_CHANNEL = 1
+ERROR_CHANNEL  = 3
+
+
+class ApiError(Exception):
+    def __init__(self, code, reason, message):
+        super().__init__(message)
+        self.code = code
+        self.reason = reason
+        self.message = message
+
+    def status(self):
+        return { "kind": "Status", "apiVersion": "v1", "metadata": {}, "status": "Failure", "message": self.message, "reason": self.reason, "code": self.code }
+
+
+# JSON pointer, RFC 6901.
+def pointer_parts(path):
+    return [ part.replace("~1", "/").replace("~0", "~") for part in path.split("/")[1:] ]
+
+def pointer_parent(doc, parts, path):
+    for part in parts[:-1]:
+        try:
+            doc = doc[int(part)] if isinstance(doc, list) else doc[part]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise ApiError(422, "Invalid", "path not found: " + path)
+    return doc
+
+# JSON patch, RFC 6902. Only the operations jetci uses.
+def json_patch(doc, operations):
+    doc = copy.deepcopy(doc)
+    for operation in operations:
+        path = operation['path']
+        parts = pointer_parts(path)
+        parent = pointer_parent(doc, parts, path)
+        key = parts[-1]
+
+        if isinstance(parent, list):
+            if key == "-":
+                index = len(parent)
+            else:
+                try:
+                    index = int(key)
+                except ValueError:
+                    raise ApiError(422, "Invalid", "bad index: " + path)
+            exists = index < len(parent)
+        else:
+            exists = key in parent
+
+        if operation['op'] == "test":
+            if not exists or (parent[index] if isinstance(parent, list) else parent[key]) != operation['value']:
+                raise ApiError(422, "Invalid", "the server rejected our request due to an error in our request: test failed for " + path)
+        elif operation['op'] == "add":
+            if isinstance(parent, list):
+                parent.insert(index, operation['value'])
+            else:
+                parent[key] = operation['value']
+        elif operation['op'] == "replace":
+            if not exists:
+                raise ApiError(422, "Invalid", "replace of missing path: " + path)
+            if isinstance(parent, list):
+                parent[index] = operation['value']
+            else:
+                parent[key] = operation['value']
+        elif operation['op'] == "remove":
+            if not exists:
+                raise ApiError(422, "Invalid", "remove of missing path: " + path)
+            del parent[index if isinstance(parent, list) else key]
+        else:
+            raise ApiError(422, "Invalid", "operation not implemented: " + operation['op'])
+    return doc
+
+# JSON merge patch, RFC 7386. Strategic merge patches are treated the same, jetci doesn't patch lists that way.
+def merge_patch(doc, patch):
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    doc = copy.deepcopy(doc) if isinstance(doc, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            doc.pop(key, None)
+        else:
+            doc[key] = merge_patch(doc.get(key), value)
+    return doc
+
+# Only equality selectors, "a=b,c=d".
+def selector_matches(selector, obj):
+    if not selector:
+        return True
+    labels = obj['metadata'].get('labels') or {}
+    for requirement in selector.split(","):
+        name, _, value = requirement.partition("=")
+        if labels.get(name.strip()) != value.strip().lstrip("="):
+            return False
+    return True
+
+def timestamp():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# Defaults the CRDs fill in.
+def apply_defaults(resource, obj):
+    if resource == "builds":
+        obj.setdefault('status', "Pending")
+        obj.setdefault('claimedBy', "")
+        obj.setdefault('pods', [])
+        obj.setdefault('logs', [])
+        obj.setdefault('spec', {}).setdefault('priority', 0)
+    elif resource == "repositories":
+        obj['spec'].setdefault('authType', "none")
+        obj['spec'].setdefault('buildPolicy', "run-all")
+        obj['spec'].setdefault('debounceSeconds', 0)
+
+
+# The cluster. Everything is guarded by condition, watchers wait on it for new events.
+class FakeCluster:
+    # pod_ready_delay - seconds from a pod being created to it running with every container ready.
+    # exec_delay      - seconds every exec takes.
+    # exec_lines      - lines every command prints, each in a websocket frame of its own and spread over another
+    #                   exec_delay, like a command that prints while it runs.
+    # log_lines       - lines every container logs, the log stream stays open until the pod is deleted.
+    # image_pull_delay - seconds every image pull adds to a pod becoming ready. Images are pulled one after another
+    #                    like the kubelet does, every time with imagePullPolicy Always, otherwise only the first time.
+    def __init__(self, pod_ready_delay=0.5, exec_delay=0.05, exec_lines=1, log_lines=2, image_pull_delay=0):
+        self.pod_ready_delay = pod_ready_delay
+        self.exec_delay = exec_delay
+        self.exec_output = "".join("ok " + str(line) + "\n" for line in range(exec_lines))
+        self.exec_line_delay = exec_delay / exec_lines if exec_lines > 1 else 0
+        self.log_lines = log_lines
+        self.image_pull_delay = image_pull_delay
+
+        # Images the one node has.
+        self.pulled_images = set()
+
+        self.condition = threading.Condition()
+        self.resource_version = 0
+        self.uids = itertools.count(1)
+        self.stopped = False
+
+        # (resource, namespace, name) -> object
+        self.objects = {}
+
+        # Every change, oldest first. event_versions holds the resourceVersion of each, for bisecting.
+        self.events = []
+        self.event_versions = []
+
+        # (client, verb, resource) -> count
+        self.calls = {}
+
+        # (namespace, build name) -> { "created", "claimed", "Queued", "Running", "Complete", ... : time.monotonic() }
+        self.timeline = {}
+
+        # (namespace, pod name) -> { "created", "ready", "first_exec", "deleted" : time.monotonic() }
+        self.pod_timeline = {}
+
+        # Delayed work like pods becoming ready, run by one thread.
+        self.scheduled = []
+        self.schedule_sequence = itertools.count()
+        threading.Thread(target=self.scheduler, daemon=True).start()
+
+    def count_call(self, client, verb, resource):
+        with self.condition:
+            key = (client, verb, resource)
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def schedule(self, delay, function, *args):
+        with self.condition:
+            heapq.heappush(self.scheduled, (time.monotonic() + delay, next(self.schedule_sequence), function, args))
+            self.condition.notify_all()
+
+    def scheduler(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (len(self.scheduled) == 0 or self.scheduled[0][0] > time.monotonic()):
+                    self.condition.wait(None if len(self.scheduled) == 0 else self.scheduled[0][0] - time.monotonic())
+                if self.stopped:
+                    return
+                _, _, function, args = heapq.heappop(self.scheduled)
+            function(*args)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    # Stores a change and wakes the watchers. Caller must hold condition.
+    def record(self, resource, event_type, obj):
+        self.resource_version += 1
+        obj['metadata']['resourceVersion'] = str(self.resource_version)
+        self.events.append((self.resource_version, resource, event_type, copy.deepcopy(obj)))
+        self.event_versions.append(self.resource_version)
+        self.condition.notify_all()
+
+    def create(self, resource, namespace, obj):
+        obj = copy.deepcopy(obj)
+        apiVersion, kind = KINDS[resource]
+        obj.setdefault('apiVersion', apiVersion)
+        obj.setdefault('kind', kind)
+        obj.setdefault('metadata', {})
+        if 'name' not in obj['metadata'] and 'generateName' in obj['metadata']:
+            obj['metadata']['name'] = obj['metadata']['generateName'] + os.urandom(3).hex()
+        obj['metadata']['namespace'] = namespace
+        obj['metadata']['uid'] = "00000000-0000-0000-0000-%012d" % next(self.uids)
+        obj['metadata']['creationTimestamp'] = timestamp()
+        apply_defaults(resource, obj)
+
+        key = (resource, namespace, obj['metadata']['name'])
+        with self.condition:
+            if key in self.objects:
+                raise ApiError(409, "AlreadyExists", resource + " \"" + key[2] + "\" already exists")
+
+            if resource == "pods":
+                obj['status'] = { "phase": "Pending" }
+                self.pod_timeline[(namespace, key[2])] = { "created": time.monotonic() }
+                self.schedule(self.pod_ready_delay + self.pull_images(obj) * self.image_pull_delay, self.pod_ready, namespace, key[2])
+            elif resource == "builds":
+                self.timeline[(namespace, key[2])] = { "created": time.monotonic() }
+
+            self.objects[key] = obj
+            self.record(resource, "ADDED", obj)
+            return copy.deepcopy(obj)
+
+    # Returns how many images a new pod pulls. Caller must hold the condition.
+    def pull_images(self, pod):
+        pulls = 0
+        for container in pod['spec'].get('initContainers', []) + pod['spec'].get('containers', []):
+            if container.get('imagePullPolicy', "Always") == "Always" or container['image'] not in self.pulled_images:
+                self.pulled_images.add(container['image'])
+                pulls += 1
+        self.calls[("kubelet", "pull", "images")] = self.calls.get(("kubelet", "pull", "images"), 0) + pulls
+        return pulls
+
+    def get(self, resource, namespace, name):
+        with self.condition:
+            if (resource, namespace, name) not in self.objects:
+                raise ApiError(404, "NotFound", resource + " \"" + name + "\" not found")
+            return copy.deepcopy(self.objects[(resource, namespace, name)])
+
+    # Returns (items, resource_version, continue token). The token is just where the next page starts.
+    def list(self, resource, namespace=None, selector=None, limit=None, continue_token=None):
+        with self.condition:
+            items = [ obj for (kind, obj_namespace, name), obj in sorted(self.objects.items()) if kind == resource and (namespace is None or obj_namespace == namespace) and selector_matches(selector, obj) ]
+            start = int(continue_token) if continue_token else 0
+            end = len(items) if not limit else start + int(limit)
+            next_token = str(end) if end < len(items) else None
+            return copy.deepcopy(items[start:end]), str(self.resource_version), next_token
+
+    def patch(self, resource, namespace, name, body, content_type):
+        with self.condition:
+            key = (resource, namespace, name)
+            if key not in self.objects:
+                raise ApiError(404, "NotFound", resource + " \"" + name + "\" not found")
+            old = self.objects[key]
+
+            if isinstance(body, list) or "json-patch" in content_type:
+                new = json_patch(old, body)
+            else:
+                new = merge_patch(old, body)
+            new['metadata']['resourceVersion'] = old['metadata']['resourceVersion']
+
+            if resource == "builds":
+                times = self.timeline.setdefault((namespace, name), {})
+                if old.get('claimedBy', "") == "" and new.get('claimedBy', "") != "":
+                    times.setdefault("claimed", time.monotonic())
+                if old.get('status') != new.get('status'):
+                    times.setdefault(new.get('status'), time.monotonic())
+
+            self.objects[key] = new
+            self.record(resource, "MODIFIED", new)
+            return copy.deepcopy(new)
+
+    def delete(self, resource, namespace, name):
+        with self.condition:
+            key = (resource, namespace, name)
+            if key not in self.objects:
+                raise ApiError(404, "NotFound", resource + " \"" + name + "\" not found")
+            obj = self.objects.pop(key)
+            if resource == "pods":
+                self.pod_timeline.setdefault((namespace, name), {})["deleted"] = time.monotonic()
+            self.record(resource, "DELETED", obj)
+            return copy.deepcopy(obj)
+
+    # Every container of the pod starts and is ready at once.
+    def pod_ready(self, namespace, name):
+        with self.condition:
+            pod = self.objects.get(("pods", namespace, name))
+            if pod is None:
+                return
+            pod['status'] = {
+                "phase": "Running",
+                "podIP": "10.0.0.1",
+                "startTime": timestamp(),
+                "containerStatuses": [ {
+                    "name": container['name'],
+                    "image": container.get('image', ""),
+                    "imageID": "docker.io/library/" + container.get('image', "") + "@sha256:" + hashlib.sha256(container.get('image', "").encode("utf-8")).hexdigest(),
+                    "ready": True,
+                    "started": True,
+                    "restartCount": 0,
+                    "state": { "running": { "startedAt": timestamp() } }
+                } for container in pod['spec'].get('containers', []) ]
+            }
+            self.pod_timeline.setdefault((namespace, name), {})["ready"] = time.monotonic()
+            self.record("pods", "MODIFIED", pod)
+
+    def pod_running(self, namespace, name):
+        with self.condition:
+            pod = self.objects.get(("pods", namespace, name))
+            return pod is not None and pod['status'].get('phase') == "Running"
+
+    # Blocks until the pod is gone or the cluster stops.
+    def wait_for_pod_deletion(self, namespace, name):
+        with self.condition:
+            while not self.stopped and ("pods", namespace, name) in self.objects:
+                self.condition.wait()
+
+    # Runs a command. Returns (output, exit code), "exit {n}" and "false" fail, everything else succeeds.
+    def exec(self, namespace, name, command):
+        with self.condition:
+            times = self.pod_timeline.setdefault((namespace, name), {})
+            times.setdefault("first_exec", time.monotonic())
+
+        time.sleep(self.exec_delay)
+
+        joined = " ".join(command)
+        match = re.search(r"\bexit (\d+)", joined)
+        if match:
+            return "", int(match.group(1))
+        if joined.strip() == "false":
+            return "", 1
+        return self.exec_output, 0
+
+    # Generator of watch events for a resource, from resource_version on. Without a resource_version every
+    # existing object is sent as ADDED first. Stops after timeout seconds, with a BOOKMARK when bookmarks were asked for.
+    def watch(self, resource, namespace=None, selector=None, resource_version=None, timeout=WATCH_MAX_SECONDS, bookmarks=False):
+        deadline = time.monotonic() + timeout
+
+        with self.condition:
+            if resource_version in [ None, "", "0" ]:
+                initial = [ { "type": "ADDED", "object": copy.deepcopy(obj) } for (kind, obj_namespace, name), obj in sorted(self.objects.items()) if kind == resource and (namespace is None or obj_namespace == namespace) and selector_matches(selector, obj) ]
+                last = self.resource_version
+            else:
+                initial = []
+                last = int(resource_version)
+
+        for event in initial:
+            yield event
+
+        while True:
+            with self.condition:
+                while not self.stopped and self.resource_version == last and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+
+                start = bisect.bisect_right(self.event_versions, last)
+                events = [ { "type": event_type, "object": obj } for version, kind, event_type, obj in self.events[start:] if kind == resource and (namespace is None or obj['metadata'].get('namespace') == namespace) and selector_matches(selector, obj) ]
+                last = self.resource_version
+                done = self.stopped or time.monotonic() >= deadline
+
+            for event in events:
+                yield event
+
+            if done:
+                if bookmarks and not self.stopped:
+                    apiVersion, kind = KINDS[resource]
+                    yield { "type": "BOOKMARK", "object": { "apiVersion": apiVersion, "kind": kind, "metadata": { "resourceVersion": str(last) } } }
+                return
+
+
+# Works out (namespace, resource, name, subresource) from a request path.
+def parse_path(path):
+    parts = [ part for part in path.split("/") if part != "" ]
+    if len(parts) > 0 and parts[0] == "api":
+        parts = parts[2:]
+    elif len(parts) > 0 and parts[0] == "apis":
+        parts = parts[3:]
+    else:
+        return None, None, None, None
+
+    namespace = None
+    if len(parts) > 2 and parts[0] == "namespaces":
+        namespace = parts[1]
+        parts = parts[2:]
+
+    parts = parts + [ None ] * (3 - len(parts))
+    return namespace, parts[0], parts[1], parts[2]
+
+def websocket_frame(opcode, payload):
+    header = bytes([ 0x80 | opcode ])
+    if len(payload) < 126:
+        header += bytes([ len(payload) ])
+    elif len(payload) < 65536:
+        header += bytes([ 126 ]) + struct.pack("!H", len(payload))
+    else:
+        header += bytes([ 127 ]) + struct.pack("!Q", len(payload))
+    return header + payload
+
+# Reads a frame from a client, they are always masked. Returns (opcode, payload), or None when the client went away.
+def read_websocket_frame(rfile):
+    header = rfile.read(2)
+    if len(header) < 2:
+        return None
+    opcode = header[0] & 0x0f
+    length = header[1] & 0x7f
+    if length == 126:
+        length = struct.unpack("!H", rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", rfile.read(8))[0]
+    mask = rfile.read(4) if header[1] & 0x80 else b"\0\0\0\0"
+    payload = rfile.read(length)
+    if len(payload) < length:
+        return None
+    return opcode, bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Requests would flood the output otherwise.
+    def log_message(self, format, *args):
+        return
+
+    def client_name(self):
+        authorization = self.headers.get("Authorization", "")
+        return authorization[len("Bearer "):] if authorization.startswith("Bearer ") else "anonymous"
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def write_chunk(self, data):
+        self.wfile.write(("%x\r\n" % len(data)).encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", "0"))
+        if length == 0:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def handle_request(self, method):
+        cluster = self.server.cluster
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        param = lambda name, default=None: query.get(name, [ default ])[-1]
+        # Clients spell booleans differently, kubernetes_asyncio sends "True".
+        flag = lambda name: (param(name) or "").lower() in [ "true", "1" ]
+        if url.path.startswith("/v2/"):
+            self.handle_registry(cluster, method, url.path)
+            return
+
+        namespace, resource, name, subresource = parse_path(url.path)
+        body = self.read_body()
+
+        if resource not in KINDS:
+            self.send_json(404, ApiError(404, "NotFound", "the server could not find the requested resource").status())
+            return
+
+        watching = method == "GET" and flag("watch")
+        verb = "watch" if watching else { "GET": "get" if name else "list", "POST": "create", "PATCH": "patch", "PUT": "update", "DELETE": "delete" }[method]
+        if subresource == "exec":
+            verb = "create"
+        cluster.count_call(self.client_name(), verb, resource + ("/" + subresource if subresource else ""))
+
+        try:
+            if subresource == "exec":
+                self.handle_exec(cluster, namespace, name, query)
+            elif subresource == "log":
+                self.handle_log(cluster, namespace, name, flag("follow"), flag("timestamps"), param("sinceSeconds"))
+            elif watching:
+                self.handle_watch(cluster, resource, namespace, param("labelSelector"), param("resourceVersion"), param("timeoutSeconds"), flag("allowWatchBookmarks"))
+            elif method == "GET" and name is None:
+                items, resource_version, next_token = cluster.list(resource, namespace, param("labelSelector"), param("limit"), param("continue"))
+                metadata = { "resourceVersion": resource_version }
+                if next_token is not None:
+                    metadata["continue"] = next_token
+                self.send_json(200, { "apiVersion": KINDS[resource][0], "kind": KINDS[resource][1] + "List", "metadata": metadata, "items": items })
+            elif method == "GET":
+                self.send_json(200, cluster.get(resource, namespace, name))
+            elif method == "POST":
+                self.send_json(201, cluster.create(resource, namespace, body))
+            elif method == "PATCH":
+                self.send_json(200, cluster.patch(resource, namespace, name, body, self.headers.get("Content-Type", "")))
+            elif method == "DELETE":
+                # The API server answers with the object as it was deleted.
+                self.send_json(200, cluster.delete(resource, namespace, name))
+            else:
+                raise ApiError(405, "MethodNotAllowed", method + " is not supported")
+        except ApiError as err:
+            self.send_json(err.code, err.status())
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def handle_watch(self, cluster, resource, namespace, selector, resource_version, timeout, bookmarks):
+        self.start_chunked("application/json")
+        for event in cluster.watch(resource, namespace, selector, resource_version, float(timeout or WATCH_MAX_SECONDS), bookmarks):
+            self.write_chunk((json.dumps(event) + "\n").encode("utf-8"))
+        self.write_chunk(b"")
+
+    # Manifests of every tag exist, without a body. Nothing asks for a token.
+    def handle_registry(self, cluster, method, path):
+        cluster.count_call("registry", method.lower(), "manifests")
+        repository, _, reference = path[len("/v2/"):].rpartition("/manifests/")
+        if repository == "" or method not in [ "GET", "HEAD" ]:
+            self.send_json(404, { "errors": [ { "code": "NAME_UNKNOWN" } ] })
+            return
+        digest = reference if reference.startswith("sha256:") else "sha256:" + hashlib.sha256((repository + ":" + reference).encode("utf-8")).hexdigest()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.oci.image.index.v1+json")
+        self.send_header("Docker-Content-Digest", digest)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # The lines of a container are written when the pod is made, a microsecond apart, so every read gets the same ones.
+    def handle_log(self, cluster, namespace, name, follow, timestamps, since_seconds=None):
+        pod = cluster.get("pods", namespace, name)
+        created = datetime.datetime.strptime(pod['metadata']['creationTimestamp'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc)
+        since = None if since_seconds is None else datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=int(since_seconds))
+        self.start_chunked("text/plain")
+        for line in range(cluster.log_lines):
+            written = created + datetime.timedelta(microseconds=line)
+            if since is not None and written < since:
+                continue
+            prefix = written.strftime("%Y-%m-%dT%H:%M:%S.%fZ ") if timestamps else ""
+            self.write_chunk((prefix + "log line " + str(line) + "\n").encode("utf-8"))
+        if follow:
+            cluster.wait_for_pod_deletion(namespace, name)
+        self.write_chunk(b"")
+
+    # Exec over a websocket with the v4.channel.k8s.io protocol. Output goes on stdout, the exit status on the error channel.
+    def handle_exec(self, cluster, namespace, name, query):
+        if not cluster.pod_running(namespace, name):
+            raise ApiError(404, "NotFound", "pods \"" + str(name) + "\" not found or not running")
+
+        accept = base64.b64encode(hashlib.sha1((self.headers["Sec-WebSocket-Key"] + WEBSOCKET_GUID).encode("ascii")).digest()).decode("ascii")
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.send_header("Sec-WebSocket-Protocol", "v4.channel.k8s.io")
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        command = query.get("command", [])
+        if len(command) == 5 and command[3] == "jetci-agent":
+            self.handle_agent(cluster, namespace, name, command[4])
+            return
+
+        output, exit_code = cluster.exec(namespace, name, command)
+        if exit_code == 0:
+            status = { "metadata": {}, "status": "Success" }
+        else:
+            status = { "metadata": {}, "status": "Failure", "message": "command terminated with non-zero exit code: " + str(exit_code), "reason": "NonZeroExitCode", "details": { "causes": [ { "reason": "ExitCode", "message": str(exit_code) } ] } }
+
+        for line in output.splitlines(keepends=True):
+            self.send_stdout(line)
+            time.sleep(cluster.exec_line_delay)
+        self.wfile.write(websocket_frame(0x2, bytes([ ERROR_CHANNEL ]) + json.dumps(status).encode("utf-8")))
+        self.wfile.write(websocket_frame(0x8, struct.pack("!H", 1000)))
+        self.wfile.flush()
+
+
+    # The command agent of agent.py. Its script isn't run, the frames it would write are made up here, and every
+    # command goes through FakeCluster.exec() like an exec does.
+    def handle_agent(self, cluster, namespace, name, token):
+        self.send_stdout("\n" + token + " ready\n")
+        buffer = ""
+        failed = None
+        while True:
+            frame = read_websocket_frame(self.rfile)
+            if frame is None or frame[0] == 0x8:
+                break
+            if len(frame[1]) < 1 or frame[1][0] != STDIN_CHANNEL:
+                continue
+
+            buffer += frame[1][1:].decode("utf-8")
+            while "\n" in buffer:
+                line, buffer = buffer.split("\n", 1)
+                batch, command_id, command = line.split(" ", 2)
+                if batch == failed:
+                    self.send_stdout("\n" + token + " skip " + command_id + "\n")
+                    continue
+                output, exit_code = cluster.exec(namespace, name, shlex.split(command))
+                if exit_code != 0:
+                    failed = batch
+                for line in output.splitlines(keepends=True):
+                    self.send_stdout(line)
+                    time.sleep(cluster.exec_line_delay)
+                self.send_stdout("\n" + token + " end " + command_id + " " + str(exit_code) + "\n")
+
+        try:
+            self.wfile.write(websocket_frame(0x8, struct.pack("!H", 1000)))
+            self.wfile.flush()
+        except OSError:
+            pass
+
+    def send_stdout(self, data):
+        self.wfile.write(websocket_frame(0x2, bytes([ STDOUT_CHANNEL ]) + data.encode("utf-8")))
+        self.wfile.flush()
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, cluster, port=0):
+        super().__init__(("127.0.0.1", port), FakeApiHandler)
+        self.cluster = cluster
+
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+# Serves the cluster from a thread of its own.
+def start_server(cluster, port=0):
+    server = FakeApiServer(cluster, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Writes a kubeconfig for the server. The token tells the clients apart in FakeCluster.calls.
+def write_kubeconfig(path, url, token="bench"):
+    kubeconfig = {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "clusters": [ { "name": "fake", "cluster": { "server": url } } ],
+        "users": [ { "name": "fake", "user": { "token": token } } ],
+        "contexts": [ { "name": "fake", "context": { "cluster": "fake", "user": "fake" } } ],
+        "current-context": "fake"
+    }
+    with open(path, "w") as kubeconfig_file:
+        json.dump(kubeconfig, kubeconfig_file)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage:", sys.argv[0], "{kubeconfig path} [port]")
+        sys.exit(1)
+
+    server = start_server(FakeCluster(), int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    write_kubeconfig(sys.argv[1], server.url())
+    print("Serving a fake API server on", server.url(), ", kubeconfig written to", sys.argv[1])
+    threading.Event().wait()
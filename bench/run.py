@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# Benchmarks the operator, and optionally the webhook endpoint, against the fake API server in fakeapi.py.
+#
+#   python3 bench/run.py [--builds 50] [--pipelines 2] [--commands 3] [--webhook] [--save NAME] [--compare NAME]
+#
+# The operator runs as its own process like it does in a cluster, pointed at the fake API server with a kubeconfig.
+# Builds are created straight in the fake cluster, or through the webhook endpoint with --webhook. .jetci.yaml
+# comes from a local git repository made for the run, so fetching it is real work too.
+#
+# Once every build is finished this prints builds per minute, API calls per build, p50/p99 of every build phase
+# and the peak memory and threads of each process. --save keeps the results in bench/baselines/{NAME}.json,
+# --compare prints how the run differs from a saved one and exits with 1 when something got worse than --threshold.
+#
+# Settings starting with JETCI_ are passed on to the processes, so this benchmarks with 4 workers:
+#   JETCI_PIPELINE_WORKERS=4 python3 bench/run.py
+#
+# Images are looked up in the fake registry of fakeapi.py, so this benchmarks pinned images:
+#   JETCI_IMAGE_DIGEST_TTL=300 python3 bench/run.py --image-pull-delay 1
+import os
+import sys
+import math
+import base64
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import urllib.request
+import concurrent.futures
+
+import fakeapi
+
+BENCH_DIR    = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR     = os.path.dirname(BENCH_DIR)
+BASELINE_DIR = os.path.join(BENCH_DIR, "baselines")
+
+NAMESPACE          = "bench"
+OPERATOR_NAMESPACE = "jetci"
+API_TOKEN          = "bench-token"
+
+FINISHED_BUILD_STATUSES = [ "Complete", "Failed", "Cancelled" ]
+
+# Build phases, from one point of the build timeline to another.
+BUILD_PHASES = [
+    ("claim", "created", "claimed"),
+    ("plan", "claimed", "Queued"),
+    ("queue", "Queued", "Running"),
+    ("run", "Running", "finished"),
+    ("total", "created", "finished")
+]
+
+# Results where more is better, everything else is better when it goes down.
+HIGHER_IS_BETTER = [ "builds_per_minute" ]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# Nearest rank percentile.
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+# With step_cache every command is cached, so builds after the first replay them.
+def jetci_yaml(pipelines, commands, fail, step_cache=False):
+    spec = { "pipelines": [] }
+    for pipeline in range(pipelines):
+        spec["pipelines"].append({
+            "name": "pipeline-" + str(pipeline),
+            "containers": [ {
+                "name": "main",
+                "image": "alpine:latest",
+                "commands": [ { "run": "echo command " + str(command), "cache": True } if step_cache else "echo command " + str(command) for command in range(commands) ]
+            } ]
+        })
+    if fail:
+        spec["pipelines"][-1]["containers"][0]["commands"].append("exit 1")
+    return json.dumps(spec, indent=2)
+
+# A git repository with a .jetci.yaml on a main branch.
+def make_git_repository(path, contents):
+    os.makedirs(path)
+    git = lambda *args: subprocess.run([ "git", "-c", "user.name=bench", "-c", "user.email=bench@localhost" ] + list(args), cwd=path, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    git("init", "-b", "main")
+    with open(os.path.join(path, ".jetci.yaml"), "w") as jetci_file:
+        jetci_file.write(contents)
+    with open(os.path.join(path, "README.md"), "w") as readme:
+        readme.write("bench\n")
+    git("add", ".")
+    git("commit", "-m", "bench")
+
+def seed_cluster(cluster, args, git_path):
+    cluster.create("secrets", NAMESPACE, {
+        "metadata": { "name": "bench-api-token" },
+        "type": "Opaque",
+        "data": { "api_token": base64.b64encode(API_TOKEN.encode("utf-8")).decode("ascii") }
+    })
+    for i in range(args.repositories):
+        cluster.create("repositories", NAMESPACE, {
+            "metadata": { "name": "repo-" + str(i) },
+            "spec": {
+                "repoPath": git_path,
+                "repoBranch": "main",
+                "apiToken": { "secretName": "bench-api-token", "secretKeyPath": "api_token" },
+                "buildPolicy": args.build_policy,
+                "debounceSeconds": args.debounce
+            }
+        })
+
+# Starts operator.py or endpoint.py with a kubeconfig of its own, so its API calls are counted apart.
+def start_process(script, work_dir, server, token, extra_env):
+    kubeconfig = os.path.join(work_dir, token + ".kubeconfig")
+    fakeapi.write_kubeconfig(kubeconfig, server.url(), token)
+
+    env = { key: value for key, value in os.environ.items() if key not in [ "KUBECONFIG", "KUBERNETES_SERVICE_HOST" ] }
+    env.update({
+        "KUBECONFIG": kubeconfig,
+        "PYTHONUNBUFFERED": "1",
+        "JETCI_API_STATS_INTERVAL": "0",
+        "JETCI_METRICS_PORT": "0",
+        "JETCI_LOG_STREAM_PORT": "0"
+    })
+    env.update(extra_env)
+
+    log_file = open(os.path.join(work_dir, token + ".log"), "w")
+    process = subprocess.Popen([ sys.executable, os.path.join(REPO_DIR, script) ], env=env, stdout=log_file, stderr=subprocess.STDOUT, cwd=work_dir)
+    process.log_path = log_file.name
+    return process
+
+# Samples the peak memory and thread count of processes from /proc.
+class ProcessSampler:
+    def __init__(self, processes, interval=0.1):
+        self.processes = processes
+        self.interval = interval
+        self.peaks = { name: { "rss_mb": 0.0, "threads": 0 } for name in processes }
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def sample(self, name, process):
+        try:
+            with open("/proc/" + str(process.pid) + "/status") as status_file:
+                for line in status_file:
+                    if line.startswith("VmHWM:") or line.startswith("VmRSS:"):
+                        self.peaks[name]["rss_mb"] = max(self.peaks[name]["rss_mb"], int(line.split()[1]) / 1024)
+                    elif line.startswith("Threads:"):
+                        self.peaks[name]["threads"] = max(self.peaks[name]["threads"], int(line.split()[1]))
+        except (OSError, ValueError):
+            return
+
+    def run(self):
+        while not self.stop_event.is_set():
+            for name, process in self.processes.items():
+                self.sample(name, process)
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        for name, process in self.processes.items():
+            self.sample(name, process)
+        self.stop_event.set()
+        self.thread.join()
+        return self.peaks
+
+def wait_until(condition, timeout, what, processes):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        for name, process in processes.items():
+            if process.poll() is not None:
+                raise SystemExit(name + " exited with " + str(process.returncode) + ", see " + process.log_path)
+        if time.monotonic() > deadline:
+            raise SystemExit("Timed out waiting for " + what)
+        time.sleep(0.05)
+
+# Returns (seconds the request took, whether the trigger was merged into a build instead of making one).
+def trigger_webhook(port, repository):
+    url = "http://127.0.0.1:" + str(port) + "/run_build?namespace=" + NAMESPACE + "&repository=" + repository + "&auth_token=" + API_TOKEN
+    start = time.monotonic()
+    with urllib.request.urlopen(url, timeout=30) as response:
+        body = json.loads(response.read())
+    return time.monotonic() - start, body.get("message", "").startswith("merged")
+
+def unfinished_builds(cluster):
+    with cluster.condition:
+        return [ key for key, obj in cluster.objects.items() if key[0] == "builds" and obj.get('status') not in FINISHED_BUILD_STATUSES ]
+
+def summarize(values):
+    return { "p50": percentile(values, 0.5), "p99": percentile(values, 0.99), "max": max(values) if values else None, "count": len(values) }
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix="jetci-bench-")
+    git_path = os.path.join(work_dir, "repository")
+    make_git_repository(git_path, jetci_yaml(args.pipelines, args.commands, args.fail, args.step_cache))
+
+    cluster = fakeapi.FakeCluster(pod_ready_delay=args.pod_ready_delay, exec_delay=args.exec_delay, exec_lines=args.exec_lines, log_lines=args.log_lines, image_pull_delay=args.image_pull_delay)
+    server = fakeapi.start_server(cluster)
+    seed_cluster(cluster, args, git_path)
+
+    processes = {}
+    processes["operator"] = start_process("operator.py", work_dir, server, "operator", {
+        "JETCI_OPERATOR_NAMESPACE": OPERATOR_NAMESPACE,
+        "JETCI_LOG_DIR": os.path.join(work_dir, "logs"),
+        "JETCI_STEP_CACHE_DIR": os.path.join(work_dir, "step-cache"),
+        "JETCI_GIT_MIRROR_DIR": os.path.join(work_dir, "git-mirrors"),
+        "JETCI_REGISTRY_MIRRORS": "docker.io=" + server.url()
+    })
+
+    webhook_port = None
+    if args.webhook:
+        webhook_port = free_port()
+        webhook_env = { "JETCI_WEBHOOK_PORT": str(webhook_port) }
+        try:
+            import waitress
+        except ImportError:
+            webhook_env["JETCI_WEBHOOK_SERVER"] = "flask"
+        processes["webhook"] = start_process("endpoint.py", work_dir, server, "webhook", webhook_env)
+
+    sampler = ProcessSampler(processes)
+    results = {}
+
+    try:
+        # The operator is up once it holds its Lease, the webhook once it answers.
+        wait_until(lambda: len(cluster.list("leases", OPERATOR_NAMESPACE)[0]) > 0, 60, "the operator to start", processes)
+        if args.webhook:
+            def webhook_up():
+                try:
+                    with socket.create_connection(("127.0.0.1", webhook_port), timeout=1):
+                        return True
+                except OSError:
+                    return False
+            wait_until(webhook_up, 60, "the webhook endpoint to start", processes)
+
+        calls_before = dict(cluster.calls)
+        start = time.monotonic()
+        repositories = [ "repo-" + str(i % args.repositories) for i in range(args.builds) ]
+
+        webhook_latencies = []
+        merged = 0
+        if args.webhook:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                futures = []
+                for repository in repositories:
+                    futures.append(executor.submit(trigger_webhook, webhook_port, repository))
+                    if args.rate > 0:
+                        time.sleep(1 / args.rate)
+                for future in futures:
+                    latency, was_merged = future.result()
+                    webhook_latencies.append(latency)
+                    merged += was_merged
+        else:
+            for i in range(len(repositories)):
+                cluster.create("builds", NAMESPACE, { "metadata": { "name": repositories[i] + "-" + str(i) }, "spec": { "repository": repositories[i] } })
+                if args.rate > 0:
+                    time.sleep(1 / args.rate)
+
+        # Triggers merged by --debounce don't make a Build of their own.
+        wait_until(lambda: len(unfinished_builds(cluster)) == 0 and len(cluster.timeline) >= args.builds - merged, args.timeout, "the builds to finish", processes)
+        duration = time.monotonic() - start
+    finally:
+        peaks = sampler.stop()
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        cluster.stop()
+        server.shutdown()
+
+    # Build phases from the timeline the fake API server kept.
+    statuses = {}
+    phases = { name: [] for name, _, _ in BUILD_PHASES }
+    with cluster.condition:
+        for key, times in cluster.timeline.items():
+            status = cluster.objects[("builds", key[0], key[1])]['status']
+            statuses[status] = statuses.get(status, 0) + 1
+            times = dict(times, finished=times.get(status))
+            for name, begin, end in BUILD_PHASES:
+                if begin in times and end in times and times[end] is not None:
+                    phases[name].append(times[end] - times[begin])
+
+        pod_ready_to_exec = [ times["first_exec"] - times["ready"] for times in cluster.pod_timeline.values() if "ready" in times and "first_exec" in times ]
+        pod_lifetime = [ times["deleted"] - times["created"] for times in cluster.pod_timeline.values() if "deleted" in times ]
+
+    # API calls made while the builds ran, per client.
+    calls = {}
+    for (client, verb, resource), count in cluster.calls.items():
+        count -= calls_before.get((client, verb, resource), 0)
+        if count > 0:
+            calls.setdefault(client, {})[verb + " " + resource] = count
+
+    results = {
+        "builds": args.builds,
+        "merged": merged,
+        "statuses": statuses,
+        "seconds": duration,
+        "builds_per_minute": args.builds / duration * 60,
+        "api_calls_per_build": { client: sum(counts.values()) / args.builds for client, counts in calls.items() },
+        "api_calls": calls,
+        "phases": { name: summarize(values) for name, values in phases.items() },
+        "pod_ready_to_first_exec": summarize(pod_ready_to_exec),
+        "pod_lifetime": summarize(pod_lifetime),
+        "peaks": peaks
+    }
+    if args.webhook:
+        results["webhook_request"] = summarize(webhook_latencies)
+
+    if args.keep:
+        print("Work directory kept in", work_dir)
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+def fmt(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return "%.3f" % value
+    return str(value)
+
+def report(results):
+    print("Builds:             ", results["builds"], results["statuses"])
+    if results.get("merged", 0) > 0:
+        print("Merged triggers:    ", results["merged"])
+    print("Time:               ", fmt(results["seconds"]), "s")
+    print("Builds per minute:  ", fmt(results["builds_per_minute"]))
+    for client, per_build in sorted(results["api_calls_per_build"].items()):
+        print("API calls per build:", client, fmt(per_build))
+        for call, count in sorted(results["api_calls"][client].items(), key=lambda item: -item[1]):
+            print("    %-28s %8.2f" % (call, count / results["builds"]))
+
+    print()
+    print("%-24s %10s %10s %10s" % ("phase (seconds)", "p50", "p99", "max"))
+    rows = [ ("build " + name, stats) for name, stats in results["phases"].items() ]
+    rows.append(("pod ready to first exec", results["pod_ready_to_first_exec"]))
+    rows.append(("pod lifetime", results["pod_lifetime"]))
+    if "webhook_request" in results:
+        rows.append(("webhook request", results["webhook_request"]))
+    for name, stats in rows:
+        print("%-24s %10s %10s %10s" % (name, fmt(stats["p50"]), fmt(stats["p99"]), fmt(stats["max"])))
+
+    print()
+    for name, peak in sorted(results["peaks"].items()):
+        print("Peak", name + ":", fmt(peak["rss_mb"]), "MB,", peak["threads"], "threads")
+
+# The numbers worth comparing between runs, name -> value.
+def comparable(results):
+    values = {
+        "builds_per_minute": results["builds_per_minute"],
+        "pod_ready_to_first_exec_p50": results["pod_ready_to_first_exec"]["p50"],
+        "pod_ready_to_first_exec_p99": results["pod_ready_to_first_exec"]["p99"]
+    }
+    for client, per_build in results["api_calls_per_build"].items():
+        values["api_calls_per_build_" + client] = per_build
+    for name, stats in results["phases"].items():
+        values["build_" + name + "_p50"] = stats["p50"]
+        values["build_" + name + "_p99"] = stats["p99"]
+    if "webhook_request" in results:
+        values["webhook_request_p50"] = results["webhook_request"]["p50"]
+        values["webhook_request_p99"] = results["webhook_request"]["p99"]
+    for name, peak in results["peaks"].items():
+        values["peak_rss_mb_" + name] = peak["rss_mb"]
+        values["peak_threads_" + name] = peak["threads"]
+    return values
+
+# Prints the difference to a baseline. Returns the names of the results that got worse by more than threshold.
+# Latencies also have to be min_seconds worse, a few milliseconds either way is noise.
+def compare(baseline, results, threshold, min_seconds):
+    if baseline["parameters"] != results["parameters"]:
+        print("Warning: the baseline was run with different parameters:", baseline["parameters"])
+
+    old_values = comparable(baseline["results"])
+    new_values = comparable(results["results"])
+    regressions = []
+
+    print()
+    print("%-36s %12s %12s %9s" % ("compared to baseline", "baseline", "now", "change"))
+    for name in sorted(new_values):
+        old = old_values.get(name)
+        new = new_values[name]
+        if old is None or new is None:
+            continue
+
+        change = (new - old) / old if old != 0 else 0.0
+        worse = -change if name in HIGHER_IS_BETTER else change
+        flag = ""
+        latency = name.endswith("_p50") or name.endswith("_p99")
+        if worse > threshold and (not latency or abs(new - old) >= min_seconds):
+            flag = "  worse"
+            regressions.append(name)
+        print("%-36s %12s %12s %8.1f%%%s" % (name, fmt(old), fmt(new), change * 100, flag))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks jetci against a fake Kubernetes API server.")
+    parser.add_argument("--builds", type=int, default=50, help="builds to run")
+    parser.add_argument("--repositories", type=int, default=5, help="repositories the builds are spread over")
+    parser.add_argument("--pipelines", type=int, default=2, help="pipelines per build")
+    parser.add_argument("--commands", type=int, default=3, help="commands per pipeline")
+    parser.add_argument("--fail", action="store_true", help="make the last pipeline of every build fail")
+    parser.add_argument("--step-cache", action="store_true", help="cache every command in the step cache")
+    parser.add_argument("--rate", type=float, default=0, help="builds started per second, 0 starts them all at once")
+    parser.add_argument("--webhook", action="store_true", help="start builds through the webhook endpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="webhook requests at once")
+    parser.add_argument("--build-policy", default="run-all", help="buildPolicy of the repositories")
+    parser.add_argument("--debounce", type=int, default=0, help="debounceSeconds of the repositories")
+    parser.add_argument("--pod-ready-delay", type=float, default=0.5, help="seconds until a pod is ready")
+    parser.add_argument("--exec-delay", type=float, default=0.05, help="seconds every command takes")
+    parser.add_argument("--exec-lines", type=int, default=1, help="lines every command prints")
+    parser.add_argument("--log-lines", type=int, default=2, help="lines every container logs")
+    parser.add_argument("--image-pull-delay", type=float, default=0, help="seconds every image pull takes")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for the builds")
+    parser.add_argument("--save", metavar="NAME", help="save the results as baseline NAME")
+    parser.add_argument("--compare", metavar="NAME", help="compare the results to baseline NAME")
+    parser.add_argument("--threshold", type=float, default=0.1, help="change that counts as a regression, 0.1 is 10%%")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="change in a latency that counts as a regression")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory with the process logs")
+    args = parser.parse_args()
+
+    parameters = { key: value for key, value in vars(args).items() if key not in [ "save", "compare", "threshold", "min_seconds", "keep", "timeout" ] }
+    parameters["env"] = { key: value for key, value in sorted(os.environ.items()) if key.startswith("JETCI_") }
+
+    results = {
+        "parameters": parameters,
+        "results": run(args),
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    }
+    try:
+        results["commit"] = subprocess.check_output([ "git", "rev-parse", "HEAD" ], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    report(results["results"])
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, args.save + ".json"), "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print()
+        print("Saved baseline", args.save)
+
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, args.compare + ".json")) as baseline_file:
+            baseline = json.load(baseline_file)
+        if len(compare(baseline, results, args.threshold, args.min_seconds)) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
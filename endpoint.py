@@ -1,21 +1,71 @@
 #!/usr/bin/env python3
 from flask import Flask, request
-from kubernetes import client, config
+from kubernetes import client, watch
+from shared import API_GROUP, API_VERSION, api_client, get_repo
 import secrets
 import base64
 import json
+import hmac
+import os
+import time
+import threading
+import metrics
+
+# How the endpoint is served. "waitress" is a multi-threaded production server, "flask" is Flask's development server.
+WEBHOOK_SERVER  = os.environ.get("JETCI_WEBHOOK_SERVER", "waitress")
+WEBHOOK_THREADS = int(os.environ.get("JETCI_WEBHOOK_THREADS", "16"))
+WEBHOOK_PORT    = int(os.environ.get("JETCI_WEBHOOK_PORT", "80"))
+
+# How long repositories and API tokens are kept when they had to be read from the API server.
+REPO_CACHE_TTL   = float(os.environ.get("JETCI_REPO_CACHE_TTL", "30"))
+SECRET_CACHE_TTL = float(os.environ.get("JETCI_SECRET_CACHE_TTL", "30"))
+
+# Served on JETCI_METRICS_PORT, see metrics.py.
+REQUEST_SECONDS      = metrics.Histogram("jetci_webhook_request_seconds", "Time /run_build requests took.", labels=("result",))
+CREATE_BUILD_SECONDS = metrics.Histogram("jetci_webhook_create_build_seconds", "Time creating or merging a build took.", labels=("result",))
+
+# The build we last created for each repository, (namespace, repo name) -> (time, build name).
+# Triggers within the repository's spec.debounceSeconds go into that build while no operator has claimed it yet.
+recent_builds = {}
+recent_builds_locker = threading.Lock()
+
+# Puts the env of a new trigger into the last build of the repo. Returns the response, or None when a new build is needed.
+def merge_build(repo, env):
+    debounce = repo['spec'].get('debounceSeconds', 0)
+    key = (repo['metadata']['namespace'], repo['metadata']['name'])
+
+    with recent_builds_locker:
+        entry = recent_builds.get(key)
+    if debounce <= 0 or entry is None or time.monotonic() - entry[0] >= debounce:
+        return None
+
+    # The newest trigger wins. The "test"s make this fail once an operator picked the build up.
+    operations = [
+        { "op": "test", "path": "/claimedBy", "value": "" },
+        { "op": "test", "path": "/status", "value": "Pending" },
+        { "op": "replace", "path": "/spec/env", "value": env }
+    ]
 
-# API Information for custom resources
-API_VERSION = "v1alpha1"
-API_GROUP   = "future.jetci.xyz"
+    try:
+        client.CustomObjectsApi(api_client).patch_namespaced_custom_object(API_GROUP, API_VERSION, key[0], "builds", entry[1], operations, _content_type="application/json-patch+json")
+    except client.exceptions.ApiException:
+        return None
+
+    print("merged trigger into build:", key[0], entry[1])
 
-try:
-    config.load_kube_config()
-except:
-    # load_kube_config throws if there is no config, but does not document what it throws, so I can't rely on any particular type here
-    config.load_incluster_config()
+    return { "status": "success", "name": entry[1], "message": "merged into build: " + entry[1] }
 
 def create_build(repo, env):
+    start = time.monotonic()
+    result = new_build(repo, env)
+    CREATE_BUILD_SECONDS.observe(time.monotonic() - start, "merged" if result['message'].startswith("merged") else result['status'])
+    return result
+
+def new_build(repo, env):
+    merged = merge_build(repo, env)
+    if merged is not None:
+        return merged
+
     build_name = repo['metadata']['name'] + "-" + secrets.token_hex(4)
 
     build_obj = {
@@ -31,29 +81,22 @@ def create_build(repo, env):
     }
 
     try:
-        build_obj = client.CustomObjectsApi().create_namespaced_custom_object(API_GROUP, API_VERSION, repo['metadata']['namespace'], "builds", build_obj)
+        build_obj = client.CustomObjectsApi(api_client).create_namespaced_custom_object(API_GROUP, API_VERSION, repo['metadata']['namespace'], "builds", build_obj)
     except:
         print("failed to create build for repo:", repo['metadata']['namespace'], repo['metadata']['name'])
         return { "status": "failed", "name": build_name, "message": "failed to create build" }
     
     print("created new build:", repo['metadata']['namespace'], build_name)
 
-    return { "status": "success", "name": build_name, "message": "created build: " + build_name }
-
-# TODO: Consolidate into shared.py
-def get_repo(namespace, reponame):
-    try:
-        repo = client.CustomObjectsApi().get_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "repositories", reponame)
-    except:
-        print("repo not found:", namespace, reponame)
-        return False
-    return repo
+    with recent_builds_locker:
+        recent_builds[(repo['metadata']['namespace'], repo['metadata']['name'])] = (time.monotonic(), build_name)
 
+    return { "status": "success", "name": build_name, "message": "created build: " + build_name }
 
 def get_api_token(repo):
     # Neet to get the actual API token from secrets
     try:
-        jetci_conf = client.CoreV1Api().read_namespaced_secret(repo['spec']['apiToken']['secretName'], repo['metadata']['namespace'])
+        jetci_conf = client.CoreV1Api(api_client).read_namespaced_secret(repo['spec']['apiToken']['secretName'], repo['metadata']['namespace'])
     except:
         print("secret not found for repo:", repo['metadata']['namespace'], repo['metadata']['name'], repo['spec']['apiToken']['secretName'])
         return False
@@ -67,18 +110,86 @@ def get_api_token(repo):
     return api_token
 
 
+# Repositories are kept in memory from a watch, so a push storm doesn't turn into a GET of the repository per request.
+# Until the watch has synced, or after it broke, get_repo() is used and the answer kept for REPO_CACHE_TTL seconds.
+# API tokens are kept for SECRET_CACHE_TTL seconds, keyed by the secret the repository points at.
+repo_cache = {}
+repo_cache_synced = threading.Event()
+repo_fallback_cache = {}
+token_cache = {}
+cache_locker = threading.Lock()
+
+def repo_informer():
+    global repo_cache
+    while True:
+        try:
+            repos = client.CustomObjectsApi(api_client).list_cluster_custom_object(API_GROUP, API_VERSION, "repositories")
+            with cache_locker:
+                repo_cache = { (repo['metadata']['namespace'], repo['metadata']['name']): repo for repo in repos['items'] }
+            repo_cache_synced.set()
+
+            resource_version = repos['metadata']['resourceVersion']
+            while True:
+                for event in watch.Watch().stream(client.CustomObjectsApi(api_client).list_cluster_custom_object, API_GROUP, API_VERSION, "repositories", resource_version=resource_version):
+                    repo = event['object']
+                    with cache_locker:
+                        if event['type'] == "DELETED":
+                            repo_cache.pop((repo['metadata']['namespace'], repo['metadata']['name']), None)
+                        else:
+                            repo_cache[(repo['metadata']['namespace'], repo['metadata']['name'])] = repo
+                    resource_version = repo['metadata']['resourceVersion']
+        except Exception as err:
+            print("repo_informer(): Watch failed, relisting:", err)
+            repo_cache_synced.clear()
+            time.sleep(1)
+
+def cached_repo(namespace, repo_name):
+    if repo_cache_synced.is_set():
+        with cache_locker:
+            return repo_cache.get((namespace, repo_name), False)
+
+    with cache_locker:
+        entry = repo_fallback_cache.get((namespace, repo_name))
+    if entry is not None and time.monotonic() - entry[0] < REPO_CACHE_TTL:
+        return entry[1]
+
+    repo = get_repo(namespace, repo_name)
+    with cache_locker:
+        repo_fallback_cache[(namespace, repo_name)] = (time.monotonic(), repo)
+    return repo
+
+def cached_api_token(repo):
+    key = (repo['metadata']['namespace'], repo['spec']['apiToken']['secretName'], repo['spec']['apiToken']['secretKeyPath'])
+    with cache_locker:
+        entry = token_cache.get(key)
+    if entry is not None and time.monotonic() - entry[0] < SECRET_CACHE_TTL:
+        return entry[1]
+
+    api_token = get_api_token(repo)
+    with cache_locker:
+        token_cache[key] = (time.monotonic(), api_token)
+    return api_token
+
+
 app = Flask(__name__)
 
 
 @app.route("/run_build")
 def run_build():
+    start = time.monotonic()
+    response = handle_run_build()
+    # Refusals come back as (body, status code).
+    REQUEST_SECONDS.observe(time.monotonic() - start, "forbidden" if isinstance(response, tuple) else "ok")
+    return response
+
+def handle_run_build():
     namespace = request.args.get('namespace')
     repo_name = request.args.get('repository')
     auth_token = request.args.get('auth_token')
     # TODO: Pull env stuff from POST data?
 
     # Get the repo
-    repo = get_repo(namespace, repo_name)
+    repo = cached_repo(namespace, repo_name)
 
     # Bad repo requested
     if repo == False:
@@ -86,10 +197,11 @@ def run_build():
         return "not authorized", 403
 
     # Get the API token.
-    api_token = get_api_token(repo)
+    api_token = cached_api_token(repo)
 
     # Someone didn't set an API Token or the token provided wasn't correct.
-    if api_token != auth_token:
+    # The comparison takes the same time however much of the token is right.
+    if api_token == False or auth_token is None or not hmac.compare_digest(api_token.encode('utf-8'), auth_token.encode('utf-8')):
         print("Provided API Token is invalid", namespace, repo_name)
         return "not authorized", 403
 
@@ -105,4 +217,14 @@ def run_build():
     return json.dumps(create_build(repo, env))
 
 
-app.run(host='0.0.0.0', port=80)
\ No newline at end of file
+threading.Thread(target=repo_informer, daemon=True).start()
+
+metrics.Callback("jetci_threads", "Threads running in the webhook endpoint.", threading.active_count)
+metrics.Callback("jetci_webhook_cached_repositories", "Repositories held by the repository informer.", lambda: len(repo_cache))
+metrics.start_server()
+
+if WEBHOOK_SERVER == "flask":
+    app.run(host='0.0.0.0', port=WEBHOOK_PORT)
+else:
+    from waitress import serve
+    serve(app, host='0.0.0.0', port=WEBHOOK_PORT, threads=WEBHOOK_THREADS)
\ No newline at end of file
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Image digests for the operator.
+#
+# Pipeline pods used to pull every image on every start, so every pipeline asked a registry about
+# alpine/git:latest and every image in .jetci.yaml. With JETCI_IMAGE_DIGEST_TTL set, the operator looks up the
+# digest a tag points at once per TTL instead, and pods get the image pinned to that digest with IfNotPresent.
+# Nodes that have it don't ask the registry at all, and every pipeline of a build runs the exact same images even
+# when a tag moves while it runs.
+#
+# Digests come from the registry's HTTP API, a HEAD of the manifest, with an anonymous token when the registry
+# asks for one. Images that can't be looked up, like ones in private registries, are left as they are and pulled
+# every time like before. Images that already have a digest are never looked up.
+#
+# Settings:
+#   JETCI_IMAGE_DIGEST_TTL - seconds a digest is used for before it's looked up again, 0 turns pinning off.
+#   JETCI_REGISTRY_MIRRORS - registry=url pairs separated by commas, the API of a registry is asked at its url
+#                            instead, like docker.io=http://registry-cache:5000.
+import os
+import json
+import time
+import threading
+import collections
+import urllib.parse
+import urllib.request
+import urllib.error
+
+IMAGE_DIGEST_TTL = float(os.environ.get("JETCI_IMAGE_DIGEST_TTL", "0"))
+REGISTRY_MIRRORS = dict(pair.strip().split("=", 1) for pair in os.environ.get("JETCI_REGISTRY_MIRRORS", "").split(",") if "=" in pair)
+
+# Seconds a failed look up is remembered, so an image that can't be looked up doesn't cost a request every build.
+FAILURE_TTL = 60
+
+# Seconds a registry gets to answer.
+REGISTRY_TIMEOUT = 10
+
+DEFAULT_REGISTRY = "docker.io"
+
+# Manifest lists first, so multi-arch images get the digest every node can pull.
+MANIFEST_TYPES = ", ".join([
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+])
+
+# Splits an image into (registry, repository, tag, digest), with the defaults docker uses filled in.
+def parse_image(image):
+    name, _, digest = image.partition("@")
+    tag = "latest"
+    if name.rfind(":") > name.rfind("/"):
+        name, tag = name.rsplit(":", 1)
+
+    first, _, rest = name.partition("/")
+    if rest != "" and ("." in first or ":" in first or first == "localhost"):
+        registry, repository = first, rest
+    else:
+        registry, repository = DEFAULT_REGISTRY, name
+    if registry == DEFAULT_REGISTRY and "/" not in repository:
+        repository = "library/" + repository
+
+    return registry, repository, tag, digest or None
+
+# Pinned images are pulled when a node doesn't have them, everything else every time.
+def pull_policy(image):
+    return "IfNotPresent" if "@" in image else "Always"
+
+def registry_url(registry):
+    if registry in REGISTRY_MIRRORS:
+        return REGISTRY_MIRRORS[registry].rstrip("/")
+    if registry == DEFAULT_REGISTRY:
+        return "https://registry-1.docker.io"
+    return "https://" + registry
+
+# Gets an anonymous token for a WWW-Authenticate: Bearer challenge. Returns None when there's none to be had.
+def registry_token(challenge):
+    scheme, _, params = challenge.partition(" ")
+    if scheme.lower() != "bearer":
+        return None
+    fields = {}
+    for part in params.split(","):
+        key, _, value = part.strip().partition("=")
+        fields[key] = value.strip('"')
+    if "realm" not in fields:
+        return None
+
+    query = urllib.parse.urlencode({ key: value for key, value in fields.items() if key in [ "service", "scope" ] })
+    with urllib.request.urlopen(fields["realm"] + ("?" + query if query else ""), timeout=REGISTRY_TIMEOUT) as resp:
+        body = json.load(resp)
+    return body.get("token") or body.get("access_token")
+
+# Asks the registry for the digest of an image. Raises on anything that isn't a digest.
+def lookup_digest(image):
+    registry, repository, tag, digest = parse_image(image)
+    if digest is not None:
+        return digest
+
+    url = registry_url(registry) + "/v2/" + repository + "/manifests/" + tag
+    headers = { "Accept": MANIFEST_TYPES }
+    for attempt in range(2):
+        request = urllib.request.Request(url, headers=headers, method="HEAD")
+        try:
+            with urllib.request.urlopen(request, timeout=REGISTRY_TIMEOUT) as resp:
+                digest = resp.headers.get("Docker-Content-Digest")
+                if digest is None or not digest.startswith("sha256:"):
+                    raise ValueError("no digest in the answer of " + url)
+                return digest
+        except urllib.error.HTTPError as err:
+            if err.code != 401 or attempt > 0:
+                raise
+            token = registry_token(err.headers.get("WWW-Authenticate", ""))
+            if token is None:
+                raise
+            headers["Authorization"] = "Bearer " + token
+
+
+# Digests looked up in the last TTL, image -> (digest or None, expires). None is a look up that failed.
+class DigestCache:
+    def __init__(self, ttl=IMAGE_DIGEST_TTL, failure_ttl=FAILURE_TTL, lookup=lookup_digest):
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.lookup = lookup
+        self.digests = {}
+        self.locker = threading.Lock()
+        self.stats = { "hits": 0, "misses": 0, "failures": 0 }
+
+    # The image pinned to its digest, or the image as it is when its digest isn't known.
+    def pin(self, image):
+        if self.ttl <= 0 or "@" in image:
+            return image
+
+        now = time.monotonic()
+        with self.locker:
+            entry = self.digests.get(image)
+            if entry is not None and entry[1] > now:
+                self.stats['hits'] += 1
+                digest = entry[0]
+            else:
+                self.stats['misses'] += 1
+                entry = None
+
+        # Two pipelines may look up the same image at once, they get the same answer.
+        if entry is None:
+            try:
+                digest = self.lookup(image)
+                expires = now + self.ttl
+            except Exception as err:
+                print("Failed to look up the digest of", image, ":", err)
+                digest = None
+                expires = now + self.failure_ttl
+            with self.locker:
+                if digest is None:
+                    self.stats['failures'] += 1
+                self.digests[image] = (digest, expires)
+                for expired in [ key for key, value in self.digests.items() if value[1] <= now ]:
+                    del self.digests[expired]
+
+        if digest is None:
+            return image
+        return image + "@" + digest
+
+
+# How many builds used every image lately, for picking the images worth keeping on every node.
+class ImageCounts:
+    def __init__(self, window):
+        self.window = window
+        # (time, images of one build), oldest first.
+        self.builds = collections.deque()
+        self.locker = threading.Lock()
+
+    def record(self, images):
+        with self.locker:
+            self.builds.append((time.monotonic(), set(images)))
+
+    # The images at least minimum builds used in the window, most used first, at most count of them.
+    def frequent(self, count, minimum):
+        now = time.monotonic()
+        uses = collections.Counter()
+        with self.locker:
+            while len(self.builds) > 0 and now - self.builds[0][0] > self.window:
+                self.builds.popleft()
+            for recorded, images in self.builds:
+                uses.update(images)
+        return [ image for image, used in sorted(uses.items(), key=lambda item: (-item[1], item[0])) if used >= minimum ][:count]
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# Checks .jetci.yaml before anything runs.
+#
+# A mistake in .jetci.yaml used to show up when a pod with it was made or a command in it ran, one mistake at a
+# time and after other pipelines already took up the cluster. lint() goes over the whole file when a build is
+# planned and returns everything that's wrong with it, so a build with a broken .jetci.yaml fails in its plan
+# without making a pod, and its log says all there is to fix.
+#
+# Fields nobody knows are mistakes too, they're usually typos of fields that would have been ignored.
+import re
+import shlex
+
+# Pipeline and container names end up in pod names and label values.
+NAME_PATTERN = re.compile(r"^[a-z0-9]([-a-z0-9]*[a-z0-9])?$")
+NAME_LENGTH = 63
+
+# Containers and volumes the operator adds to every pipeline.
+RESERVED_CONTAINERS = [ "clone-git-repository" ]
+RESERVED_VOLUMES = [ "source-dir", "git-ssh-key" ]
+
+PIPELINE_FIELDS = [ "name", "containers", "needs", "volumes", "readinessTimeout", "pipelineTimeout" ]
+CONTAINER_FIELDS = [ "name", "image", "entrypoint", "commands", "env", "volumeMounts", "readinessProbe", "privileged", "needs" ]
+STEP_FIELDS = [ "run", "cache" ]
+CACHE_FIELDS = [ "inputs", "outputs" ]
+
+def is_string_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+def unknown_fields(obj, known, where):
+    prefix = where + "." if where != "" else ""
+    return [ prefix + str(key) + ": unknown field" for key in obj if key not in known ]
+
+def name_errors(name, where):
+    if not isinstance(name, str):
+        return [ where + ".name: required, has to be a string" ]
+    if len(name) > NAME_LENGTH or not NAME_PATTERN.match(name):
+        return [ where + ".name: " + repr(name) + " has to be lower case letters, numbers and dashes, at most " + str(NAME_LENGTH) + " long" ]
+    return []
+
+def command_errors(command, where):
+    if isinstance(command, str):
+        try:
+            if len(shlex.split(command)) == 0:
+                return [ where + ": empty command" ]
+        except ValueError:
+            return [ where + ": its quotes don't add up" ]
+        return []
+    if is_string_list(command):
+        return [] if len(command) > 0 else [ where + ": empty command" ]
+    return [ where + ": has to be a string or a list of strings" ]
+
+def step_errors(step, where):
+    if not isinstance(step, dict):
+        return command_errors(step, where)
+
+    errors = unknown_fields(step, STEP_FIELDS, where)
+    if "run" not in step:
+        errors.append(where + ".run: required")
+    else:
+        errors += command_errors(step["run"], where + ".run")
+
+    cache = step.get("cache", False)
+    if isinstance(cache, dict):
+        errors += unknown_fields(cache, CACHE_FIELDS, where + ".cache")
+        for field in CACHE_FIELDS:
+            if not is_string_list(cache.get(field, [])):
+                errors.append(where + ".cache." + field + ": has to be a list of paths")
+    elif cache is not None and not isinstance(cache, bool):
+        errors.append(where + ".cache: has to be true, false or have inputs and outputs")
+    return errors
+
+def env_errors(env, where):
+    if not isinstance(env, list):
+        return [ where + ": has to be a list" ]
+
+    errors = []
+    for i in range(len(env)):
+        env_var = env[i]
+        at = where + "[" + str(i) + "]"
+        if not isinstance(env_var, dict):
+            errors.append(at + ": has to have a name and a value")
+            continue
+        if not isinstance(env_var.get("name"), str) or env_var["name"] == "":
+            errors.append(at + ".name: required, has to be a string")
+        if "value" in env_var and "valueFrom" in env_var:
+            errors.append(at + ": can't have both value and valueFrom")
+        # YAML makes numbers and booleans of unquoted values, Kubernetes only takes strings.
+        if "value" in env_var and not isinstance(env_var["value"], str):
+            errors.append(at + ".value: has to be a string, quote it")
+        if "valueFrom" in env_var and not isinstance(env_var["valueFrom"], dict):
+            errors.append(at + ".valueFrom: has to be a mapping")
+    return errors
+
+def container_errors(container, where, volume_names):
+    if not isinstance(container, dict):
+        return [ where + ": has to be a mapping" ]
+
+    errors = unknown_fields(container, CONTAINER_FIELDS, where)
+    errors += name_errors(container.get("name"), where)
+    if container.get("name") in RESERVED_CONTAINERS:
+        errors.append(where + ".name: " + container["name"] + " is the name of a container jetci adds")
+
+    if not isinstance(container.get("image"), str) or container["image"].strip() == "":
+        errors.append(where + ".image: required, has to be a string")
+    if "entrypoint" in container and not (is_string_list(container["entrypoint"]) and len(container["entrypoint"]) > 0):
+        errors.append(where + ".entrypoint: has to be a list of strings")
+    if "privileged" in container and not isinstance(container["privileged"], bool):
+        errors.append(where + ".privileged: has to be true or false")
+    if "readinessProbe" in container and not isinstance(container["readinessProbe"], dict):
+        errors.append(where + ".readinessProbe: has to be a mapping, see the pod spec")
+    if "needs" in container and not is_string_list(container["needs"]):
+        errors.append(where + ".needs: has to be a list of container names")
+    if "env" in container:
+        errors += env_errors(container["env"], where + ".env")
+
+    commands = container.get("commands", [])
+    if not isinstance(commands, list):
+        errors.append(where + ".commands: has to be a list")
+    else:
+        for i in range(len(commands)):
+            errors += step_errors(commands[i], where + ".commands[" + str(i) + "]")
+
+    volume_mounts = container.get("volumeMounts", [])
+    if not isinstance(volume_mounts, list):
+        errors.append(where + ".volumeMounts: has to be a list")
+    else:
+        for i in range(len(volume_mounts)):
+            at = where + ".volumeMounts[" + str(i) + "]"
+            volume_mount = volume_mounts[i]
+            if not isinstance(volume_mount, dict) or not isinstance(volume_mount.get("mountPath"), str):
+                errors.append(at + ": has to have a name and a mountPath")
+            elif volume_mount.get("name") not in volume_names:
+                errors.append(at + ".name: no volume " + repr(volume_mount.get("name")) + " in the pipeline")
+    return errors
+
+def pipeline_errors(pipeline, where, reserved_volumes):
+    if not isinstance(pipeline, dict):
+        return [ where + ": has to be a mapping" ]
+
+    errors = unknown_fields(pipeline, PIPELINE_FIELDS, where)
+    errors += name_errors(pipeline.get("name"), where)
+
+    for field in [ "readinessTimeout", "pipelineTimeout" ]:
+        timeout = pipeline.get(field)
+        if timeout is not None and (type(timeout) != int or timeout <= 0):
+            errors.append(where + "." + field + ": has to be a number of seconds")
+    if "needs" in pipeline and not is_string_list(pipeline["needs"]):
+        errors.append(where + ".needs: has to be a list of pipeline names")
+
+    # Volumes are passed on to the pod as they are, only their names are checked. /usr/src can be mounted elsewhere too.
+    volume_names = [ "source-dir" ]
+    volumes = pipeline.get("volumes", [])
+    if not isinstance(volumes, list):
+        errors.append(where + ".volumes: has to be a list")
+        volumes = []
+    for i in range(len(volumes)):
+        name = volumes[i].get("name") if isinstance(volumes[i], dict) else None
+        if not isinstance(name, str):
+            errors.append(where + ".volumes[" + str(i) + "].name: required, has to be a string")
+        elif name in reserved_volumes:
+            errors.append(where + ".volumes[" + str(i) + "].name: " + name + " is the name of a volume jetci adds")
+        elif name in volume_names:
+            errors.append(where + ".volumes[" + str(i) + "].name: duplicate volume " + name)
+        else:
+            volume_names.append(name)
+
+    containers = pipeline.get("containers")
+    if not isinstance(containers, list) or len(containers) == 0:
+        errors.append(where + ".containers: required, has to be a list with at least one container")
+    else:
+        for i in range(len(containers)):
+            errors += container_errors(containers[i], where + ".containers[" + str(i) + "]", volume_names)
+    return errors
+
+# Returns what's wrong with a loaded .jetci.yaml, an empty list when nothing is.
+# reserved_volumes are the names of volumes the operator adds, on top of RESERVED_VOLUMES.
+def lint(jetci_obj, reserved_volumes=[]):
+    if not isinstance(jetci_obj, dict):
+        return [ ".jetci.yaml has to be a mapping with pipelines in it" ]
+
+    errors = unknown_fields(jetci_obj, [ "pipelines" ], "")
+    pipelines = jetci_obj.get("pipelines")
+    if not isinstance(pipelines, list):
+        return errors + [ "pipelines: required, has to be a list" ]
+
+    for i in range(len(pipelines)):
+        errors += pipeline_errors(pipelines[i], "pipelines[" + str(i) + "]", RESERVED_VOLUMES + reserved_volumes)
+    return errors
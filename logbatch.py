@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Batching of container logs for the operator.
+#
+# Every build log entry is a write to the log store and a PATCH of the Build, so a container that prints a line
+# at a time would cost a write per line. The lines a container logs are collected in a LogBatch instead, and
+# written as one entry once there are JETCI_LOG_BATCH_BYTES of them, once the oldest of them waited
+# JETCI_LOG_BATCH_SECONDS, or when the container's log ends. A container gets at most one write per window no
+# matter how much it prints, unless it prints more than a batch holds.
+#
+# An entry from a batch has all of its lines in output, one per line, and the time the container wrote each of
+# them in timestamps, in the same order:
+#
+#   { "command": "-", "status": "-", "output": "first\nsecond", "timestamps": [ "2021-...Z", "2021-...Z" ], ... }
+#
+# The output of exec'd commands comes in chunks instead of lines. It goes through a LogBatch too, with the chunks
+# put together as they are, so a command's output costs the same few writes however many chunks it comes in.
+#
+# Settings:
+#   JETCI_LOG_BATCH_BYTES   - bytes of lines that make a batch get written right away.
+#   JETCI_LOG_BATCH_SECONDS - seconds a line waits for more at most, 0 writes every line on its own.
+import os
+import time
+import threading
+
+LOG_BATCH_BYTES   = int(os.environ.get("JETCI_LOG_BATCH_BYTES", str(64 * 1024)))
+LOG_BATCH_SECONDS = float(os.environ.get("JETCI_LOG_BATCH_SECONDS", "1"))
+
+# How often the flusher looks for batches that waited long enough.
+FLUSH_INTERVAL = 0.25
+
+# Splits a line of a log read with timestamps into (timestamp, text). The timestamp is None when it has none.
+def split_timestamp(line):
+    line = line.rstrip("\n")
+    timestamp, _, text = line.partition(" ")
+    if len(timestamp) < 20 or timestamp[4] != "-" or timestamp[10] != "T":
+        return None, line
+    return timestamp, text
+
+
+# The lines of one container that haven't been written yet.
+class LogBatch:
+    # write is called with (output, timestamps) for every batch, one at a time and in order.
+    # separator goes between lines in output, chunks of exec output have their own newlines and use "".
+    def __init__(self, write, max_bytes=LOG_BATCH_BYTES, window=LOG_BATCH_SECONDS, separator="\n"):
+        self.write = write
+        self.max_bytes = max_bytes
+        self.window = window
+        self.separator = separator
+        self.lines = []
+        self.timestamps = []
+        self.bytes = 0
+        # When the oldest line came in, time.monotonic().
+        self.started = None
+        # locker guards the lines and is never held while writing, write_locker keeps the writes in order.
+        self.locker = threading.Lock()
+        self.write_locker = threading.Lock()
+
+    # Adds a line. Returns True when the batch is full, the caller flushes it then.
+    def add(self, timestamp, text):
+        with self.locker:
+            if self.started is None:
+                self.started = time.monotonic()
+            self.lines.append(text)
+            self.timestamps.append(timestamp)
+            self.bytes += len(text) + len(self.separator)
+            return self.bytes >= self.max_bytes or self.window <= 0
+
+    def due(self, now):
+        with self.locker:
+            return self.started is not None and now - self.started >= self.window
+
+    # Writes whatever is in the batch.
+    def flush(self):
+        with self.write_locker:
+            with self.locker:
+                if len(self.lines) == 0:
+                    return
+                lines, timestamps = self.lines, self.timestamps
+                self.lines, self.timestamps, self.bytes, self.started = [], [], 0, None
+            self.write(self.separator.join(lines), timestamps)
+
+
+# The batches of the containers being logged, for the flusher.
+class LogBatches:
+    def __init__(self):
+        self.batches = set()
+        self.locker = threading.Lock()
+
+    def add(self, batch):
+        with self.locker:
+            self.batches.add(batch)
+
+    # Writes what's left of a batch and forgets it.
+    def close(self, batch):
+        with self.locker:
+            self.batches.discard(batch)
+        batch.flush()
+
+    def due(self):
+        now = time.monotonic()
+        with self.locker:
+            batches = list(self.batches)
+        return [ batch for batch in batches if batch.due(now) ]
+
+    # Lines waiting to be written.
+    def pending(self):
+        with self.locker:
+            batches = list(self.batches)
+        pending = 0
+        for batch in batches:
+            with batch.locker:
+                pending += len(batch.lines)
+        return pending
+
+    # Flushes batches that waited long enough, forever.
+    def flusher(self, interval=FLUSH_INTERVAL):
+        while True:
+            for batch in self.due():
+                try:
+                    batch.flush()
+                except Exception as err:
+                    print("LogBatches.flusher(): Failed to write log batch:", err)
+            time.sleep(interval)
+
+    # Runs the flusher in a thread of its own.
+    def start(self):
+        threading.Thread(target=self.flusher, daemon=True).start()
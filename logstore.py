@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# Build log storage for the operator.
+#
+# Build logs used to be appended to the `logs` array of the Build object. That makes every write re-send the
+# whole log history and big builds run into the etcd object size limit. The stores in here keep the log
+# somewhere else, the build only gets a small summary (see `write_build_log()` in operator.py).
+#
+# The store is picked with JETCI_LOG_BACKEND:
+#   "volume" - (default) append-only compressed segments on a local volume, see VolumeLogStore.
+#   "cr"     - the old behavior, log entries are appended to the Build object.
+#
+# Running this file prints the log of a build, so logs can be read from inside the operator pod:
+#   python3 logstore.py {namespace} {build name} [offset] [length]
+import os
+import sys
+import json
+import zlib
+import time
+import shutil
+import threading
+import contextlib
+
+LOG_BACKEND        = os.environ.get("JETCI_LOG_BACKEND", "volume")
+LOG_DIR            = os.environ.get("JETCI_LOG_DIR", "/var/lib/jetci/logs")
+LOG_SEGMENT_BYTES  = int(os.environ.get("JETCI_LOG_SEGMENT_BYTES", str(1024 * 1024)))
+
+# Seconds what the store knows about a build is kept after it finished, for late log entries, and after its last
+# entry for builds that never said they finished. It's read back from the index when it's needed again.
+LOG_STATE_LINGER   = 300
+LOG_STATE_IDLE     = 3600
+
+
+# Logs are written to a directory per build:
+#   {root}/{namespace}/{build name}/segment-{n}  - compressed log entries, each one is its own zlib stream
+#   {root}/{namespace}/{build name}/index        - one line per entry: "{offset} {segment} {position} {compressed length} {length}"
+#
+# The offset is where the entry starts in the uncompressed log, which is every entry as a line of JSON.
+# Appending only writes the new entry and one index line, so a write costs O(new bytes) no matter how long
+# the log already is. Reads use the index to decompress only the entries that overlap the requested range.
+class VolumeLogStore:
+    def __init__(self, root=LOG_DIR, segment_bytes=LOG_SEGMENT_BYTES, linger=LOG_STATE_LINGER, idle=LOG_STATE_IDLE):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.linger = linger
+        self.idle = idle
+
+        # What the store knows about a build: (namespace, build_name) -> { "locker", "users", "used", "finished" }.
+        # Every build has its own lock, so builds don't wait for each other's writes. users counts the threads holding
+        # or waiting for it, a build is only forgotten when there are none. self.locker guards builds.
+        self.locker = threading.Lock()
+        self.builds = {}
+
+        # Where the next entry of a build goes: (namespace, build_name) -> [offset, segment, position]
+        # Only touched while holding the build's lock.
+        self.tails = {}
+
+    @contextlib.contextmanager
+    def build_locker(self, key):
+        with self.locker:
+            build = self.builds.get(key)
+            if build is None:
+                build = self.builds[key] = { "locker": threading.Lock(), "users": 0, "used": 0, "finished": None }
+            build["users"] += 1
+        try:
+            with build["locker"]:
+                yield
+        finally:
+            with self.locker:
+                build["users"] -= 1
+                build["used"] = time.monotonic()
+                self.prune()
+
+    # Forgets what we know about builds that finished a while ago or haven't been written to in a long time, like
+    # LogBuffers.prune() in logstream.py. Caller must hold self.locker.
+    def prune(self):
+        now = time.monotonic()
+        for key, build in list(self.builds.items()):
+            if build["users"] > 0:
+                continue
+            if (build["finished"] is not None and now - build["finished"] > self.linger) or now - build["used"] > self.idle:
+                del self.builds[key]
+                self.tails.pop(key, None)
+
+    # The build won't get more than the odd late entry.
+    def finish(self, namespace, build_name):
+        with self.locker:
+            build = self.builds.get((namespace, build_name))
+            if build is not None:
+                build["finished"] = time.monotonic()
+            self.prune()
+
+    def build_dir(self, namespace, build_name):
+        return os.path.join(self.root, namespace, build_name)
+
+    # Figures out where the next entry goes from the last line of the index.
+    def load_tail(self, namespace, build_name):
+        tail = [0, 0, 0]
+        index_path = os.path.join(self.build_dir(namespace, build_name), "index")
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as index_file:
+                for line in index_file:
+                    offset, segment, position, compressed_length, length = [ int(n) for n in line.split() ]
+                    tail = [offset + length, segment, position + compressed_length]
+        return tail
+
+    # Appends an entry and returns the size of the uncompressed log after it.
+    def append(self, namespace, build_name, entry):
+        data = (json.dumps(entry) + "\n").encode("utf-8")
+        compressed = zlib.compress(data)
+
+        key = (namespace, build_name)
+        with self.build_locker(key):
+            if key not in self.tails:
+                os.makedirs(self.build_dir(namespace, build_name), exist_ok=True)
+                self.tails[key] = self.load_tail(namespace, build_name)
+            offset, segment, position = self.tails[key]
+
+            # Start a new segment once the current one is big enough.
+            if position > 0 and position + len(compressed) > self.segment_bytes:
+                segment += 1
+                position = 0
+
+            with open(os.path.join(self.build_dir(namespace, build_name), "segment-" + str(segment)), "ab") as segment_file:
+                segment_file.write(compressed)
+
+            # The index is written last, a crash in between leaves an entry that is never read instead of a broken index.
+            with open(os.path.join(self.build_dir(namespace, build_name), "index"), "a") as index_file:
+                index_file.write("%d %d %d %d %d\n" % (offset, segment, position, len(compressed), len(data)))
+
+            self.tails[key] = [offset + len(data), segment, position + len(compressed)]
+            return offset + len(data)
+
+    # Generator over the uncompressed log from offset, up to length bytes. Yields bytes.
+    def read(self, namespace, build_name, offset=0, length=None):
+        index_path = os.path.join(self.build_dir(namespace, build_name), "index")
+        if not os.path.exists(index_path):
+            return
+
+        end = None if length is None else offset + length
+        segment_file = None
+        segment_open = None
+
+        try:
+            with open(index_path, "rb") as index_file:
+                for line in index_file:
+                    entry_offset, segment, position, compressed_length, entry_length = [ int(n) for n in line.split() ]
+
+                    # Skip entries before the range and stop after it.
+                    if entry_offset + entry_length <= offset:
+                        continue
+                    if end is not None and entry_offset >= end:
+                        break
+
+                    if segment_open != segment:
+                        if segment_file is not None:
+                            segment_file.close()
+                        segment_file = open(os.path.join(self.build_dir(namespace, build_name), "segment-" + str(segment)), "rb")
+                        segment_open = segment
+
+                    segment_file.seek(position)
+                    data = zlib.decompress(segment_file.read(compressed_length))
+
+                    start = max(offset - entry_offset, 0)
+                    stop = entry_length if end is None else min(end - entry_offset, entry_length)
+                    yield data[start:stop]
+        finally:
+            if segment_file is not None:
+                segment_file.close()
+
+    def delete(self, namespace, build_name):
+        key = (namespace, build_name)
+        with self.build_locker(key):
+            self.tails.pop(key, None)
+            shutil.rmtree(self.build_dir(namespace, build_name), ignore_errors=True)
+            with self.locker:
+                self.builds[key]["finished"] = 0
+
+
+def get_log_store():
+    if LOG_BACKEND == "volume":
+        return VolumeLogStore()
+    if LOG_BACKEND == "cr":
+        return None
+    raise ValueError("JETCI_LOG_BACKEND not implemented: " + LOG_BACKEND)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("usage:", sys.argv[0], "{namespace} {build name} [offset] [length]")
+        sys.exit(1)
+
+    offset = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    length = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    for chunk in VolumeLogStore().read(sys.argv[1], sys.argv[2], offset, length):
+        sys.stdout.buffer.write(chunk)
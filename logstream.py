@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# Live build logs for the operator.
+#
+# Every build log entry the operator writes also goes into a bounded in-memory buffer for its build. Viewers
+# follow a build over HTTP, all of them are woken by one notify when an entry comes in, so a build with many
+# viewers costs no more API calls than a build with none:
+#
+#   GET /builds/{namespace}/{build name}/logs[?offset=N]
+#
+# The log is the same as the one in logstore.py, every entry as a line of JSON, and offsets are byte offsets
+# into it. With "Accept: text/event-stream" entries are sent as server-sent events whose id is the offset after
+# them, so an EventSource resumes with Last-Event-ID by itself. Otherwise the log is sent as chunked JSON lines
+# and a client resumes with ?offset= set to the bytes it already has. Parts that have fallen out of the buffer
+# are read from the log store when there is one. The stream ends once the build is finished.
+#
+# Only the replica running a build has its live log, the build's claimedBy says which one that is.
+#
+# Logs have whatever commands print in them, secrets included. Without JETCI_LOG_STREAM_TOKEN the logs are only
+# served on localhost, for kubectl port-forward. With it they are served on every address, and viewers have to
+# send the token as "Authorization: Bearer {token}" or, since an EventSource can't set headers, as ?token=.
+#
+# Settings:
+#   JETCI_LOG_STREAM_PORT  - port the logs are served on, 0 turns it off.
+#   JETCI_LOG_STREAM_TOKEN - token viewers need, the logs are served on every address once it's set.
+#   JETCI_LOG_BUFFER_BYTES - how much of the log of a build is kept in memory.
+#   JETCI_LOG_BUFFER_LINGER - seconds the buffer of a finished build is kept around for late viewers.
+import os
+import hmac
+import json
+import time
+import threading
+import collections
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOG_STREAM_PORT   = int(os.environ.get("JETCI_LOG_STREAM_PORT", "8080"))
+LOG_STREAM_TOKEN  = os.environ.get("JETCI_LOG_STREAM_TOKEN", "")
+LOG_BUFFER_BYTES  = int(os.environ.get("JETCI_LOG_BUFFER_BYTES", str(1024 * 1024)))
+LOG_BUFFER_LINGER = float(os.environ.get("JETCI_LOG_BUFFER_LINGER", "300"))
+
+# How often an idle stream sends something, so viewers that went away are noticed.
+KEEPALIVE_SECONDS = 15
+
+
+# The recent log of one build. Guarded by the condition of LogBuffers.
+class LogBuffer:
+    def __init__(self):
+        # (offset, line) pairs, oldest first. offset is where the line starts in the log.
+        self.lines = collections.deque()
+        self.bytes = 0
+        self.start = 0
+        self.end = 0
+        self.finished = None
+
+    def append(self, line, end_offset, max_bytes):
+        # A buffer made after a restart starts where the log store is at.
+        if len(self.lines) == 0:
+            self.start = end_offset - len(line)
+        self.lines.append((end_offset - len(line), line))
+        self.bytes += len(line)
+        self.end = end_offset
+
+        # The newest line stays even when it's bigger than the whole buffer.
+        while self.bytes > max_bytes and len(self.lines) > 1:
+            offset, dropped = self.lines.popleft()
+            self.bytes -= len(dropped)
+            self.start = self.lines[0][0]
+
+    # The lines at or after offset, with the part before offset cut off the first one.
+    def since(self, offset):
+        lines = []
+        for line_offset, line in self.lines:
+            if line_offset + len(line) <= offset:
+                continue
+            lines.append((line_offset + len(line), line[max(offset - line_offset, 0):]))
+        return lines
+
+
+class LogBuffers:
+    def __init__(self, max_bytes=LOG_BUFFER_BYTES, linger=LOG_BUFFER_LINGER):
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.buffers = {}
+        self.condition = threading.Condition()
+
+    # Adds an entry. end_offset is the size of the log after it, when the log store knows it.
+    def append(self, namespace, build_name, entry, end_offset=None):
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+        with self.condition:
+            key = (namespace, build_name)
+            if key not in self.buffers:
+                self.prune()
+                self.buffers[key] = LogBuffer()
+            log_buffer = self.buffers[key]
+            if end_offset is None:
+                end_offset = log_buffer.end + len(line)
+            log_buffer.append(line, end_offset, self.max_bytes)
+            self.condition.notify_all()
+
+    # Makes the buffer of a build that's starting, so viewers can connect before it logs anything.
+    def open(self, namespace, build_name):
+        with self.condition:
+            if (namespace, build_name) not in self.buffers:
+                self.prune()
+                self.buffers[(namespace, build_name)] = LogBuffer()
+
+    # Ends the streams of a build. Its buffer sticks around for a while for late viewers.
+    def finish(self, namespace, build_name):
+        with self.condition:
+            log_buffer = self.buffers.setdefault((namespace, build_name), LogBuffer())
+            log_buffer.finished = time.monotonic()
+            self.condition.notify_all()
+
+    def drop(self, namespace, build_name):
+        with self.condition:
+            self.buffers.pop((namespace, build_name), None)
+            self.condition.notify_all()
+
+    # Caller must hold the condition.
+    def prune(self):
+        now = time.monotonic()
+        for key in [ key for key, log_buffer in self.buffers.items() if log_buffer.finished is not None and now - log_buffer.finished > self.linger ]:
+            del self.buffers[key]
+
+    def known(self, namespace, build_name):
+        with self.condition:
+            return (namespace, build_name) in self.buffers
+
+    # Blocks until there is log after offset, the build finished or timeout passes.
+    # Returns (buffer start, [ (end offset, bytes) ], finished). Finished is also True when the buffer is gone.
+    def wait(self, namespace, build_name, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                log_buffer = self.buffers.get((namespace, build_name))
+                if log_buffer is None:
+                    return offset, [], True
+                lines = log_buffer.since(offset)
+                if len(lines) > 0 or log_buffer.finished is not None or time.monotonic() >= deadline:
+                    return log_buffer.start, lines, log_buffer.finished is not None and len(lines) == 0
+                self.condition.wait(deadline - time.monotonic())
+
+    def stats(self):
+        with self.condition:
+            return len(self.buffers), sum(log_buffer.bytes for log_buffer in self.buffers.values())
+
+
+# Splits a part of the log that starts at offset into (end offset, bytes) pairs, one per line.
+def split_lines(data, offset):
+    lines = []
+    start = 0
+    while start < len(data):
+        end = data.find(b"\n", start)
+        end = len(data) if end < 0 else end + 1
+        lines.append((offset + end, data[start:end]))
+        start = end
+    return lines
+
+
+class LogStreamHandler(BaseHTTPRequestHandler):
+    # Chunked responses need HTTP/1.1.
+    protocol_version = "HTTP/1.1"
+
+    # Set by start_server().
+    log_buffers = None
+    log_store = None
+    token = ""
+
+    def authorized(self, query):
+        if self.token == "":
+            return True
+        header = self.headers.get("Authorization", "")
+        given = header[len("Bearer "):] if header.startswith("Bearer ") else query.get("token", [ "" ])[0]
+        return hmac.compare_digest(self.token.encode("utf-8"), given.encode("utf-8"))
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) != 4 or parts[0] != "builds" or parts[3] != "logs":
+            self.send_error(404)
+            return
+        namespace, build_name = urllib.parse.unquote(parts[1]), urllib.parse.unquote(parts[2])
+
+        query = urllib.parse.parse_qs(url.query)
+        if not self.authorized(query):
+            self.send_error(401, "A valid token is needed")
+            return
+
+        try:
+            offset = int(query.get("offset", [ self.headers.get("Last-Event-ID", "0") ])[0])
+        except ValueError:
+            self.send_error(400, "offset has to be a number")
+            return
+
+        if not self.log_buffers.known(namespace, build_name):
+            self.send_error(404, "This replica isn't running that build")
+            return
+
+        events = "text/event-stream" in self.headers.get("Accept", "")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream" if events else "application/x-ndjson")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        try:
+            self.stream(namespace, build_name, offset, events)
+
+            # The empty chunk ends the response.
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+    def stream(self, namespace, build_name, offset, events):
+        while True:
+            start, lines, finished = self.log_buffers.wait(namespace, build_name, offset, KEEPALIVE_SECONDS)
+
+            # Whatever fell out of the buffer comes from the log store, a line at a time so every entry gets its own event.
+            if offset < start and self.log_store is not None:
+                gap = b"".join(self.log_store.read(namespace, build_name, offset, start - offset))
+                if len(gap) > 0:
+                    self.send_lines(split_lines(gap, offset), events)
+                offset = start
+                continue
+
+            if finished:
+                if events:
+                    self.write_chunk(b"event: end\ndata: {}\n\n")
+                return
+
+            # Comments are the only thing that can be sent without changing the log, JSON lines get nothing.
+            if len(lines) == 0:
+                if events:
+                    self.write_chunk(b": keepalive\n\n")
+                continue
+
+            self.send_lines(lines, events)
+            offset = lines[-1][0]
+
+    # lines are (end offset, bytes) pairs. Entries are JSON without newlines, so each line is one event.
+    def send_lines(self, lines, events):
+        if not events:
+            self.write_chunk(b"".join(line for end, line in lines))
+            return
+
+        data = b""
+        for end, line in lines:
+            data += b"id: " + str(end).encode("ascii") + b"\ndata: " + line.rstrip(b"\n") + b"\n\n"
+        self.write_chunk(data)
+
+    def write_chunk(self, data):
+        self.wfile.write(("%x\r\n" % len(data)).encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    # Viewers would flood the log otherwise.
+    def log_message(self, format, *args):
+        return
+
+# Serves the logs from a thread of its own. Only on localhost when there's no token.
+def start_server(log_buffers, log_store, port=LOG_STREAM_PORT, token=LOG_STREAM_TOKEN):
+    if port <= 0:
+        return None
+
+    handler = type("BoundLogStreamHandler", (LogStreamHandler,), { "log_buffers": log_buffers, "log_store": log_store, "token": token })
+    server = ThreadingHTTPServer(("0.0.0.0" if token != "" else "127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Prometheus metrics for the operator and the webhook endpoint.
+#
+# Metrics are kept in plain Python objects and only turned into the Prometheus text format when scraped, so
+# recording a value is a lock and a few additions. Gauges are read through a function at scrape time instead
+# of being updated on the hot paths.
+#
+# Settings:
+#   JETCI_METRICS_PORT - port the metrics are served on at /metrics, 0 turns it off.
+import os
+import bisect
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.environ.get("JETCI_METRICS_PORT", "9090"))
+
+# Upper bounds of the histogram buckets, in seconds. Covers a fast API call up to a long build.
+DEFAULT_BUCKETS = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600 ]
+
+# Everything that gets rendered on a scrape, in the order it was made.
+registry = []
+registry_locker = threading.Lock()
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ""
+    pairs = [ name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in zip(names, values) ]
+    return "{" + ",".join(pairs) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Histogram with optional labels. observe() takes the label values after the value.
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = list(labels)
+        self.buckets = list(buckets)
+        self.locker = threading.Lock()
+
+        # label values -> [ bucket counts (not cumulative), count, sum ]
+        self.series = {}
+
+        register(self)
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.locker:
+            if label_values not in self.series:
+                self.series[label_values] = [ [0] * len(self.buckets), 0, 0.0 ]
+            series = self.series[label_values]
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        with self.locker:
+            series = { label_values: (list(itertools.accumulate(counts)), count, total) for label_values, (counts, count, total) in self.series.items() }
+        return histogram_lines(self.name, self.documentation, self.labels, self.buckets, series)
+
+# Text format of a histogram. series is label values -> (cumulative bucket counts, count, sum).
+def histogram_lines(name, documentation, labels, buckets, series):
+    lines = [ "# HELP " + name + " " + documentation, "# TYPE " + name + " histogram" ]
+    for label_values, (cumulative, count, total) in sorted(series.items()):
+        for bound, bucket_count in zip(buckets, cumulative):
+            lines.append(name + "_bucket" + format_labels(labels + [ "le" ], list(label_values) + [ format_value(float(bound)) ]) + " " + str(bucket_count))
+        lines.append(name + "_bucket" + format_labels(labels + [ "le" ], list(label_values) + [ "+Inf" ]) + " " + str(count))
+        lines.append(name + "_sum" + format_labels(labels, label_values) + " " + format_value(total))
+        lines.append(name + "_count" + format_labels(labels, label_values) + " " + str(count))
+    return lines
+
+
+# Gauge or counter read from a function at scrape time. The function returns a number, or a dict of
+# label values tuple -> number when the metric has labels.
+class Callback:
+    def __init__(self, name, documentation, function, labels=(), metric_type="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labels = list(labels)
+        self.metric_type = metric_type
+
+        register(self)
+
+    def render(self):
+        lines = [ "# HELP " + self.name + " " + self.documentation, "# TYPE " + self.name + " " + self.metric_type ]
+        value = self.function()
+        if isinstance(value, dict):
+            for label_values, number in sorted(value.items()):
+                lines.append(self.name + format_labels(self.labels, label_values) + " " + format_value(number))
+        else:
+            lines.append(self.name + " " + format_value(value))
+        return lines
+
+
+# Histogram kept somewhere else, like the API call stats in shared.py. The function returns what histogram_lines() takes as series.
+class HistogramCallback:
+    def __init__(self, name, documentation, function, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labels = list(labels)
+        self.buckets = list(buckets)
+
+        register(self)
+
+    def render(self):
+        return histogram_lines(self.name, self.documentation, self.labels, self.buckets, self.function())
+
+
+# Anything with a render() method that returns lines of the text format.
+def register(metric):
+    with registry_locker:
+        registry.append(metric)
+
+def render():
+    with registry_locker:
+        metrics = list(registry)
+
+    lines = []
+    for metric in metrics:
+        try:
+            lines.extend(metric.render())
+        except Exception as err:
+            # One broken metric shouldn't take the others down with it.
+            print("Failed to render metric:", getattr(metric, 'name', metric), ":", err)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes would flood the log otherwise.
+    def log_message(self, format, *args):
+        return
+
+# Serves /metrics from a thread of its own.
+def start_server(port=METRICS_PORT):
+    if port <= 0:
+        return None
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,51 +1,517 @@
 #!/usr/bin/env python3
-from kubernetes import client, config, watch
-from kubernetes.stream import stream
-from kubernetes.stream.ws_client import ERROR_CHANNEL
+from kubernetes import client, watch
+from kubernetes.stream.ws_client import ERROR_CHANNEL, STDIN_CHANNEL, STDOUT_CHANNEL, STDERR_CHANNEL
 import secrets
+import shlex
 import socket
 import time
 import json
+import os
+import collections
+import copy
+import bisect
+import itertools
+import hashlib
+import datetime
+import base64
+import tempfile
+import shutil
+import subprocess
 import threading
+import concurrent.futures
 import yaml
+import agent
+import images
+import lint
+import logbatch
+import logstore
+import logstream
+import metrics
+import stepcache
+import warmpool
+from shared import API_GROUP, API_VERSION, API_POOL_SIZE, api_client, exec_stream, get_repo
+import asyncio
+
+# The asyncio engine needs kubernetes_asyncio, the threaded engine doesn't.
+try:
+    from kubernetes_asyncio import client as async_client, config as async_config, watch as async_watch
+    from kubernetes_asyncio.stream import WsApiClient
+except ImportError:
+    async_client = None
 
-# API Information for custom resources
-API_VERSION = "v1alpha1"
-API_GROUP   = "future.jetci.xyz"
+# Where build logs go, None means they are kept in the Build object. See logstore.py.
+log_store = logstore.get_log_store()
 
-try:
-    config.load_kube_config()
-except:
-    # load_kube_config throws if there is no config, but does not document what it throws, so I can't rely on any particular type here
-    config.load_incluster_config()
+# The recent log of every build we run, for viewers following it live. See logstream.py.
+log_buffers = logstream.LogBuffers()
+log_batches = logbatch.LogBatches()
+
+# Where build time goes. Served with the gauges at the bottom of this file, see metrics.py.
+CLAIM_SECONDS            = metrics.Histogram("jetci_build_claim_seconds", "Time from a build being created to it being claimed.")
+JETCI_YAML_FETCH_SECONDS = metrics.Histogram("jetci_jetci_yaml_fetch_seconds", "Time fetching .jetci.yaml took on a cache miss.", labels=("mode",))
+POD_READY_SECONDS        = metrics.Histogram("jetci_pod_ready_seconds", "Time from creating a pipeline pod to all its containers being ready.")
+POD_CLAIM_SECONDS        = metrics.Histogram("jetci_pod_claim_seconds", "Time from a pipeline starting to its pod being ready.", labels=("source",))
+EXEC_SECONDS             = metrics.Histogram("jetci_exec_seconds", "Time a pipeline command took.", labels=("status",))
+BUILD_LOG_SECONDS        = metrics.Histogram("jetci_build_log_seconds", "Time writing a build log entry took.")
+BUILD_LOCK_WAIT_SECONDS  = metrics.Histogram("jetci_build_log_lock_wait_seconds", "Time build log writes waited for the build's lock.")
+BUILD_SECONDS            = metrics.Histogram("jetci_build_seconds", "Time from a build being created to it finishing.", labels=("status",))
+
+# Builds we claimed and haven't finished, (namespace, build_name) -> when the build was created, as a time.time().
+active_builds = {}
+
+# Builds that have reached one of these statuses no longer get written to by pipeline threads.
+FINISHED_BUILD_STATUSES = [ "Complete", "Failed", "Cancelled" ]
+
+# How many times a build patch is retried when the build changed underneath us.
+BUILD_PATCH_RETRIES = 5
 
-# TODO: Update this to an array of locks. I'm doing things this way because it should result in less mistakes in prototyping.
 # Something to help prevent pipeline threads from modifying the same build at the same time.
-run_locker = threading.Lock()
+# Each build gets its own lock so that unrelated builds don't queue up behind each other.
+# Builds are only in the registry from their claim until they finish, see open_build_lock().
+# build_locks_locker only guards the registry itself, it is never held while talking to the API.
+build_locks = {}
+build_locks_locker = threading.Lock()
+
+# Last resourceVersion seen for a build, keyed the same way as build_locks.
+# Only read while holding that build's lock, and only kept for builds in the registry.
+build_versions = {}
+
+# Keeps the log entries of a build in the same order in the log store and the live log buffer, keyed the same way
+# as build_locks too. Separate from the build's lock, so log writes don't wait for build patches.
+log_append_locks = {}
+
+# Puts a build we're claiming in the registry.
+def open_build_lock(namespace, build_name):
+    with build_locks_locker:
+        if (namespace, build_name) not in build_locks:
+            build_locks[(namespace, build_name)] = threading.Lock()
+            log_append_locks[(namespace, build_name)] = threading.Lock()
+
+# Builds that aren't in the registry, like ones that finished and still get a last log entry, get a lock of their
+# own. They don't need to wait for anyone anymore, and they'd never leave the registry again.
+def get_build_lock(namespace, build_name):
+    with build_locks_locker:
+        return build_locks.get((namespace, build_name)) or threading.Lock()
+
+def get_log_append_lock(namespace, build_name):
+    with build_locks_locker:
+        return log_append_locks.get((namespace, build_name)) or threading.Lock()
+
+def set_build_version(namespace, build_name, resource_version):
+    with build_locks_locker:
+        if (namespace, build_name) in build_locks:
+            build_versions[(namespace, build_name)] = resource_version
+
+# Evict the lock for a build that is finished or deleted.
+# A pipeline thread that is still holding the old lock keeps working with it, a new caller just gets a fresh lock.
+def release_build_lock(namespace, build_name):
+    with build_locks_locker:
+        build_locks.pop((namespace, build_name), None)
+        build_versions.pop((namespace, build_name), None)
+        log_append_locks.pop((namespace, build_name), None)
+
+# Sends a JSON patch (RFC 6902) with only the changed fields of a build. No GET is needed in the common case.
+# Status changes use the resourceVersion from our last write as a precondition with a "test" operation, when we
+# know it. When someone else changed the build in the meantime the test fails, we refresh the version and try again.
+# Everything else, like log entries and pods being added, goes through whatever else changed, the build's lock
+# already keeps our own writes in order.
+# The caller must hold the build's lock.
+def patch_build(namespace, build_name, operations):
+    status_change = any(operation['path'] == "/status" for operation in operations)
+    for attempt in range(BUILD_PATCH_RETRIES):
+        body = list(operations)
+        resource_version = build_versions.get((namespace, build_name))
+        if resource_version is not None and status_change:
+            body.insert(0, { "op": "test", "path": "/metadata/resourceVersion", "value": resource_version })
 
-def container_logging(namespace, build_name, pipeline_name, pod_name, container_name):
-    for log_entry in watch.Watch().stream(client.CoreV1Api().read_namespaced_pod_log, pod_name, namespace, container=container_name, follow=True, _preload_content=False):
-        build_log(namespace, build_name, pipeline_name, container_name, "-", log_entry, "-")
-    
+        try:
+            build_obj = client.CustomObjectsApi(api_client).patch_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name, body, _content_type="application/json-patch+json")
+        except client.exceptions.ApiException as err:
+            # 409 is a plain conflict, 422 is what the API server answers when the "test" operation fails.
+            if err.status not in [409, 422] or attempt == BUILD_PATCH_RETRIES - 1:
+                raise
+
+            # Pick up the current resourceVersion and retry.
+            build_obj = client.CustomObjectsApi(api_client).get_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name)
+            set_build_version(namespace, build_name, build_obj['metadata']['resourceVersion'])
+
+            # A cancelled build stays cancelled, whoever cancelled it.
+            if build_obj.get('status') == "Cancelled" and status_change:
+                return build_obj
+            continue
+
+        set_build_version(namespace, build_name, build_obj['metadata']['resourceVersion'])
+        return build_obj
+
+# Labels put on every pod the operator creates.
+# The pod informer selects on MANAGED_BY_LABEL and indexes pods by BUILD_LABEL, pods without a build have a REPOSITORY_LABEL.
+# Pods of the warm pool have a POOL_LABEL, and a POOL_OWNER_LABEL saying which replica's pool they are in.
+MANAGED_BY_LABEL = "app.kubernetes.io/managed-by"
+MANAGED_BY_VALUE = "jetci-operator"
+BUILD_LABEL      = "future.jetci.xyz/build"
+PIPELINE_LABEL   = "future.jetci.xyz/pipeline"
+REPOSITORY_LABEL = "future.jetci.xyz/repository"
+POOL_LABEL       = "future.jetci.xyz/pool"
+POOL_OWNER_LABEL = "future.jetci.xyz/pool-owner"
+
+# Nothing waits forever. Pipelines can set their own readinessTimeout and pipelineTimeout in .jetci.yaml, in seconds.
+# Pods also get an activeDeadlineSeconds, so Kubernetes stops them even when the operator is gone.
+READINESS_TIMEOUT = int(os.environ.get("JETCI_READINESS_TIMEOUT", "600"))
+PIPELINE_TIMEOUT  = int(os.environ.get("JETCI_PIPELINE_TIMEOUT", "3600"))
+FETCH_TIMEOUT     = int(os.environ.get("JETCI_FETCH_TIMEOUT", "300"))
+
+# How long a pod may run at most: until it's ready, then until its commands are done.
+def pod_lifetime(pipeline_specification):
+    return pipeline_specification.get('readinessTimeout', READINESS_TIMEOUT) + pipeline_specification.get('pipelineTimeout', PIPELINE_TIMEOUT)
+
+# The activeDeadlineSeconds of a pipeline pod. Pods of the warm pool can be handed out until they are WARM_POOL_MAX_AGE
+# seconds old, so they live that much longer.
+def pod_deadline(pipeline_specification):
+    if warmpool.WARM_POOL_SIZE > 0:
+        return pod_lifetime(pipeline_specification) + warmpool.WARM_POOL_MAX_AGE
+    return pod_lifetime(pipeline_specification)
+
+# Deletes a pod and doesn't mind if it's already gone.
+def delete_pod(namespace, pod_name):
+    try:
+        client.CoreV1Api(api_client).delete_namespaced_pod(pod_name, namespace)
+    except client.exceptions.ApiException as err:
+        if err.status != 404:
+            print("Failed to delete pod:", namespace, pod_name, ":", err)
+
+# Shared pod cache filled by one watch on all operator managed pods.
+# This replaces every thread polling read_namespaced_pod, so API load doesn't grow with builds and pods.
+# pod_cache is keyed by (namespace, pod_name), build_pod_index maps (namespace, build_name) to a set of pod names.
+# Waiters block on pod_cache_condition and get woken on every pod event.
+pod_cache = {}
+build_pod_index = {}
+pod_cache_condition = threading.Condition()
+
+# Longest wait between tries when pods can't be listed, it doubles from a second up to this.
+POD_INFORMER_MAX_BACKOFF = 30
+
+def pod_cache_update(event_type, pod):
+    key = (pod.metadata.namespace, pod.metadata.name)
+    build_name = (pod.metadata.labels or {}).get(BUILD_LABEL)
+    build_key = (pod.metadata.namespace, build_name)
+
+    with pod_cache_condition:
+        if event_type == "DELETED":
+            pod_cache.pop(key, None)
+            if build_key in build_pod_index:
+                build_pod_index[build_key].discard(pod.metadata.name)
+                if len(build_pod_index[build_key]) == 0:
+                    del build_pod_index[build_key]
+        else:
+            # Pods of the warm pool change builds.
+            old_pod = pod_cache.get(key)
+            old_build_key = (pod.metadata.namespace, None if old_pod is None else (old_pod.metadata.labels or {}).get(BUILD_LABEL))
+            if old_build_key != build_key and old_build_key in build_pod_index:
+                build_pod_index[old_build_key].discard(pod.metadata.name)
+                if len(build_pod_index[old_build_key]) == 0:
+                    del build_pod_index[old_build_key]
+
+            pod_cache[key] = pod
+            if build_name is not None:
+                build_pod_index.setdefault(build_key, set()).add(pod.metadata.name)
+
+        pod_cache_condition.notify_all()
+
+# Replaces the whole cache with a fresh list of pods.
+def pod_cache_replace(pods):
+    global pod_cache, build_pod_index
+    new_cache = {}
+    new_index = {}
+    for pod in pods:
+        new_cache[(pod.metadata.namespace, pod.metadata.name)] = pod
+        build_name = (pod.metadata.labels or {}).get(BUILD_LABEL)
+        if build_name is not None:
+            new_index.setdefault((pod.metadata.namespace, build_name), set()).add(pod.metadata.name)
+
+    with pod_cache_condition:
+        pod_cache = new_cache
+        build_pod_index = new_index
+        pod_cache_condition.notify_all()
+
+# The informer. List once, then follow the watch from where the list left off.
+# We only relist when the watch fails, like when our resourceVersion is too old.
+def pod_informer():
+    label_selector = MANAGED_BY_LABEL + "=" + MANAGED_BY_VALUE
+    backoff = 1
+    while True:
+        # Anything getting out of here would leave the pod cache stale for good.
+        try:
+            pods = client.CoreV1Api(api_client).list_pod_for_all_namespaces(label_selector=label_selector)
+        except Exception as err:
+            print("pod_informer(): Failed to list pods, retrying in", backoff, "seconds:", err)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, POD_INFORMER_MAX_BACKOFF)
+            continue
+        backoff = 1
 
-def execute_pipeline(namespace, build_name, pipeline_specification):
-    # Generate the pod name
-    pod_name = build_name +  "-" + pipeline_specification['name'] + "-" + secrets.token_hex(4) # Max length is 253 characters
+        pod_cache_replace(pods.items)
+        resource_version = pods.metadata.resource_version
 
-    # Add this pod to the build
-    add_pod_to_build(namespace, build_name, pod_name)
+        try:
+            while True:
+                for event in watch.Watch().stream(client.CoreV1Api(api_client).list_pod_for_all_namespaces, label_selector=label_selector, resource_version=resource_version):
+                    pod_cache_update(event["type"], event["object"])
+                    resource_version = event["object"].metadata.resource_version
+        except Exception as err:
+            print("pod_informer(): Watch failed, relisting:", err)
+
+# Blocks until every container in the pod is ready.
+# Returns False if the pod can't become ready anymore, like when it failed, finished or got deleted, or after timeout seconds.
+def wait_for_pod_ready(namespace, pod_name, timeout=READINESS_TIMEOUT):
+    seen = False
+    deadline = time.monotonic() + timeout
+    with pod_cache_condition:
+        while True:
+            ready, seen = pod_ready_state(namespace, pod_name, seen)
+            if ready is not None:
+                return ready
+            if time.monotonic() >= deadline:
+                print("Pod", pod_name, "wasn't ready after", timeout, "seconds")
+                return False
+            pod_cache_condition.wait(deadline - time.monotonic())
+
+# Looks at a pod in the cache. Returns (ready, seen), where ready is True or False once the wait is over and None otherwise.
+# Both engines use this to wait for pods, the caller must hold pod_cache_condition.
+def pod_ready_state(namespace, pod_name, seen):
+    pod = pod_cache.get((namespace, pod_name))
+
+    # The pod may not have shown up in the watch yet, but once seen it going away means it was deleted.
+    if pod is None:
+        if seen:
+            print("Expected", pod_name, "to be in the running phase, but it was deleted")
+            return False, seen
+        return None, seen
+
+    if pod.status.phase != 'Pending':
+        all_ready = True
+
+        # Iterate the container ready statuses.
+        for cstat in pod.status.container_statuses or []:
+            if cstat.ready == False:
+                all_ready = False # Still not ready
+
+        if (all_ready or pod.status.phase in ['Succeeded', 'Failed']) and pod.status.phase != 'Running':
+            print("Expected", pod_name, "to be in the running phase, but it's phase is ", pod.status.phase)
+            return False, True
+
+        if all_ready and pod.status.phase == 'Running':
+            return True, True
+
+    return None, True
+
+# Counts the pods of a build that are still doing something. Caller must hold pod_cache_condition.
+def build_pods_remaining(namespace, build_name):
+    pods_remaining = 0
+    for pod_name in build_pod_index.get((namespace, build_name), set()):
+        pod = pod_cache[(namespace, pod_name)]
+        if pod.status.phase == 'Pending' or pod.status.phase == 'Running':
+            pods_remaining += 1
+    return pods_remaining
+
+# Container logs are followed by a fixed set of LOG_FOLLOWERS threads instead of a thread each, a stream per
+# container. Containers past the cap wait for a follower to free up, and whatever they logged by then comes with
+# their stream. The streams of a pod end when it's deleted. finish_container_logging() is called once a pipeline is
+# done with its pod, before that: containers that never got a follower have their log read in one go, and the streams
+# of a pod that goes back to the warm pool are ended, then the rest of its log is read.
+#
+# followed_logs is (namespace, pod_name) -> { container name: state }. A pod from the pool only logs what its containers
+# wrote after it was claimed, since when is in pod_log_since as (namespace, pod_name) -> datetime. Both guarded by
+# log_streams_locker.
+#
+# Logs are read with timestamps and go to the build log in batches, see logbatch.py.
+LOG_FOLLOWERS = int(os.environ.get("JETCI_LOG_FOLLOWERS", "64"))
+
+# Seconds finish_container_logging() waits for the followers of a pod to write what they have.
+LOG_STOP_TIMEOUT = 5
+
+followed_logs = {}
+pod_log_since = {}
+log_streams_locker = threading.Lock()
+log_followers = concurrent.futures.ThreadPoolExecutor(max_workers=LOG_FOLLOWERS, thread_name_prefix="log-follower")
+
+# Starts following the log of a container of a pipeline pod.
+def follow_container_log(namespace, build_name, pipeline_name, pod_name, container_name):
+    state = {
+        'batch': container_log_batch(namespace, build_name, pipeline_name, container_name),
+        'resp': None,
+        'stopped': False,
+        # Lines handled, so reading the log again after its stream was ended skips them.
+        'lines': 0
+    }
+    with log_streams_locker:
+        state['since'] = pod_log_since.get((namespace, pod_name))
+        followed_logs.setdefault((namespace, pod_name), {})[container_name] = state
+    state['future'] = log_followers.submit(container_logging, namespace, pod_name, container_name, state)
+
+def add_log_line(state, line):
+    timestamp, text = logbatch.split_timestamp(line)
+    if state['since'] is not None and logged_before(timestamp, state['since']):
+        return
+    state['lines'] += 1
+    if state['batch'].add(timestamp, text):
+        state['batch'].flush()
 
+# Follows the log of a container until the pod is gone or finish_container_logging() ends the stream.
+def container_logging(namespace, pod_name, container_name, state):
+    try:
+        with log_streams_locker:
+            stopped = state['stopped']
+        if not stopped:
+            try:
+                resp = client.CoreV1Api(api_client).read_namespaced_pod_log(pod_name, namespace, container=container_name, follow=True, timestamps=True, _preload_content=False)
+            except client.exceptions.ApiException as err:
+                print("container_logging(): Failed to follow the log:", namespace, pod_name, container_name, ":", err)
+                return
 
+            with log_streams_locker:
+                stopped = state['stopped']
+                state['resp'] = resp
+            try:
+                if not stopped:
+                    for line in watch.watch.iter_resp_lines(resp):
+                        add_log_line(state, line)
+            except Exception as err:
+                # Streams ended by finish_container_logging() end with an error.
+                with log_streams_locker:
+                    if not state['stopped']:
+                        print("container_logging(): Log stream ended:", namespace, pod_name, container_name, ":", err)
+            finally:
+                resp.release_conn()
+
+            with log_streams_locker:
+                stopped = state['stopped']
+
+        # Ended by finish_container_logging(), or it was done with the pod before the stream got going.
+        if stopped:
+            read_container_log(namespace, pod_name, container_name, state)
+    finally:
+        log_batches.close(state['batch'])
+
+# Reads what a container logged in one go, past the lines that were already handled.
+def read_container_log(namespace, pod_name, container_name, state):
+    kwargs = {}
+    if state['since'] is not None:
+        kwargs['since_seconds'] = int((datetime.datetime.now(datetime.timezone.utc) - state['since']).total_seconds()) + 1
+    try:
+        log = client.CoreV1Api(api_client).read_namespaced_pod_log(pod_name, namespace, container=container_name, timestamps=True, **kwargs)
+    except client.exceptions.ApiException as err:
+        # 400 is a container that never started, 404 a pod that's gone, neither has anything to read.
+        if err.status not in [ 400, 404 ]:
+            print("read_container_log(): Failed to read the log:", namespace, pod_name, container_name, ":", err)
+        return
+
+    handled = state['lines']
+    for line in (log or "").splitlines():
+        timestamp, _ = logbatch.split_timestamp(line)
+        if state['since'] is not None and logged_before(timestamp, state['since']):
+            continue
+        if handled > 0:
+            handled -= 1
+            continue
+        add_log_line(state, line)
+
+# Called before a pod is deleted, or with stop before it goes back to the pool. Streams that are ended here lose
+# what was on its way, the rest of the log is read after them, and this waits for that to be written.
+def finish_container_logging(namespace, pod_name, stop=False):
+    with log_streams_locker:
+        states = followed_logs.pop((namespace, pod_name), {})
+        pod_log_since.pop((namespace, pod_name), None)
+        for state in states.values():
+            state['stopped'] = stop
+
+    running = []
+    for container_name, state in states.items():
+        # Never got a follower.
+        if state['future'].cancel():
+            try:
+                read_container_log(namespace, pod_name, container_name, state)
+            finally:
+                log_batches.close(state['batch'])
+            continue
+
+        if stop:
+            running.append(state['future'])
+            if state['resp'] is not None:
+                try:
+                    state['resp'].shutdown()
+                except Exception:
+                    state['resp'].close()
+
+    concurrent.futures.wait(running, timeout=LOG_STOP_TIMEOUT)
+
+# The batch the log of a container is collected in until it's written to the build log.
+def container_log_batch(namespace, build_name, pipeline_name, container_name):
+    def write(output, timestamps):
+        build_log(namespace, build_name, pipeline_name, container_name, "-", output, "-", timestamps=timestamps)
+    batch = logbatch.LogBatch(write)
+    log_batches.add(batch)
+    return batch
+
+# The batch the output of an exec'd command is collected in while it runs. Commands of a container run one after
+# another, so the batch of a command is closed once the next one prints something and after the last one, before
+# any of their statuses are written.
+def command_log_batch(namespace, build_name, pipeline_name, container_name, command):
+    def write(output, timestamps):
+        build_log(namespace, build_name, pipeline_name, container_name, command, output, "running")
+    batch = logbatch.LogBatch(write, separator="")
+    log_batches.add(batch)
+    return batch
+
+# Whether a line of a log read with timestamps was written before since. Lines without a timestamp weren't.
+# Timestamps are only compared to the second, the rest of them depends on the container runtime.
+def logged_before(timestamp, since):
+    try:
+        written = datetime.datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=datetime.timezone.utc)
+    except (TypeError, ValueError):
+        return False
+    return written < since.replace(microsecond=0)
+
+
+# Pipelines are compiled once when their build is planned. The environment of every container is merged from
+# the repository, then the build, then the container itself, later ones win. Every pipeline gets the pod that runs
+# it in 'pod', without a name, and pods are made from copies of it, so it never changes once it's compiled.
+def compile_pipelines(build_obj, repo, pipelines):
+    env_layers = [ repo['spec'].get('env') or [], build_obj['spec'].get('env') or [] ]
+    for pipeline_specification in pipelines:
+        for container_specification in pipeline_specification['containers']:
+            container_specification['env'] = merge_env(env_layers + [ container_specification.get('env') or [] ])
+        pipeline_specification['pod'] = pipeline_pod_info(build_obj['metadata']['name'], pipeline_specification)
+
+# Merges lists of environment variables, a variable in a later list replaces the one with the same name before it.
+def merge_env(layers):
+    merged = {}
+    for layer in layers:
+        for env_var in layer:
+            merged[env_var['name']] = env_var
+    return list(merged.values())
+
+# The pod of a compiled pipeline, named pod_name.
+def pipeline_pod(pipeline_specification, pod_name):
+    pod_info = copy.deepcopy(pipeline_specification['pod'])
+    pod_info['metadata']['name'] = pod_name
+    return pod_info
+
+# Turns a compiled pipeline into the pod that runs it, without a name.
+def pipeline_pod_info(build_name, pipeline_specification):
     # We take the specification and convert it to pod_info for k8s.
     # To simplify this. here is a base object
     pod_info = {
         "apiVersion": "v1",
         "kind": "Pod",
         "metadata": {
-            "app.kubernetes.io/managed-by": "kubed-ci-runner",
-            "name": pod_name
+            "labels": {
+                MANAGED_BY_LABEL: MANAGED_BY_VALUE,
+                BUILD_LABEL: build_name,
+                PIPELINE_LABEL: pipeline_specification['name']
+            }
         },
         "spec": {
+            "activeDeadlineSeconds": pod_deadline(pipeline_specification),
             "containers": [],
             "volumes": [
                 # We need somewhere for 
@@ -63,6 +529,14 @@ def execute_pipeline(namespace, build_name, pipeline_specification):
     if 'volumes' in pipeline_specification:
         for volume in pipeline_specification['volumes']:
             pod_info['spec']['volumes'].append(volume)
+
+    # Cached outputs are kept on a volume, see stepcache.py.
+    cache_outputs = stepcache.STEP_CACHE_CLAIM != "" and any(stepcache.caches_outputs(container_specification) for container_specification in pipeline_specification['containers'])
+    if cache_outputs:
+        pod_info['spec']['volumes'].append({
+            "name": stepcache.STEP_CACHE_VOLUME,
+            "persistentVolumeClaim": { "claimName": stepcache.STEP_CACHE_CLAIM }
+        })
         
     # Iterate the containers in the specification and add them to pod_info
     for container_specification in pipeline_specification['containers']:
@@ -77,7 +551,7 @@ def execute_pipeline(namespace, build_name, pipeline_specification):
                         "mountPath": "/usr/src"
                     }
                 ],
-                "imagePullPolicy": "Always",
+                "imagePullPolicy": images.pull_policy(container_specification['image']),
                 'env': [],
                 "restartPolicy": "Never",
                 "securityContext": {}
@@ -96,26 +570,18 @@ def execute_pipeline(namespace, build_name, pipeline_specification):
             for volume_mount in container_specification['volumeMounts']:
                 container['volumeMounts'].append(volume_mount)
 
+        if cache_outputs and stepcache.caches_outputs(container_specification):
+            container['volumeMounts'].append({
+                "name": stepcache.STEP_CACHE_VOLUME,
+                "mountPath": stepcache.STEP_CACHE_MOUNT
+            })
+
         # Overwrite the entry point if requested
         if 'entrypoint' in container_specification:
             container["command"] = container_specification['entrypoint']
 
-        # Need to gather a simple version of the env.        
-        # We start with an empty env
-        container_env = {}
-        
-        # Write the repo env
-
-        # Write the build env over last env
-
-        # Write the conainer specification env over last env
-        if 'env' in container_specification:
-            for env_var in container_specification['env']:
-                container_env[env_var['name']] = env_var
-
-        # Now add the consolidated environment to the container env.
-        for k in container_env.keys():
-            container['env'].append(container_env[k])
+        # The env was merged by compile_pipelines().
+        container['env'] = container_specification.get('env', [])
 
         pod_info['spec']['containers'].append(container)
 
@@ -124,167 +590,562 @@ def execute_pipeline(namespace, build_name, pipeline_specification):
         #print(yaml.dump(pod_info))
         #print("---------- final pipeline pod /end-------")
 
+    return pod_info
+
+
+def execute_pipeline(namespace, build_name, pipeline_specification, repo_name=None):
+    # The build may have been cancelled while this pipeline waited.
+    if build_cancelled(namespace, build_name):
+        return False
+
+    # Generate the pod name
+    pod_name = build_name +  "-" + pipeline_specification['name'] + "-" + secrets.token_hex(4) # Max length is 253 characters
 
+    # The pod for this pipeline, compiled with the build.
+    pod_info = pipeline_pod(pipeline_specification, pod_name)
+
+    # With the warm pool on, a pod an earlier pipeline left behind may be waiting for us. See warmpool.py.
+    pod_start = time.monotonic()
+    pool_key = None
+    pod_source = "new"
+    pod_created = pod_start
+    if warmpool.WARM_POOL_SIZE > 0:
+        pool_key = warm_pool_pod_info(namespace, repo_name, pod_info)
+        claimed = warm_pool_claim(namespace, pool_key, pod_info, build_name, pipeline_specification['name'])
+        if claimed is not None:
+            pod_name, pod_created = claimed
+            pod_source = "pool"
 
+    # Add this pod to the build
+    add_pod_to_build(namespace, build_name, pod_name)
 
     # Create the pod in kubernetes
+    if pod_source == "new":
+        try:
+            resp = client.CoreV1Api(api_client).create_namespaced_pod(body=pod_info, namespace=namespace)
+        except client.exceptions.ApiException as err:
+            print("Failed to create pod:", pod_name, ":", err)
+            if pool_key is not None:
+                warm_pools.released(pool_key)
+            return False
+
+    # The pod goes away however the pipeline ends, or back to the pool when it succeeded.
+    succeeded = False
     try:
-        resp = client.CoreV1Api().create_namespaced_pod(body=pod_info, namespace=namespace)
-    except client.exceptions.ApiException as err:
-        print("Failed to create pod:", pod_name, ":", err)
+        succeeded = run_pipeline_pod(namespace, build_name, pipeline_specification, pod_name, pod_start, pod_source)
+        return succeeded
+    finally:
+        finish_container_logging(namespace, pod_name, stop=pool_key is not None)
+        if pool_key is None:
+            delete_pod(namespace, pod_name)
+        else:
+            warm_pool_release(namespace, pool_key, pod_name, pod_created, succeeded and not build_cancelled(namespace, build_name))
+
+# pod_source is "new" for a pod made for this pipeline, "pool" for one from the warm pool.
+def run_pipeline_pod(namespace, build_name, pipeline_specification, pod_name, pod_start, pod_source="new"):
+    # Wait for pod to be ready
+    if not wait_for_pod_ready(namespace, pod_name, pipeline_specification.get('readinessTimeout', READINESS_TIMEOUT)):
+        build_log(namespace, build_name, pipeline_specification['name'], "", "@jetci-readiness", "The pod wasn't ready in time", "failed")
         return False
+    if pod_source == "new":
+        POD_READY_SECONDS.observe(time.monotonic() - pod_start)
+    POD_CLAIM_SECONDS.observe(time.monotonic() - pod_start, pod_source)
+
+    # Commands that are still running at the deadline are stopped.
+    deadline = time.monotonic() + pipeline_specification.get('pipelineTimeout', PIPELINE_TIMEOUT)
+
+    # Pod is ready, run commands in the containers.
+    # Every container gets a thread that waits for the containers it needs, see needs_state().
+    results = {}
+    results_condition = threading.Condition()
+
+    def run_container(container_specification):
+        with results_condition:
+            needs_met = needs_state(container_specification, results)
+            while needs_met is None:
+                results_condition.wait()
+                needs_met = needs_state(container_specification, results)
+
+        succeeded = False
+        try:
+            if needs_met:
+                succeeded = run_container_commands(namespace, build_name, pipeline_specification['name'], pod_name, container_specification, pipeline_specification.get('commit'), deadline)
+            else:
+                build_log(namespace, build_name, pipeline_specification['name'], container_specification['name'], "@jetci-needs", "A container this one needs failed", "cancelled")
+        finally:
+            with results_condition:
+                results[container_specification['name']] = succeeded
+                results_condition.notify_all()
+
+    container_threads = [ threading.Thread(target=run_container, args=[container_specification]) for container_specification in pipeline_specification['containers'] ]
+    for container_thread in container_threads:
+        container_thread.start()
+    for container_thread in container_threads:
+        container_thread.join()
+
+    return all(results.values())
+
+# Runs the commands of a container one after another. Returns True when all of them succeeded.
+# commit is what the pod checked out, cached commands without inputs are keyed on it. Nothing runs past deadline.
+def run_container_commands(namespace, build_name, pipeline_name, pod_name, container_specification, commit=None, deadline=None):
+    # capture container output
+    follow_container_log(namespace, build_name, pipeline_name, pod_name, container_specification['name'])
+
+    steps = [ stepcache.parse_step(step) for step in container_specification.get('commands', []) ]
+    command_agent = None
+    agent_tried = False
+    try:
+        i = 0
+        while i < len(steps):
+            command, cache_options = steps[i]
+
+            # Cached commands that ran before with the same inputs aren't run again.
+            step_key = None
+            if cache_options is not None:
+                step_key = step_cache_key(namespace, pod_name, container_specification['name'], commit, cache_options, command)
+                record = step_cache_restore(namespace, pod_name, container_specification['name'], step_key, cache_options)
+                if record is not None:
+                    build_log(namespace, build_name, pipeline_name, container_specification['name'], command, STEP_CACHE_NOTE + record['output'], record['status'])
+                    i += 1
+                    continue
 
-    # Wait for pod to be ready
-    while True:
-        resp = client.CoreV1Api().read_namespaced_pod(name=pod_name, namespace=namespace)
-        
-        if resp.status.phase != 'Pending':
+            # Commands up to the next cached one are sent to the agent together.
+            batch = [ command ]
+            if cache_options is None:
+                while i + len(batch) < len(steps) and steps[i + len(batch)][1] is None:
+                    batch.append(steps[i + len(batch)][0])
+            i += len(batch)
+
+            if EXEC_MODE == "agent" and not agent_tried:
+                agent_tried = True
+                command_agent = start_command_agent(namespace, pod_name, container_specification['name'])
+
+            # Output is sent to the build log in batches while the commands run, see command_log_batch().
+            output_batches = {}
+            def log_output(j, output, batch=batch, output_batches=output_batches):
+                if j not in output_batches:
+                    for previous in output_batches.values():
+                        log_batches.close(previous)
+                    output_batches[j] = command_log_batch(namespace, build_name, pipeline_name, container_specification['name'], batch[j])
+                if output_batches[j].add(None, output):
+                    output_batches[j].flush()
 
-            all_ready = True
+            try:
+                results = run_commands(namespace, pod_name, container_specification['name'], batch, log_output, deadline, command_agent)
+            finally:
+                for output_batch in output_batches.values():
+                    log_batches.close(output_batch)
+
+            for command, res in zip(batch, results):
+                # Human readable status.
+                if res['status'] == 0:
+                    status = 'success'
+                elif res.get('timedOut'):
+                    status = 'timeout'
+                else:
+                    status = 'failed'
+
+                # Update the build log. The output is already in there.
+                entry_status = build_log(namespace, build_name, pipeline_name, container_specification['name'], command, "", status)
+                if entry_status == False:
+                    print("Unable to update build:", namespace, build_name)
+                    print("Stopping container", pipeline_name, container_specification['name'])
+                    return False
+
+                # Stop this container if it failed.
+                if res['status'] != 0:
+                    return False
+
+                if step_key is not None:
+                    step_cache_save(namespace, pod_name, container_specification['name'], step_key, cache_options, command, res)
+
+        return True
+    finally:
+        if command_agent is not None:
+            command_agent.close()
+
+
+# Step cache, see stepcache.py. Nothing in here fails a build, a step that can't be cached just runs.
+STEP_CACHE_NOTE = "Replayed from the step cache.\n"
+
+# The image digest and environment of a container, from the pod cache. The digest is None until the container started.
+# Variables from secrets and config maps are keyed on the reference, not on the value.
+def pod_container_state(namespace, pod_name, container_name):
+    with pod_cache_condition:
+        pod = pod_cache.get((namespace, pod_name))
+    if pod is None:
+        return None, []
+
+    image_id = None
+    for cstat in pod.status.container_statuses or []:
+        if cstat.name == container_name and cstat.image_id:
+            image_id = cstat.image_id
+
+    env = []
+    for container in pod.spec.containers:
+        if container.name == container_name:
+            for env_var in container.env or []:
+                env.append((env_var.name, env_var.value if env_var.value_from is None else str(env_var.value_from.to_dict())))
+    return image_id, env
+
+# Returns the key of a cached step, or None when it can't be cached.
+def step_cache_key(namespace, pod_name, container_name, commit, cache_options, command):
+    if stepcache.get_step_cache() is None:
+        return None
+    if len(cache_options['outputs']) > 0 and stepcache.STEP_CACHE_CLAIM == "":
+        print("Not caching", command, ": outputs need JETCI_STEP_CACHE_CLAIM")
+        return None
+
+    # Without a digest the same tag could be a different image.
+    image_id, env = pod_container_state(namespace, pod_name, container_name)
+    if image_id is None:
+        return None
+
+    if len(cache_options['inputs']) > 0:
+        try:
+            res = pod_exec(namespace, pod_name, container_name, stepcache.inputs_hash_command(cache_options['inputs']))
+        except Exception as err:
+            print("Failed to hash step inputs:", namespace, pod_name, container_name, ":", err)
+            return None
+        if res['status'] != 0 or res['output'].strip() == "":
+            print("Failed to hash step inputs:", namespace, pod_name, container_name, ":", res['output'])
+            return None
+        source = "inputs:" + res['output'].split()[0]
+    elif commit is not None:
+        source = "commit:" + commit
+    else:
+        return None
+
+    return stepcache.step_key(namespace, source, image_id, env, command)
+
+# Looks up a step and puts its outputs back in place. Returns the record on a hit, None otherwise.
+def step_cache_restore(namespace, pod_name, container_name, step_key, cache_options):
+    if step_key is None:
+        return None
+
+    step_cache = stepcache.get_step_cache()
+    record = step_cache.get(step_key)
+    if record is None:
+        return None
+
+    if record['outputs']:
+        try:
+            res = pod_exec(namespace, pod_name, container_name, stepcache.restore_command(step_key))
+        except Exception as err:
+            res = { 'status': -1, 'output': str(err) }
+        if res['status'] != 0:
+            print("Failed to restore step outputs, running it instead:", namespace, pod_name, container_name, ":", res['output'])
+            step_cache.forget(step_key)
+            return None
+
+    print("Step cache hit:", namespace, pod_name, container_name, step_key)
+    return record
+
+# Saves a step that succeeded, with its outputs.
+def step_cache_save(namespace, pod_name, container_name, step_key, cache_options, command, res):
+    step_cache = stepcache.get_step_cache()
+    archive_bytes = 0
+    if len(cache_options['outputs']) > 0:
+        # The removals go back when the save fails, the next save in the namespace gets them.
+        taken = step_cache.take_removals(namespace)
+        removals = [ removal for removal in taken if removal != step_key ]
+        try:
+            saved = pod_exec(namespace, pod_name, container_name, stepcache.save_command(step_key, cache_options['outputs'], removals))
+            archive_bytes = int(saved['output'].split()[-1]) if saved['status'] == 0 else None
+        except Exception as err:
+            print("Failed to save step outputs:", namespace, pod_name, container_name, ":", err)
+            step_cache.return_removals(namespace, taken)
+            return
+        if archive_bytes is None:
+            print("Failed to save step outputs:", namespace, pod_name, container_name, ":", saved['output'])
+            step_cache.return_removals(namespace, taken)
+            return
 
-            # Iterate the container ready statuses.
-            for cstat in resp.status.container_statuses:
-                if cstat.ready == False:
-                    all_ready = False # Still not ready
+    try:
+        step_cache.put(step_key, {
+            'namespace': namespace,
+            'command': str(command),
+            'status': 'success',
+            'output': res['output'],
+            'outputs': len(cache_options['outputs']) > 0,
+            'bytes': len(res['output'].encode("utf-8")) + archive_bytes
+        })
+    except OSError as err:
+        print("Failed to save step:", step_key, ":", err)
+
+
+# Pipelines are run by a fixed number of worker threads instead of a thread each.
+# Queued pipelines are kept in priority order, a worker takes the first one that isn't held back by a concurrency cap.
+# A cap of 0 means no limit.
+PIPELINE_WORKERS       = int(os.environ.get("JETCI_PIPELINE_WORKERS", "16"))
+NAMESPACE_CONCURRENCY  = int(os.environ.get("JETCI_NAMESPACE_CONCURRENCY", "0"))
+REPOSITORY_CONCURRENCY = int(os.environ.get("JETCI_REPOSITORY_CONCURRENCY", "0"))
+
+# Backpressure. New builds aren't claimed while this many pipelines are waiting for a worker.
+# They are left for another replica, or for us once the queue drains.
+MAX_QUEUED_PIPELINES = int(os.environ.get("JETCI_MAX_QUEUED_PIPELINES", "64"))
+
+# Everything below is guarded by scheduler_condition.
+# pipeline_queue holds (-priority, sequence, job) tuples, sorted. The sequence keeps equal priorities first come first served.
+pipeline_queue = []
+pipeline_sequence = itertools.count()
+running_namespaces = {}
+running_repositories = {}
+
+# Pipelines of a build that haven't finished yet, and builds that have had a pipeline start.
+build_pipelines_remaining = {}
+started_builds = set()
+
+# How many things are working on a build right now, its claim and its running pipelines, or its task in the asyncio
+# engine. A cancelled build is remembered until this drops to nothing, see forget_cancelled_build().
+build_work = {}
+
+# Pipelines waiting on the pipelines they need, as build key -> (priority, [ jobs ]),
+# and how the finished pipelines of a build went, as build key -> { pipeline name: True/False }.
+build_waiting_pipelines = {}
+build_pipeline_results = {}
+
+# Builds we saw but haven't claimed yet, oldest first.
+claim_backlog = collections.deque()
+
+scheduler_condition = threading.Condition()
+
+# Builds whose pipelines are all done. build_monitor() marks them complete once their pods are gone.
+# Guarded by pod_cache_condition, since that's what wakes build_monitor() up.
+finishing_builds = set()
+
+def execute_pipelines(namespace, build_name, repo_name, pipelines, priority=0):
+    # Pipelines wait until the pipelines they need are done, release_pipelines() queues them.
+    with scheduler_condition:
+        build_pipelines_remaining[(namespace, build_name)] = len(pipelines)
+        build_pipeline_results[(namespace, build_name)] = {}
+        jobs = []
+        for pipeline in pipelines:
+            jobs.append({
+                'namespace': namespace,
+                'build_name': build_name,
+                'repo_name': repo_name,
+                'pipeline': pipeline,
+                'queued': time.monotonic()
+            })
+        build_waiting_pipelines[(namespace, build_name)] = (priority, jobs)
+        cancelled = release_pipelines((namespace, build_name))
+        scheduler_condition.notify_all()
+    log_cancelled_pipelines(cancelled)
+
+    # Nothing to run, the build is done as soon as it has no pods.
+    if len(pipelines) == 0:
+        with scheduler_condition:
+            del build_pipelines_remaining[(namespace, build_name)]
+            build_pipeline_results.pop((namespace, build_name), None)
+        with pod_cache_condition:
+            finishing_builds.add((namespace, build_name))
+            pod_cache_condition.notify_all()
+
+# Queues the waiting pipelines of a build whose needs all succeeded, and cancels the ones that need a failed pipeline.
+# Returns the cancelled jobs, for log_cancelled_pipelines(). Caller must hold scheduler_condition.
+def release_pipelines(build_key):
+    if build_key not in build_waiting_pipelines:
+        return []
+
+    priority, jobs = build_waiting_pipelines[build_key]
+    results = build_pipeline_results[build_key]
+    cancelled = []
+
+    # A cancelled pipeline counts as failed, which can cancel the ones that need it. Go until nothing changes.
+    changed = True
+    while changed:
+        changed = False
+        for job in list(jobs):
+            state = needs_state(job['pipeline'], results)
+            if state is None:
+                continue
+            jobs.remove(job)
+            if state:
+                job['queued'] = time.monotonic()
+                bisect.insort(pipeline_queue, (-priority, next(pipeline_sequence), job))
+            else:
+                results[job['pipeline']['name']] = False
+                build_pipelines_remaining[build_key] -= 1
+                cancelled.append(job)
+                changed = True
+
+    if len(jobs) == 0:
+        del build_waiting_pipelines[build_key]
+    return cancelled
+
+def log_cancelled_pipelines(jobs):
+    for job in jobs:
+        print("Cancelling pipeline:", job['namespace'], job['build_name'], job['pipeline']['name'], ": a pipeline it needs failed")
+        build_log(job['namespace'], job['build_name'], job['pipeline']['name'], "", "@jetci-needs", "A pipeline this one needs failed", "cancelled")
+
+# Takes the first queued pipeline that fits under the concurrency caps. Caller must hold scheduler_condition.
+def next_runnable_pipeline():
+    for i in range(len(pipeline_queue)):
+        job = pipeline_queue[i][2]
+        if NAMESPACE_CONCURRENCY > 0 and running_namespaces.get(job['namespace'], 0) >= NAMESPACE_CONCURRENCY:
+            continue
+        if REPOSITORY_CONCURRENCY > 0 and running_repositories.get((job['namespace'], job['repo_name']), 0) >= REPOSITORY_CONCURRENCY:
+            continue
+        del pipeline_queue[i]
+        return job
+    return None
+
+# Drops the queued pipelines of a build, like when the build got deleted.
+def cancel_queued_pipelines(namespace, build_name):
+    with scheduler_condition:
+        pipeline_queue[:] = [ entry for entry in pipeline_queue if (entry[2]['namespace'], entry[2]['build_name']) != (namespace, build_name) ]
+        for i in range(len(claim_backlog) - 1, -1, -1):
+            if (claim_backlog[i]['metadata']['namespace'], claim_backlog[i]['metadata']['name']) == (namespace, build_name):
+                del claim_backlog[i]
+        build_pipelines_remaining.pop((namespace, build_name), None)
+        build_waiting_pipelines.pop((namespace, build_name), None)
+        build_pipeline_results.pop((namespace, build_name), None)
+        started_builds.discard((namespace, build_name))
+        scheduler_condition.notify_all()
+
+    with pod_cache_condition:
+        finishing_builds.discard((namespace, build_name))
+
+def pipeline_worker():
+    while True:
+        with scheduler_condition:
+            job = next_runnable_pipeline()
+            while job is None:
+                scheduler_condition.wait()
+                job = next_runnable_pipeline()
 
-            if all_ready and resp.status.phase != 'Running':
-                print("Expected", pod_name, "to be in the running phase, but it's phase is ", resp.status.phase)
-                return False
-            
-            if all_ready and resp.status.phase == 'Running':
-                break
+            build_key = (job['namespace'], job['build_name'])
+            repo_key = (job['namespace'], job['repo_name'])
+            running_namespaces[job['namespace']] = running_namespaces.get(job['namespace'], 0) + 1
+            running_repositories[repo_key] = running_repositories.get(repo_key, 0) + 1
 
-        time.sleep(1)
+            first_pipeline = build_key not in started_builds
+            started_builds.add(build_key)
+            build_work[build_key] = build_work.get(build_key, 0) + 1
+            queue_depth = len(pipeline_queue)
 
+            # Room in the queue again, the claim loop may want to take another build.
+            scheduler_condition.notify_all()
 
-    # Pod is ready, run commands in the containers
-    for container_specification in pipeline_specification['containers']:
-        if 'commands' not in container_specification:
-            container_specification['commands'] = []
-        
-        # capture container output
-        threading.Thread(target=container_logging, args=[namespace, build_name, pipeline_specification['name'], pod_name, container_specification['name']]).start()
+        print("Starting pipeline:", job['namespace'], job['build_name'], job['pipeline']['name'], ": waited", round(time.monotonic() - job['queued'], 3), "s, queue depth", queue_depth)
 
-        for command in container_specification['commands']:
-            # Exec command in container.
-            res = pod_exec(namespace, pod_name, container_specification['name'], command)
+        # Update the build status
+        if first_pipeline:
+            set_build_status(job['namespace'], job['build_name'], "Running")
 
-            # Human readable status.
-            if res['status'] == 0:
-                status = 'success'
-            else:
-                status = 'failed'
+        succeeded = False
+        try:
+            succeeded = execute_pipeline(job['namespace'], job['build_name'], job['pipeline'], job['repo_name']) == True
+        except Exception as err:
+            print("Pipeline crashed:", job['namespace'], job['build_name'], job['pipeline']['name'], ":", err)
 
-            # Update the build log.
-            entry_status = build_log(namespace, build_name, pipeline_specification['name'], container_specification['name'], command, res['output'], status)
-            if entry_status == False:
-                print("Unable to update build:", namespace, build_name)
-                print("Stopping pipeline", pipeline_specification['name'])
-                return
+        build_done = False
+        cancelled = []
+        with scheduler_condition:
+            running_namespaces[job['namespace']] -= 1
+            if running_namespaces[job['namespace']] == 0:
+                del running_namespaces[job['namespace']]
+            running_repositories[repo_key] -= 1
+            if running_repositories[repo_key] == 0:
+                del running_repositories[repo_key]
 
-            # Break from this pipeline if it failed.
-            if res['status'] != 0:
-                break
+            # The build may have been deleted while this pipeline ran.
+            if build_key in build_pipelines_remaining:
+                build_pipelines_remaining[build_key] -= 1
+                build_pipeline_results[build_key][job['pipeline']['name']] = succeeded
+                cancelled = release_pipelines(build_key)
+                if build_pipelines_remaining[build_key] == 0:
+                    del build_pipelines_remaining[build_key]
+                    build_pipeline_results.pop(build_key, None)
+                    started_builds.discard(build_key)
+                    build_done = True
 
-    client.CoreV1Api().delete_namespaced_pod(pod_name, namespace)
+            scheduler_condition.notify_all()
 
+        end_build_work(build_key)
+        log_cancelled_pipelines(cancelled)
 
-def execute_pipelines(namespace, build_name, pipelines):
-    # Iterate and run each pipeline in an array of pipelines.
-    for pipeline in pipelines:
-        # TODO: Add git-clone-repo task to pipeline.
-        #build_and_execute_pipeline(namespace, pod_base_name, pipeline)
-        threading.Thread(target=execute_pipeline, args=[namespace, build_name, pipeline]).start()
-    
-    threading.Thread(target=build_loop, args=[namespace, build_name]).start()
+        # Pods of failed pipelines may still be around, build_monitor() waits for them.
+        if build_done:
+            with pod_cache_condition:
+                finishing_builds.add(build_key)
+                pod_cache_condition.notify_all()
 
 
 
 
 
 def add_pod_to_build(namespace, build_name, pod_name):
-    run_locker.acquire()
     print("Adding pod to build:", namespace, build_name, pod_name)
-    try:
-        build_obj = client.CustomObjectsApi().get_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name)
-    except client.exceptions.ApiException as err:
-        print("add_pod_to_build(): Failed to get build:", namespace, build_name)
-        print(err)
-        run_locker.release()
-        return
+    with get_build_lock(namespace, build_name):
+        try:
+            patch_build(namespace, build_name, [ { "op": "add", "path": "/pods/-", "value": pod_name } ])
+        except client.exceptions.ApiException as err:
+            print("Failed add pod to build:", namespace, build_name)
+            print(err)
+            return
+
 
-    build_obj['pods'].append(pod_name)
 
-    try:
-        client.CustomObjectsApi().patch_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name, build_obj)
-    except client.exceptions.ApiException as err:
-        print("Failed add pod to build:", namespace, build_name)
-        print(err)
-        run_locker.release()
-        return
 
-    run_locker.release()
 
+# One thread that completes every build whose pipelines are done, once the pod cache shows none of its pods running.
+def build_monitor():
+    while True:
+        with pod_cache_condition:
+            done = []
+            while len(done) == 0:
+                done = [ build_key for build_key in finishing_builds if build_pods_remaining(build_key[0], build_key[1]) == 0 ]
+                if len(done) == 0:
+                    pod_cache_condition.wait()
 
+            for build_key in done:
+                finishing_builds.discard(build_key)
 
+        for namespace, build_name in done:
+            set_build_status(namespace, build_name, "Complete")
 
 
-def build_loop(namespace, build_name):
-    # Update the build status
-    set_build_status(namespace, build_name, "Running")
 
-    while True:
-        # Get pods in build
+
+def set_build_status(namespace, build_name, status):
+    # Pipelines of a cancelled build may still be finishing, they don't get to change its status.
+    if status != "Cancelled" and build_cancelled(namespace, build_name):
+        return
+
+    with get_build_lock(namespace, build_name):
         try:
-            build_obj = client.CustomObjectsApi().get_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name)
+            patch_build(namespace, build_name, [ { "op": "replace", "path": "/status", "value": status } ])
         except client.exceptions.ApiException as err:
-            print("build_loop(): Failed to get build:", namespace, build_name)
+            print("Failed to change status of build:", namespace, build_name)
             print(err)
             return
-        
-        # Pod detection
-        pods_remaining = 0
-        for pod_name in build_obj['pods']:
-            try:
-                resp = client.CoreV1Api().read_namespaced_pod(name=pod_name, namespace=namespace)
-            except: # happens when pod doesn't exist anymore
-                continue
-            
-            if resp.status.phase == 'Pending' or resp.status.phase == 'Running':
-                pods_remaining += 1
-        
-        if pods_remaining == 0:
-            set_build_status(namespace, build_name, "Complete")
-            return
-        
-        time.sleep(5)
-        
 
+    # Nothing else should be writing to this build, so let go of its lock.
+    if status in FINISHED_BUILD_STATUSES:
+        release_build_lock(namespace, build_name)
+        finish_active_build(namespace, build_name, status)
 
+# Forgets a build we were running and records how long it took. Its log is done too, apart from late entries.
+def finish_active_build(namespace, build_name, status):
+    log_buffers.finish(namespace, build_name)
+    if log_store is not None:
+        log_store.finish(namespace, build_name)
+    created = active_builds.pop((namespace, build_name), None)
+    if created is not None:
+        BUILD_SECONDS.observe(time.time() - created, status)
 
-def set_build_status(namespace, build_name, status):
-    run_locker.acquire()
-    try:
-        build_obj = client.CustomObjectsApi().get_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name)
-    except client.exceptions.ApiException as err:
-        print("set_build_status(): Failed to get build:", namespace, build_name)
-        print(err)
-        run_locker.release()
-        return
-
-    build_obj['status'] = status
 
+# timestamps has the time every line of output was written, for container logs.
+def build_log(namespace, build_name, pipeline_name, container_name, command, output, status, timestamps=None):
+    start = time.monotonic()
     try:
-        client.CustomObjectsApi().patch_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name, build_obj)
-    except client.exceptions.ApiException as err:
-        print("Failed to change status of build:", namespace, build_name)
-        print(err)
-        run_locker.release()
-        return
-    run_locker.release()
+        return write_build_log(namespace, build_name, pipeline_name, container_name, command, output, status, timestamps)
+    finally:
+        BUILD_LOG_SECONDS.observe(time.monotonic() - start)
 
-
-def build_log(namespace, build_name, pipeline_name, container_name, command, output, status):
+def write_build_log(namespace, build_name, pipeline_name, container_name, command, output, status, timestamps=None):
     # TODO: Debug flags.
     #print("build_log():")
     #print("namespace", namespace)
@@ -297,64 +1158,82 @@ def build_log(namespace, build_name, pipeline_name, container_name, command, out
     #print("status", status)
     #print("-----")
 
-    run_locker.acquire()
-    try:
-        build_obj = client.CustomObjectsApi().get_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name)
-        build_obj['logs'].append({
-            'pipelineName': pipeline_name,
-            'command': str(command),
-            'output': output,
-            'container': container_name,
-            'status': status
-        })
-    except client.exceptions.ApiException as err:
-        print("build_log(): Failed to get build:", namespace, build_name)
-        print(err)
-        run_locker.release()
-        return False
-    
-    try:
-        client.CustomObjectsApi().patch_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name, build_obj)
-    except client.exceptions.ApiException as err:
-        print("Failed to update build:", namespace, build_name)
-        print(err)
-        run_locker.release()
-        return False
+    log_entry = {
+        'pipelineName': pipeline_name,
+        'command': str(command),
+        'output': output,
+        'container': container_name,
+        'status': status
+    }
+    if timestamps is not None:
+        log_entry['timestamps'] = timestamps
+
+    # Old behavior, the whole log lives in the build.
+    if log_store is None:
+        operations = [ { "op": "add", "path": "/logs/-", "value": log_entry } ]
+        log_buffers.append(namespace, build_name, log_entry)
+
+    # The log goes to the store and the build only gets a small summary that doesn't grow with the log.
+    else:
+        # Viewers move on to the offset of the last entry they got, so entries have to reach the buffer in log order.
+        with get_log_append_lock(namespace, build_name):
+            try:
+                log_bytes = log_store.append(namespace, build_name, log_entry)
+            except OSError as err:
+                print("Failed to write build log:", namespace, build_name)
+                print(err)
+                return False
+            log_buffers.append(namespace, build_name, log_entry, log_bytes)
+
+        operations = [ { "op": "add", "path": "/logSummary", "value": {
+            'backend': logstore.LOG_BACKEND,
+            'bytes': log_bytes,
+            'lastPipelineName': pipeline_name,
+            'lastContainer': container_name,
+            'lastCommand': str(command),
+            'lastStatus': status
+        } } ]
+
+    build_lock = get_build_lock(namespace, build_name)
+    lock_wait_start = time.monotonic()
+    with build_lock:
+        BUILD_LOCK_WAIT_SECONDS.observe(time.monotonic() - lock_wait_start)
+        try:
+            patch_build(namespace, build_name, operations)
+        except client.exceptions.ApiException as err:
+            print("Failed to update build:", namespace, build_name)
+            print(err)
+            return False
 
-    run_locker.release()
     return True
 
 
-# TODO: Consolidate into shared.py
-def get_repo(namespace, reponame):
-    try:
-        repo = client.CustomObjectsApi().get_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "repositories", reponame)
-    except:
-        print("repo not found:", namespace, reponame)
-        return False
-    return repo
-
-
-
-def get_jetci_yaml(namespace, repo):    
+# Fetches .jetci.yaml using a pod. When commit is given that commit is checked out instead of the branch head.
+# Returns (contents, commit), where commit is the branch head the pod saw when none was given, or False.
+def get_jetci_yaml(namespace, repo, commit=None):
     # This pod is going to be used to get .jetci.yaml
     pod_name = "git-jetci-yaml-" + secrets.token_hex(4)
+    image = image_digests.pin(GIT_IMAGE)
     pod_info = {
         "apiVersion": "v1",
         "kind": "Pod",
         "metadata": {
-            "app.kubernetes.io/managed-by": "jetci-operator",
-            "name": pod_name
+            "name": pod_name,
+            "labels": {
+                MANAGED_BY_LABEL: MANAGED_BY_VALUE,
+                REPOSITORY_LABEL: repo['metadata']['name']
+            }
         },
         "spec": {
+            "activeDeadlineSeconds": READINESS_TIMEOUT + FETCH_TIMEOUT,
             "containers": [
                 {
                     "name": "git-jetci-yaml",
-                    "image": "alpine/git:latest",
-                    "command": [ "/bin/sh", "-c", "while true; do sleep 300s; done" ],
+                    "image": image,
+                    "command": [ "/bin/sh", "-c", "sleep " + str(READINESS_TIMEOUT + FETCH_TIMEOUT) ],
                     "workingDir": "/usr/src",
                     "volumeMounts": [],
-                    "imagePullPolicy": "Always",
+                    "imagePullPolicy": images.pull_policy(image),
                     "env":[
                         { "name": "GIT_SSH_COMMAND", "value": "ssh -o StrictHostKeyChecking=no" }
                     ],
@@ -385,172 +1264,2302 @@ def get_jetci_yaml(namespace, repo):
         })
 
     try:
-        resp = client.CoreV1Api().create_namespaced_pod(body=pod_info, namespace=namespace)
+        resp = client.CoreV1Api(api_client).create_namespaced_pod(body=pod_info, namespace=namespace)
     except client.exceptions.ApiException as err:
         print("Failed to create pod:", pod_name, ":", err)
         return False
 
+    # The pod goes away however the fetch ends.
+    try:
+        return read_jetci_yaml_in_pod(namespace, repo, pod_name, commit)
+    finally:
+        delete_pod(namespace, pod_name)
+
+def read_jetci_yaml_in_pod(namespace, repo, pod_name, commit):
     # Wait for pod to be ready.
-    while True:
-        resp = client.CoreV1Api().read_namespaced_pod(name=pod_name, namespace=namespace)
-        if resp.status.phase != 'Pending':
-            if resp.status.phase != 'Running':
-                print("Expected", pod_name, "to be in the running phase, but it's phase is ", resp.status.phase)
-                return False
-            break
-        time.sleep(1)
+    if not wait_for_pod_ready(namespace, pod_name):
+        return False
+    deadline = time.monotonic() + FETCH_TIMEOUT
 
-    res = pod_exec(namespace, pod_name, "git-jetci-yaml", "git init")
+    res = pod_exec(namespace, pod_name, "git-jetci-yaml", "git init", deadline=deadline)
     if res['status'] != 0:
         print("get_jetci_yaml(): failed: git init")
         print(res)
-        client.CoreV1Api().delete_namespaced_pod(pod_name, namespace)
         return False
 
-    res = pod_exec(namespace, pod_name, "git-jetci-yaml", "git remote add origin -f " + repo['spec']["repoPath"]) # https://github.com/scalabledelivery/resolve-host-patcher.git
+    res = pod_exec(namespace, pod_name, "git-jetci-yaml", "git remote add origin -f " + repo['spec']["repoPath"], deadline=deadline) # https://github.com/scalabledelivery/resolve-host-patcher.git
     if res['status'] != 0:
         print("get_jetci_yaml(): failed: git remote add origin -f " + repo['spec']["repoPath"])
         print(res)
-        client.CoreV1Api().delete_namespaced_pod(pod_name, namespace)
         return False
 
-    res = pod_exec(namespace, pod_name, "git-jetci-yaml", "git checkout origin/" + repo['spec']["repoBranch"] + " -- .jetci.yaml")
+    revision = "origin/" + repo['spec']["repoBranch"]
+    if commit is not None:
+        revision = commit
+
+    res = pod_exec(namespace, pod_name, "git-jetci-yaml", "git checkout " + revision + " -- .jetci.yaml", deadline=deadline)
     if res['status'] != 0:
         print("Failed to fetch .jetci.yaml from ", repo['metadata']['name'], ":", repo['spec']["repoPath"])
         print(res)
-        client.CoreV1Api().delete_namespaced_pod(pod_name, namespace)
         return False
 
-    res = pod_exec(namespace, pod_name, "git-jetci-yaml", "cat .jetci.yaml")
+    res = pod_exec(namespace, pod_name, "git-jetci-yaml", "cat .jetci.yaml", deadline=deadline)
     if res['status'] != 0:
         print("Failed to read .jetci.yaml from ", repo['metadata']['name'], ":", repo['spec']["repoPath"])
         print(res)
-        client.CoreV1Api().delete_namespaced_pod(pod_name, namespace)
         return False
 
-    client.CoreV1Api().delete_namespaced_pod(pod_name, namespace)
-    return res['output']
+    # The middle of a file bigger than the exec output bound is missing, parsing what's left would be wrong.
+    if res['truncated']:
+        print("Failed to read .jetci.yaml from ", repo['metadata']['name'], ":", repo['spec']["repoPath"], ": it's bigger than", EXEC_OUTPUT_HEAD + EXEC_OUTPUT_TAIL, "characters")
+        return False
+    jetci_yaml = res['output']
+
+    # The pipelines check out the same commit this .jetci.yaml is from, not whatever the branch is at by then.
+    if commit is None:
+        res = pod_exec(namespace, pod_name, "git-jetci-yaml", "git rev-parse " + revision, deadline=deadline)
+        if res['status'] != 0 or len(res['output'].strip()) != 40:
+            print("Failed to resolve", revision, "of", repo['metadata']['name'], ":", repo['spec']["repoPath"])
+            print(res)
+            return False
+        commit = res['output'].strip()
+
+    return jetci_yaml, commit
+
+
+
+
+
+# How long git may run inside the operator process.
+GIT_TIMEOUT = float(os.environ.get("JETCI_GIT_TIMEOUT", "60"))
+
+# Runs git commands in the operator process, one after the other, stopping at the first one that fails.
+# Returns the CompletedProcess of the last command that ran, or False if git couldn't run.
+# For ssh repositories the key from the repository's sshKey secret is written to a temporary file for the calls.
+def run_git(repo, commands, cwd=None):
+    env = dict(os.environ)
+    env["GIT_TERMINAL_PROMPT"] = "0"
+    ssh_command = "ssh -o StrictHostKeyChecking=no"
+
+    with tempfile.TemporaryDirectory() as key_dir:
+        if repo['spec']['authType'] == "ssh":
+            try:
+                secret = client.CoreV1Api(api_client).read_namespaced_secret(repo['spec']['sshKey']['secretName'], repo['metadata']['namespace'])
+                ssh_key = base64.standard_b64decode(secret.data[repo['spec']['sshKey']['secretKeyPath']])
+            except (client.exceptions.ApiException, KeyError, TypeError) as err:
+                print("run_git(): Failed to get ssh key for repo:", repo['metadata']['namespace'], repo['metadata']['name'])
+                print(err)
+                return False
+
+            key_path = os.path.join(key_dir, "id_rsa")
+            with open(os.open(key_path, os.O_WRONLY | os.O_CREAT, 0o600), "wb") as key_file:
+                key_file.write(ssh_key)
+            ssh_command += " -o IdentitiesOnly=yes -i " + key_path
+
+        env["GIT_SSH_COMMAND"] = ssh_command
+
+        for args in commands:
+            try:
+                res = subprocess.run(["git"] + args, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=GIT_TIMEOUT)
+            except (OSError, subprocess.TimeoutExpired) as err:
+                print("run_git(): git", args[0], "failed:", err)
+                return False
+
+            if res.returncode != 0:
+                break
+
+        return res
+
+# Resolves the head of the repository's branch to a commit sha with `git ls-remote`. Returns False when that fails.
+def resolve_commit(repo):
+    res = run_git(repo, [ ["ls-remote", repo['spec']["repoPath"], "refs/heads/" + repo['spec']["repoBranch"]] ])
+    if res == False or res.returncode != 0:
+        print("Failed to resolve branch of", repo['metadata']['name'], ":", repo['spec']["repoPath"], repo['spec']["repoBranch"])
+        if res != False:
+            print(res.stderr.decode('utf-8', 'replace'))
+        return False
+
+    for line in res.stdout.decode('utf-8').splitlines():
+        return line.split()[0]
+
+    print("Branch not found in", repo['metadata']['name'], ":", repo['spec']["repoPath"], repo['spec']["repoBranch"])
+    return False
+
+
+# How .jetci.yaml is fetched. "operator" fetches it from the operator process and falls back to a pod when that fails.
+# "pod" always uses a pod, like get_jetci_yaml() always did.
+FETCH_MODE = os.environ.get("JETCI_FETCH_MODE", "operator")
+
+# The operator keeps a bare mirror of every repository it fetches .jetci.yaml from in GIT_MIRROR_DIR, so every
+# fetch after the first only downloads what's new. Mirrors don't have blobs, a blob is only downloaded when it's read.
+# An empty GIT_MIRROR_DIR fetches into a temporary directory every time instead.
+GIT_MIRROR_DIR = os.environ.get("JETCI_GIT_MIRROR_DIR", "/var/lib/jetci/git-mirrors")
+
+# One lock per mirror, git doesn't like two fetches into the same repository at once.
+git_mirror_locks = {}
+git_mirror_locks_locker = threading.Lock()
+
+def git_mirror_lock(path):
+    with git_mirror_locks_locker:
+        if path not in git_mirror_locks:
+            git_mirror_locks[path] = threading.Lock()
+        return git_mirror_locks[path]
+
+# Fetches .jetci.yaml of commit, or the head of the branch, through the operator's mirror. Returns the contents or False.
+def fetch_jetci_yaml_from_mirror(repo, commit=None):
+    path = os.path.join(GIT_MIRROR_DIR, mirror_name(repo))
+    branch = repo['spec']["repoBranch"]
+
+    with git_mirror_lock(path):
+        commands = []
+        if not os.path.isdir(path):
+            os.makedirs(GIT_MIRROR_DIR, exist_ok=True)
+            commands += [
+                ["init", "-q", "--bare", path],
+                ["-C", path, "remote", "add", "origin", repo['spec']["repoPath"]],
+                ["-C", path, "config", "remote.origin.promisor", "true"],
+                ["-C", path, "config", "remote.origin.partialclonefilter", "blob:none"],
+            ]
+        commands += [
+            ["-C", path, "fetch", "-q", "--prune", "--filter=blob:none", "--no-tags", "origin", "+refs/heads/" + branch + ":refs/heads/" + branch],
+            ["-C", path, "show", (commit if commit is not None else "refs/heads/" + branch) + ":.jetci.yaml"],
+        ]
+        res = run_git(repo, commands)
+
+    if res == False or res.returncode != 0:
+        print("fetch_jetci_yaml(): Failed to fetch", repo['metadata']['name'], ":", repo['spec']["repoPath"], "through the mirror")
+        if res != False:
+            print(res.stderr.decode('utf-8', 'replace'))
+
+        # A mirror that failed to be made would fail every time.
+        if not os.path.isfile(os.path.join(path, "HEAD")):
+            shutil.rmtree(path, ignore_errors=True)
+        return False
 
+    return res.stdout.decode('utf-8')
+
+# Fetches .jetci.yaml from the operator process without starting a pod.
+# Only the tip of the branch is fetched, without history and without blobs. The blob of .jetci.yaml is then
+# the only file content that gets downloaded. Returns the contents or False.
+def fetch_jetci_yaml(repo, commit=None):
+    if GIT_MIRROR_DIR != "":
+        return fetch_jetci_yaml_from_mirror(repo, commit)
+
+    with tempfile.TemporaryDirectory() as git_dir:
+        res = run_git(repo, [
+            ["init", "-q"],
+            ["remote", "add", "origin", repo['spec']["repoPath"]],
+            ["fetch", "-q", "--depth=1", "--filter=blob:none", "--no-tags", "origin", "refs/heads/" + repo['spec']["repoBranch"]],
+            ["rev-parse", "FETCH_HEAD"],
+        ], cwd=git_dir)
+
+        if res == False or res.returncode != 0:
+            print("fetch_jetci_yaml(): Failed to fetch", repo['metadata']['name'], ":", repo['spec']["repoPath"])
+            if res != False:
+                print(res.stderr.decode('utf-8', 'replace'))
+            return False
+
+        # The branch moved since it was resolved, let the caller deal with the exact commit.
+        if commit is not None and res.stdout.decode('utf-8').strip() != commit:
+            print("fetch_jetci_yaml(): Branch moved past", commit, "in", repo['metadata']['name'], ":", repo['spec']["repoPath"])
+            return False
+
+        res = run_git(repo, [ ["show", "FETCH_HEAD:.jetci.yaml"] ], cwd=git_dir)
+        if res == False or res.returncode != 0:
+            print("Failed to read .jetci.yaml from ", repo['metadata']['name'], ":", repo['spec']["repoPath"])
+            if res != False:
+                print(res.stderr.decode('utf-8', 'replace'))
+            return False
+
+        return res.stdout.decode('utf-8')
+
+
+# Cache of .jetci.yaml, keyed by (namespace, repository name, commit).
+# Rebuilds of the same commit, from webhook retries for example, then skip fetching .jetci.yaml entirely.
+# The pipelines are still made for every build, they depend on the Repository too, like its secrets and branch.
+# Entries are evicted least recently used first, and expire after JETCI_CACHE_TTL seconds.
+JETCI_CACHE_SIZE = int(os.environ.get("JETCI_CACHE_SIZE", "128"))
+JETCI_CACHE_TTL  = float(os.environ.get("JETCI_CACHE_TTL", "3600"))
+
+jetci_cache = collections.OrderedDict()
+jetci_cache_locker = threading.Lock()
+jetci_cache_stats = { "hits": 0, "misses": 0 }
+
+def jetci_cache_key(repo, commit):
+    return (repo['metadata']['namespace'], repo['metadata']['name'], commit)
+
+# Returns the cached .jetci.yaml, or None.
+def jetci_cache_get(repo, commit):
+    key = jetci_cache_key(repo, commit)
+    with jetci_cache_locker:
+        entry = jetci_cache.get(key)
+        if entry is not None and time.monotonic() - entry['time'] > JETCI_CACHE_TTL:
+            del jetci_cache[key]
+            entry = None
+
+        if entry is None:
+            jetci_cache_stats['misses'] += 1
+            return None
+
+        jetci_cache.move_to_end(key)
+        jetci_cache_stats['hits'] += 1
+        return entry['yaml']
+
+def jetci_cache_put(repo, commit, jetci_yaml):
+    key = jetci_cache_key(repo, commit)
+    with jetci_cache_locker:
+        jetci_cache[key] = { 'time': time.monotonic(), 'yaml': jetci_yaml }
+        jetci_cache.move_to_end(key)
+        while len(jetci_cache) > JETCI_CACHE_SIZE:
+            jetci_cache.popitem(last=False)
+
+# The clone-git-repository step fills /usr/src with the commit a build runs, without the history before it.
+# With JETCI_GIT_MIRROR_CLAIM set, every Repository gets a bare mirror on that PersistentVolumeClaim. Pods only fetch
+# what's new into it, under a lock, and take the one commit they need from it. Without a mirror, or when it fails,
+# only that commit is fetched from the remote, and the whole branch when the remote won't hand out single commits.
+GIT_MIRROR_CLAIM  = os.environ.get("JETCI_GIT_MIRROR_CLAIM", "")
+GIT_MIRROR_VOLUME = "jetci-git-mirror"
+GIT_MIRROR_MOUNT  = "/jetci-git-mirror"
+
+def mirror_name(repo):
+    return hashlib.sha256(repo['spec']["repoPath"].encode("utf-8")).hexdigest()[:32] + ".git"
+
+# The command clone-git-repository runs, commit is the branch head when it's None.
+def clone_command(repo, commit):
+    url = shlex.quote(repo['spec']["repoPath"])
+    branch = shlex.quote("refs/heads/" + repo['spec']["repoBranch"])
+    refspec = shlex.quote("+refs/heads/" + repo['spec']["repoBranch"] + ":refs/heads/" + repo['spec']["repoBranch"])
+    revision = commit if commit is not None else branch
+
+    fetch = "git fetch -q --depth=1 origin " + revision + " || git fetch -q origin " + branch
+    if GIT_MIRROR_CLAIM != "":
+        mirror = GIT_MIRROR_MOUNT + "/" + mirror_name(repo)
+        update_mirror = "( flock 9 && { [ -d " + mirror + " ] || git init -q --bare " + mirror + "; } && git -C " + mirror + " fetch -q --prune " + url + " " + refspec + " ) 9>" + mirror + ".lock"
+        fetch = "{ " + update_mirror + " && git fetch -q --depth=1 file://" + mirror + " " + revision + "; } || " + fetch
+
+    script = "set -e; git init -q; git remote add origin " + url + "; " + fetch + "; git checkout -q " + (commit if commit is not None else "FETCH_HEAD")
+    return [ "/bin/sh", "-c", script ]
+
+# Turns the contents of .jetci.yaml into the pipelines we run, see lint.py for what it's checked for.
+# commit is what the pipelines check out, the branch head when it's None.
+# Returns (pipelines, None) or (False, what's wrong with it).
+def load_pipelines(repo, jetci_yaml, commit=None):
+    try:
+        jetci_obj = yaml.safe_load(jetci_yaml)
+    except yaml.YAMLError as err:
+        print("Error loading contents from .jetci.yaml:", err)
+        return False, "Can't parse .jetci.yaml:\n" + str(err)
+
+    errors = lint.lint(jetci_obj, [ GIT_MIRROR_VOLUME, stepcache.STEP_CACHE_VOLUME ])
+    if len(errors) > 0:
+        print("Error in .jetci.yaml of", repo['metadata']['name'], ":", "; ".join(errors))
+        return False, "Invalid .jetci.yaml:\n" + "\n".join(errors)
+
+    # Pipeline convenience doctor
+    for i in range(len(jetci_obj['pipelines'])):
+        # Ensure that volumes is set.
+        if 'volumes' not in jetci_obj['pipelines'][i]:
+            jetci_obj['pipelines'][i]['volumes'] = []
+
+        # Build the repo cloning pod
+        clone_git_repository = {
+            "name": "clone-git-repository",
+            "image": GIT_IMAGE,
+            # Only has to outlive the pipeline, the pod's activeDeadlineSeconds is the same.
+            "entrypoint": [ "/bin/sh", "-c", "sleep " + str(pod_deadline(jetci_obj['pipelines'][i])) ],
+            "env":[
+                { "name": "GIT_SSH_COMMAND", "value": "ssh -o StrictHostKeyChecking=no" }
+            ],
+            "volumeMounts": [],
+            "commands": [ clone_command(repo, commit) ],
+        }
 
+        # The shared mirror, see clone_command().
+        if GIT_MIRROR_CLAIM != "":
+            jetci_obj['pipelines'][i]['volumes'].append({
+                "name": GIT_MIRROR_VOLUME,
+                "persistentVolumeClaim": { "claimName": GIT_MIRROR_CLAIM }
+            })
+            clone_git_repository['volumeMounts'].append({
+                "name": GIT_MIRROR_VOLUME,
+                "mountPath": GIT_MIRROR_MOUNT
+            })
+
+        # Inject repo ssh-key mount data into the pipeline
+        if repo['spec']['authType'] == "ssh":
+            jetci_obj['pipelines'][i]['volumes'].append({
+                        "name": "git-ssh-key",
+                        "secret": {
+                            "secretName": repo['spec']['sshKey']['secretName'],
+                            "defaultMode": yaml.safe_load('0400') # TODO: 0400 becomes 256 in yaml? There's probably a data type for this.
+                        },
+                    })
+
+            clone_git_repository['volumeMounts'].append({
+                "name": "git-ssh-key",
+                "mountPath": "/root/.ssh/id_rsa",
+                "subPath": repo['spec']['sshKey']['secretKeyPath'],
+                "readOnly": True,
+            })
+
+        # Inject the clone-git-repository pod into the pipeline.
+        jetci_obj['pipelines'][i]['containers'].insert(0, clone_git_repository)
+
+        # Cached steps without inputs are keyed on the commit.
+        jetci_obj['pipelines'][i]['commit'] = commit
+
+        # Pipelines without needs start right away.
+        if 'needs' not in jetci_obj['pipelines'][i]:
+            jetci_obj['pipelines'][i]['needs'] = []
+
+        # Containers without needs wait for the one before them, like they always did.
+        # Everything waits for the clone, it's what fills /usr/src.
+        containers = jetci_obj['pipelines'][i]['containers']
+        clone_git_repository['needs'] = []
+        for j in range(1, len(containers)):
+            if 'needs' not in containers[j]:
+                containers[j]['needs'] = [ containers[j - 1]['name'] ]
+            if isinstance(containers[j]['needs'], list) and clone_git_repository['name'] not in containers[j]['needs']:
+                containers[j]['needs'] = [ clone_git_repository['name'] ] + containers[j]['needs']
+
+        error = dag_error(containers, "container", "pipeline " + str(jetci_obj['pipelines'][i].get('name')))
+        if error is not None:
+            print("Error in .jetci.yaml:", error)
+            return False, "Invalid .jetci.yaml:\n" + error
+
+    error = dag_error(jetci_obj['pipelines'], "pipeline", ".jetci.yaml")
+    if error is not None:
+        print("Error in .jetci.yaml:", error)
+        return False, "Invalid .jetci.yaml:\n" + error
+
+    return jetci_obj['pipelines'], None
+
+# Checks the needs of pipelines or containers. Returns what's wrong with them, or None if they can be run.
+def dag_error(nodes, kind, where):
+    names = [ node.get('name') for node in nodes ]
+    for name in names:
+        if names.count(name) > 1:
+            return "duplicate " + kind + " " + str(name) + " in " + where
+
+    for node in nodes:
+        if not isinstance(node['needs'], list):
+            return "needs of " + kind + " " + str(node['name']) + " in " + where + " isn't a list"
+        for need in node['needs']:
+            if need == node['name']:
+                return kind + " " + str(node['name']) + " in " + where + " needs itself"
+            if need not in names:
+                return kind + " " + str(node['name']) + " in " + where + " needs unknown " + kind + " " + str(need)
+
+    # Keep taking nodes whose needs are all taken, whatever is left over is in a cycle.
+    taken = set()
+    remaining = list(nodes)
+    while len(remaining) > 0:
+        ready = [ node for node in remaining if all(need in taken for need in node['needs']) ]
+        if len(ready) == 0:
+            return "cycle in the needs of " + ", ".join(str(node['name']) for node in remaining) + " in " + where
+        for node in ready:
+            taken.add(node['name'])
+        remaining = [ node for node in remaining if node['name'] not in taken ]
+
+    return None
+
+# True when everything a pipeline or container needs succeeded, False when something it needs failed, None while waiting.
+# results is name -> True/False for the ones that are done.
+def needs_state(specification, results):
+    for need in specification.get('needs', []):
+        if need in results and results[need] == False:
+            return False
+    for need in specification.get('needs', []):
+        if need not in results:
+            return None
+    return True
 
+# Gets the pipelines for the head of the repository's branch, from the cache when possible, with their images pinned.
+# Returns (pipelines, None) or (False, reason).
+def get_pipelines(namespace, repo):
+    pipelines, reason = load_build_pipelines(namespace, repo)
+    if pipelines != False:
+        pin_pipeline_images(pipelines)
+    return pipelines, reason
+
+def load_build_pipelines(namespace, repo):
+    # In pod mode the operator doesn't talk to the remote at all. The pod says which commit it read instead, so the
+    # cache only ever gets hits in operator mode.
+    commit = None
+    jetci_yaml = False
+    if FETCH_MODE == "operator":
+        commit = resolve_commit(repo)
+        if commit != False:
+            jetci_yaml = jetci_cache_get(repo, commit)
+            print(".jetci.yaml cache", "miss" if jetci_yaml is None else "hit", "for", repo['metadata']['namespace'], repo['metadata']['name'], commit, ": hits", jetci_cache_stats['hits'], "misses", jetci_cache_stats['misses'])
+            if jetci_yaml is None:
+                jetci_yaml = False
+        else:
+            # We can still run the build, it just can't be cached.
+            commit = None
+
+    # Get the contents of .jetci.yaml, the pod is the fallback.
+    # When the branch couldn't be resolved here the pod says which commit it read, so the pipelines still check that out.
+    cached = jetci_yaml != False
+    if FETCH_MODE == "operator" and not cached:
+        fetch_start = time.monotonic()
+        jetci_yaml = fetch_jetci_yaml(repo, commit)
+        JETCI_YAML_FETCH_SECONDS.observe(time.monotonic() - fetch_start, "operator")
+    if jetci_yaml == False:
+        fetch_start = time.monotonic()
+        fetched = get_jetci_yaml(namespace, repo, commit)
+        JETCI_YAML_FETCH_SECONDS.observe(time.monotonic() - fetch_start, "pod")
+        if fetched != False:
+            jetci_yaml, commit = fetched
+    if jetci_yaml == False:
+        print("get_jetci_yaml() returned false.")
+        return False, "Failed to pull .jetci.yaml"
+
+    pipelines, reason = load_pipelines(repo, jetci_yaml, commit)
+    if pipelines == False:
+        return False, reason
+
+    if FETCH_MODE == "operator" and commit is not None and not cached:
+        jetci_cache_put(repo, commit, jetci_yaml)
+
+    return pipelines, None
+
+
+
+
+# How long pod_exec blocks waiting for output before checking on the connection again.
+EXEC_READ_TIMEOUT = float(os.environ.get("JETCI_EXEC_READ_TIMEOUT", "1"))
+
+# How much of a command's output pod_exec keeps in memory.
+# The first EXEC_OUTPUT_HEAD and last EXEC_OUTPUT_TAIL characters are kept, the middle is dropped.
+EXEC_OUTPUT_HEAD = int(os.environ.get("JETCI_EXEC_OUTPUT_HEAD", str(64 * 1024)))
+EXEC_OUTPUT_TAIL = int(os.environ.get("JETCI_EXEC_OUTPUT_TAIL", str(64 * 1024)))
+
+# Collects output without copying it on every write, and without holding more than head + tail characters.
+class BoundedOutput:
+    def __init__(self, head_size=EXEC_OUTPUT_HEAD, tail_size=EXEC_OUTPUT_TAIL):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = []
+        self.head_length = 0
+        self.tail = collections.deque()
+        self.tail_length = 0
+        self.dropped = 0
+
+    def write(self, data):
+        if data == "":
+            return
 
+        # Fill the head first.
+        if self.head_length < self.head_size:
+            part = data[:self.head_size - self.head_length]
+            self.head.append(part)
+            self.head_length += len(part)
+            data = data[len(part):]
+
+        # Everything else goes to the tail, dropping the oldest chunks once it's too big.
+        if data != "":
+            self.tail.append(data)
+            self.tail_length += len(data)
+            while self.tail_length - len(self.tail[0]) >= self.tail_size:
+                self.tail_length -= len(self.tail[0])
+                self.dropped += len(self.tail.popleft())
+
+            # Trim the oldest chunk so the tail is exactly tail_size.
+            if self.tail_length > self.tail_size:
+                extra = self.tail_length - self.tail_size
+                self.tail[0] = self.tail[0][extra:]
+                self.tail_length -= extra
+                self.dropped += extra
+
+    def getvalue(self):
+        if self.dropped == 0:
+            return "".join(self.head) + "".join(self.tail)
+        return "".join(self.head) + "\n... [" + str(self.dropped) + " characters omitted] ...\n" + "".join(self.tail)
+
+# Works out the exit code from what the API server sent on the error channel.
+# This is what WSClient.returncode does, but we consume the channel ourselves so it's parsed here.
+def exec_returncode(error):
+    if error == "":
+        return -1
+
+    err = yaml.safe_load(error)
+    if err['status'] == "Success":
+        return 0
+
+    # Failures that didn't come from the command, like a missing executable, have no exit code.
+    try:
+        return int(err['details']['causes'][0]['message'])
+    except (KeyError, IndexError, TypeError, ValueError):
+        print("pod_exec(): exec failed:", err.get('message', error))
+        return -1
 
 # Executes commands inside of containers
-def pod_exec(namespace, pod_name, container, command):
-    if not isinstance(command, list):
-        command = command.split()
+# on_output is called with every chunk of combined output as soon as it arrives.
+# The returned output is bounded, see BoundedOutput, 'truncated' is set when some of it was dropped. Commands still running at deadline, a time.monotonic(), are
+# given up on with 'timedOut' set, the pod's activeDeadlineSeconds takes care of the process itself.
+def pod_exec(namespace, pod_name, container, command, on_output=None, deadline=None):
+    argv = command_argv(command)
+    if argv is None:
+        return unparsable_command(command)
+
+    exec_start = time.monotonic()
+
+    resp = exec_stream(pod_name, namespace, container=container, command=argv, stderr=True, stdin=True, stdout=True, tty=False, _preload_content=False)
+
+    combinedout = BoundedOutput()
+    error = []
+    timed_out = False
+
+    while True:
+        if deadline is not None and time.monotonic() >= deadline:
+            timed_out = True
+            break
+
+        # Block until there is output or the timeout passes, no spinning.
+        resp.update(timeout=EXEC_READ_TIMEOUT)
+
+        # Grab the exit status before read_all() throws it away.
+        error.append(resp.read_channel(ERROR_CHANNEL, timeout=0))
+
+        # read_all() gives us stdout and stderr combined in the order they were received, and empties the buffers.
+        output = resp.read_all()
+        if output != "":
+            combinedout.write(output)
+            if on_output is not None:
+                on_output(output)
+
+        if not resp.is_open():
+            break
 
-    resp = stream(client.CoreV1Api().connect_get_namespaced_pod_exec, pod_name, namespace, container=container,  command=command, stderr=True, stdin=True, stdout=True, tty=False, _preload_content=False)
+    resp.close()
 
-    stderr = ""
-    stdout = ""
-    combinedout = ""
+    if timed_out:
+        print("pod_exec(): timed out:", namespace, pod_name, container, command)
+        combinedout.write("\nTimed out.\n")
+        status = -1
+    else:
+        status = exec_returncode("".join(error))
+    EXEC_SECONDS.observe(time.monotonic() - exec_start, "success" if status == 0 else "failed")
 
-    while resp.is_open():
-        # This was taken from resp.read_all()
-        # read_all consumes the ERROR_CHANNEL
-        # We just want to combine outputs, but 
-        # consume specific output later
-        combinedout += resp._all.getvalue()
-        resp._all = resp._all.__class__()
+    return {
+        'output': combinedout.getvalue(),
+        'status': status,
+        'timedOut': timed_out,
+        'truncated': combinedout.dropped > 0
+    }
 
-        # Now we consume output
-        stderr += resp.read_stderr()
-        stdout += resp.read_stdout()
-    
+# Commands from .jetci.yaml are split into arguments like a shell would, without running one, so quotes work.
+# Returns None when the quotes don't add up.
+def command_argv(command):
+    if isinstance(command, list):
+        return command
+    try:
+        return shlex.split(command)
+    except ValueError:
+        return None
 
+def unparsable_command(command):
+    print("Can't parse command:", command)
     return {
-        'output': combinedout,
-        'stdout': stdout,
-        'stderr': stderr,
-        'status': resp.returncode
+        'output': "Can't parse the command, its quotes don't add up.\n",
+        'status': -1,
+        'timedOut': False
     }
 
+# How commands are run in containers. "exec" execs every command through the API server, "agent" starts a command
+# agent in every container and sends it the commands, see agent.py. Containers it doesn't start in get exec.
+EXEC_MODE = os.environ.get("JETCI_EXEC_MODE", "exec")
+
+# Seconds an agent gets to say it's ready.
+AGENT_START_TIMEOUT = 10
+
+class AgentError(Exception):
+    pass
+
+# One command agent in a container, over one exec that stays open.
+class CommandAgent:
+    def __init__(self, namespace, pod_name, container):
+        self.token = secrets.token_hex(16)
+        self.stream = agent.AgentStream(self.token)
+        self.batches = itertools.count()
+        self.ids = itertools.count()
+        # Set once the agent can't be used anymore, the rest of the commands are exec'd.
+        self.broken = False
+
+        self.resp = exec_stream(pod_name, namespace, container=container, command=agent.agent_command(self.token), stderr=True, stdin=True, stdout=True, tty=False, _preload_content=False)
+        deadline = time.monotonic() + AGENT_START_TIMEOUT
+        try:
+            while ("ready",) not in self.read():
+                if time.monotonic() >= deadline:
+                    raise AgentError("not ready after " + str(AGENT_START_TIMEOUT) + " seconds")
+        except Exception:
+            self.resp.close()
+            raise
+
+    # Waits up to EXEC_READ_TIMEOUT for what the agent writes. Raises AgentError once it's gone.
+    def read(self):
+        self.resp.update(timeout=EXEC_READ_TIMEOUT)
+        events = self.stream.feed(self.resp.read_channel(STDOUT_CHANNEL, timeout=0))
+
+        # Commands write to stdout, anything on stderr is the shell itself.
+        errors = self.resp.read_channel(STDERR_CHANNEL, timeout=0)
+        if errors != "":
+            print("Command agent:", errors.strip())
+
+        if len(events) == 0 and not self.resp.is_open():
+            raise AgentError(self.resp.read_channel(ERROR_CHANNEL, timeout=0) or "the agent exited")
+        return events
+
+    # Runs commands one after another until one fails. Returns a result like pod_exec()'s for every command that ran.
+    # on_output is called with the index of the command and every chunk of its output as soon as it arrives.
+    def run(self, commands, on_output=None, deadline=None):
+        batch = next(self.batches)
+        ids = [ str(next(self.ids)) for command in commands ]
+        try:
+            self.resp.write_stdin("".join(agent.command_line(batch, ids[i], command_argv(commands[i])) for i in range(len(commands))))
+        except Exception as err:
+            # Nothing ran, it's all exec'd instead.
+            print("Command agent went away:", err)
+            self.close()
+            return []
+
+        results = []
+        combinedout = BoundedOutput()
+        exec_start = time.monotonic()
+        while len(results) < len(commands):
+            if deadline is not None and time.monotonic() >= deadline:
+                print("Command agent: timed out:", commands[len(results)])
+                combinedout.write("\nTimed out.\n")
+                results.append({ 'output': combinedout.getvalue(), 'status': -1, 'timedOut': True })
+                self.close()
+                break
+
+            try:
+                events = self.read()
+            except Exception as err:
+                # The command may have done something already, it isn't run again.
+                print("Command agent went away:", err)
+                combinedout.write("\nThe command agent went away.\n")
+                results.append({ 'output': combinedout.getvalue(), 'status': -1, 'timedOut': False })
+                self.close()
+                break
+
+            for event in events:
+                if event[0] == "output":
+                    combinedout.write(event[1])
+                    if on_output is not None:
+                        on_output(len(results), event[1])
+                elif event[0] == "end" and event[1] == ids[len(results)]:
+                    status = int(event[2])
+                    EXEC_SECONDS.observe(time.monotonic() - exec_start, "success" if status == 0 else "failed")
+                    results.append({ 'output': combinedout.getvalue(), 'status': status, 'timedOut': False })
+                    combinedout = BoundedOutput()
+                    exec_start = time.monotonic()
+
+                    # The agent skips the rest of the batch.
+                    if status != 0:
+                        return results
+        return results
+
+    def close(self):
+        self.broken = True
+        try:
+            self.resp.close()
+        except Exception:
+            pass
+
+# Returns None when the agent doesn't start, like in containers without /bin/sh.
+def start_command_agent(namespace, pod_name, container):
+    try:
+        return CommandAgent(namespace, pod_name, container)
+    except Exception as err:
+        print("Command agent didn't start, exec'ing commands instead:", namespace, pod_name, container, ":", err)
+        return None
+
+# Runs commands one after another until one fails, through command_agent when there is one that works.
+# Returns a result like pod_exec()'s for every command that ran. on_output gets the index of the command and its output.
+def run_commands(namespace, pod_name, container, commands, on_output, deadline, command_agent=None):
+    results = []
+    while len(results) < len(commands) and (len(results) == 0 or results[-1]['status'] == 0):
+        i = len(results)
+        if command_agent is not None and not command_agent.broken and command_argv(commands[i]) is not None:
+            batch = []
+            for command in commands[i:]:
+                if command_argv(command) is None:
+                    break
+                batch.append(command)
+            results += command_agent.run(batch, lambda j, output: on_output(i + j, output), deadline)
+        else:
+            results.append(pod_exec(namespace, pod_name, container, commands[i], on_output=lambda output: on_output(i, output), deadline=deadline))
+    return results
+
+
+# Replicas split builds between them with consistent hashing over the live members.
+# Every replica keeps a Lease named after itself in OPERATOR_NAMESPACE, members are the replicas with a Lease that hasn't expired.
+# A build belongs to the first member at or after its hash on the ring. When a member goes away its builds move to the next one,
+# and builds it claimed but never finished get claimed again after its Lease expires.
+OPERATOR_NAMESPACE = os.environ.get("JETCI_OPERATOR_NAMESPACE", "jetci")
+OPERATOR_IDENTITY  = socket.getfqdn()
+LEASE_DURATION     = int(os.environ.get("JETCI_LEASE_DURATION", "30"))
+MEMBER_LABEL       = "future.jetci.xyz/operator-member"
+
+# Points per member on the ring, more points spread builds more evenly.
+SHARD_POINTS = 64
+
+# Leases of replicas that went away are deleted once they expired this many seconds ago, so they don't pile up with
+# every rollout. Long enough that a replica that only stalled for a while keeps its Lease.
+LEASE_DELETE_AFTER = LEASE_DURATION * 10
+
+# Guarded by shard_locker. shard_ring is a sorted list of (hash, identity), empty until membership_loop() built it.
+shard_locker = threading.Lock()
+shard_members = [ OPERATOR_IDENTITY ]
+shard_ring = []
+
+# Unfinished builds from the watch, (namespace, build_name) -> build object. Looked at again when members change.
+tracked_builds = {}
+
+# Builds handed to the claim queue and not claimed yet, so they don't get queued twice.
+claims_pending = set()
+
+# Builds this process claimed. Unfinished builds claimed by our identity that aren't in here were claimed before we
+# restarted with the same identity, like a StatefulSet pod does, and nothing runs them anymore.
+claimed_here = set()
+
+# Set once we know who the other members are. Nothing gets claimed before that.
+membership_ready = threading.Event()
+
+# Puts a build in front of the engine's claim loop. Set by the engine that is running.
+claim_queuer = None
+
+def shard_hash(value):
+    return int(hashlib.sha1(value.encode('utf-8')).hexdigest()[:16], 16)
+
+def set_shard_members(identities):
+    global shard_members, shard_ring
+    ring = []
+    for identity in identities:
+        for point in range(SHARD_POINTS):
+            ring.append((shard_hash(identity + "#" + str(point)), identity))
+    ring.sort()
+
+    with shard_locker:
+        shard_members = sorted(identities)
+        shard_ring = ring
+
+def shard_owner(namespace, build_name):
+    with shard_locker:
+        i = bisect.bisect_left(shard_ring, (shard_hash(namespace + "/" + build_name), ""))
+        return shard_ring[i % len(shard_ring)][1]
+
+def lease_now():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+# Creates or renews our Lease.
+def renew_lease():
+    lease_name = "jetci-operator-" + shard_hash(OPERATOR_IDENTITY).to_bytes(8, 'big').hex()
+    lease = {
+        "metadata": {
+            "name": lease_name,
+            "labels": { MANAGED_BY_LABEL: MANAGED_BY_VALUE, MEMBER_LABEL: "true" }
+        },
+        "spec": {
+            "holderIdentity": OPERATOR_IDENTITY,
+            "leaseDurationSeconds": LEASE_DURATION,
+            "renewTime": lease_now()
+        }
+    }
+
+    try:
+        client.CoordinationV1Api(api_client).patch_namespaced_lease(lease_name, OPERATOR_NAMESPACE, lease)
+    except client.exceptions.ApiException as err:
+        if err.status != 404:
+            raise
+        client.CoordinationV1Api(api_client).create_namespaced_lease(OPERATOR_NAMESPACE, lease)
+
+# The identities of every replica whose Lease hasn't expired, including us. Leases that expired long ago are deleted.
+def live_members():
+    identities = set([ OPERATOR_IDENTITY ])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for lease in client.CoordinationV1Api(api_client).list_namespaced_lease(OPERATOR_NAMESPACE, label_selector=MEMBER_LABEL + "=true").items:
+        if lease.spec.holder_identity is None or lease.spec.renew_time is None:
+            continue
+        expires = lease.spec.renew_time + datetime.timedelta(seconds=lease.spec.lease_duration_seconds or LEASE_DURATION)
+        if expires > now:
+            identities.add(lease.spec.holder_identity)
+        elif (now - expires).total_seconds() > LEASE_DELETE_AFTER:
+            delete_lease(lease)
+    return sorted(identities)
+
+# Deletes the Lease of a replica that went away. The precondition keeps it if the replica renewed it since we listed it.
+def delete_lease(lease):
+    print("Deleting expired lease of", lease.spec.holder_identity, ":", lease.metadata.name)
+    try:
+        client.CoordinationV1Api(api_client).delete_namespaced_lease(lease.metadata.name, OPERATOR_NAMESPACE, body=client.V1DeleteOptions(preconditions=client.V1Preconditions(resource_version=lease.metadata.resource_version)))
+    except client.exceptions.ApiException as err:
+        if err.status not in [404, 409]:
+            print("Failed to delete lease:", lease.metadata.name, ":", err)
+
+# Decides whether we should claim a build we just saw, and remembers unfinished builds for later hand offs.
+def observe_build(event_type, build_obj):
+    build_key = (build_obj['metadata']['namespace'], build_obj['metadata']['name'])
+
+    with shard_locker:
+        if event_type == "DELETED" or build_obj.get('status') in FINISHED_BUILD_STATUSES:
+            tracked_builds.pop(build_key, None)
+            claims_pending.discard(build_key)
+            claimed_here.discard(build_key)
+            return False
+        tracked_builds[build_key] = build_obj
+
+        # Ours from before a restart, it's taken over like an orphan and starts over.
+        restarted = build_obj['claimedBy'] == OPERATOR_IDENTITY and build_key not in claimed_here
+        if (build_obj['claimedBy'] != "" and not restarted) or build_key in claims_pending:
+            return False
+
+    if not restarted and shard_owner(build_key[0], build_key[1]) != OPERATOR_IDENTITY:
+        return False
+
+    with shard_locker:
+        claims_pending.add(build_key)
+    return True
+
+# Queues the builds that became ours: unclaimed builds of members that left, and builds claimed by members that are gone.
+def hand_off_builds():
+    with shard_locker:
+        members = set(shard_members)
+        builds = list(tracked_builds.values())
+
+    for build_obj in builds:
+        build_key = (build_obj['metadata']['namespace'], build_obj['metadata']['name'])
+        if build_obj['claimedBy'] != "" and build_obj['claimedBy'] in members:
+            continue
+        if shard_owner(build_key[0], build_key[1]) != OPERATOR_IDENTITY:
+            continue
+
+        with shard_locker:
+            if build_key in claims_pending:
+                continue
+            claims_pending.add(build_key)
+
+        if build_obj['claimedBy'] != "":
+            print("Build orphaned by", build_obj['claimedBy'], ":", build_key[0], build_key[1])
+        claim_queuer(build_obj)
+
+def membership_loop():
+    while True:
+        try:
+            renew_lease()
+            members = live_members()
+            with shard_locker:
+                changed = members != shard_members or len(shard_ring) == 0
+
+            if changed:
+                print("Operator members:", members)
+                set_shard_members(members)
+            membership_ready.set()
+
+            # Hand offs also catch orphans whose owner's Lease only just ran out.
+            hand_off_builds()
+        except Exception as err:
+            print("membership_loop(): Failed to update members:", err)
+
+        time.sleep(LEASE_DURATION / 3)
+
+# Claims a build atomically. The "test" makes the API server reject the patch when someone else claimed it first.
+# When taking over a build from a replica that went away, its pods are deleted and the build starts over.
+def claim_build_atomically(build_obj):
+    namespace = build_obj['metadata']['namespace']
+    build_name = build_obj['metadata']['name']
+    previous_owner = build_obj['claimedBy']
+
+    # Testing the status too keeps us from claiming a build that was cancelled since we saw it.
+    operations = [
+        { "op": "test", "path": "/claimedBy", "value": previous_owner },
+        { "op": "test", "path": "/status", "value": build_obj.get('status', "Pending") },
+        { "op": "replace", "path": "/claimedBy", "value": OPERATOR_IDENTITY }
+    ]
+    if previous_owner != "":
+        operations.append({ "op": "replace", "path": "/pods", "value": [] })
+
+    # Remembered before the patch, the watch event of our own claim may come in before it returns.
+    with shard_locker:
+        claimed_here.add((namespace, build_name))
+
+    open_build_lock(namespace, build_name)
+    with get_build_lock(namespace, build_name):
+        try:
+            claimed = client.CustomObjectsApi(api_client).patch_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name, operations, _content_type="application/json-patch+json")
+        except client.exceptions.ApiException as err:
+            if err.status not in [404, 409, 422]:
+                print("Failed to claim build:", namespace, build_name)
+                print(err)
+            with shard_locker:
+                claimed_here.discard((namespace, build_name))
+            release_build_lock(namespace, build_name)
+            return False
+        finally:
+            with shard_locker:
+                claims_pending.discard((namespace, build_name))
+
+        set_build_version(namespace, build_name, claimed['metadata']['resourceVersion'])
+
+    if previous_owner != "":
+        delete_build_pods(namespace, build_name, build_obj.get('pods', []))
+        build_log(namespace, build_name, '@jetci', '@jetci', "@jetci-log", "Build taken over from " + previous_owner, "-")
+
+    build_obj['claimedBy'] = OPERATOR_IDENTITY
+    return True
+
+
+# Coalescing. Pushes come in bursts and usually only the newest build of a repository matters, so a Repository
+# picks what happens to its older builds with spec.buildPolicy:
+#   "run-all"            - (default) every build runs.
+#   "queue"              - one build runs at a time. A newer build cancels the older ones that haven't started yet.
+#   "cancel-in-progress" - a newer build cancels every older build, running ones included.
+# With spec.debounceSeconds a build is only claimed once it is that old, so a burst of triggers ends up as one build.
+# Every build of a Repository checks out its repoBranch, so builds of the same repository are builds of the same branch.
+BUILD_POLICIES = [ "run-all", "queue", "cancel-in-progress" ]
+
+# Builds that got cancelled while we were running them. Guarded by shard_locker.
+cancelled_builds = set()
+
+def build_cancelled(namespace, build_name):
+    with shard_locker:
+        return (namespace, build_name) in cancelled_builds
+
+def start_build_work(build_key):
+    with scheduler_condition:
+        build_work[build_key] = build_work.get(build_key, 0) + 1
+
+def end_build_work(build_key):
+    with scheduler_condition:
+        build_work[build_key] -= 1
+        if build_work[build_key] > 0:
+            return
+        del build_work[build_key]
+    forget_cancelled_build(build_key)
+
+# Forgets a cancelled build once nothing works on it anymore. Until then its pipelines have to see it's cancelled,
+# so they stop and don't change its status.
+def forget_cancelled_build(build_key):
+    with scheduler_condition:
+        if build_key in build_work:
+            return
+    with shard_locker:
+        cancelled_builds.discard(build_key)
+
+# Builds are ordered by creation, the name breaks ties so every replica agrees on the order.
+def build_order(build_obj):
+    return (build_obj['metadata']['creationTimestamp'], build_obj['metadata']['name'])
+
+def build_age(build_obj):
+    created = datetime.datetime.strptime(build_obj['metadata']['creationTimestamp'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc)
+    return (datetime.datetime.now(datetime.timezone.utc) - created).total_seconds()
+
+# Unfinished builds of a repository, oldest first.
+def repository_builds(namespace, repo_name):
+    with shard_locker:
+        builds = [ build_obj for build_obj in tracked_builds.values() if build_obj['metadata']['namespace'] == namespace and build_obj['spec']['repository'] == repo_name ]
+    return sorted(builds, key=build_order)
+
+# Sets the status of a build to Cancelled, as long as its status is one of statuses. The "test" keeps us from cancelling
+# a build that moved on since we saw it, then we look again. The replica running the build cleans up, see cancel_local_build().
+def cancel_build(build_obj, reason, statuses):
+    namespace = build_obj['metadata']['namespace']
+    build_name = build_obj['metadata']['name']
+
+    for attempt in range(BUILD_PATCH_RETRIES):
+        status = build_obj.get('status', "Pending")
+        if status not in statuses:
+            return False
+
+        operations = [
+            { "op": "test", "path": "/status", "value": status },
+            { "op": "replace", "path": "/status", "value": "Cancelled" }
+        ]
+
+        try:
+            client.CustomObjectsApi(api_client).patch_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name, operations, _content_type="application/json-patch+json")
+        except client.exceptions.ApiException as err:
+            if err.status == 404:
+                return False
+            if err.status not in [409, 422] or attempt == BUILD_PATCH_RETRIES - 1:
+                print("Failed to cancel build:", namespace, build_name)
+                print(err)
+                return False
+
+            try:
+                build_obj = client.CustomObjectsApi(api_client).get_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name)
+            except client.exceptions.ApiException:
+                return False
+            continue
+
+        print("Cancelled build:", namespace, build_name, ":", reason)
+        return True
+
+    return False
+
+# Stops a build of ours that got cancelled: drops its queued pipelines and deletes its pods, which ends the running ones.
+def cancel_local_build(build_obj):
+    namespace = build_obj['metadata']['namespace']
+    build_name = build_obj['metadata']['name']
+
+    # Builds we stopped tracking were cancelled already, later events of theirs are left alone.
+    with shard_locker:
+        if (namespace, build_name) in cancelled_builds or (namespace, build_name) not in tracked_builds:
+            return
+        cancelled_builds.add((namespace, build_name))
+
+    cancel_queued_pipelines(namespace, build_name)
+    build_log(namespace, build_name, '@jetci', '@jetci', "@jetci-log", "Build cancelled", "cancelled")
+
+    # Pods that never made it into the build's pod list are still in the pod cache.
+    with pod_cache_condition:
+        pod_names = set(build_pod_index.get((namespace, build_name), set()))
+    pod_names.update(build_obj.get('pods', []))
+    delete_build_pods(namespace, build_name, pod_names)
+
+    release_build_lock(namespace, build_name)
+    finish_active_build(namespace, build_name, "Cancelled")
+    forget_cancelled_build((namespace, build_name))
+
+# Puts a build back in front of the claim loop once it is done waiting, if it still needs claiming.
+def requeue_claim(build_key):
+    with shard_locker:
+        build_obj = tracked_builds.get(build_key)
+        if build_obj is None or build_key not in claims_pending:
+            return
+    claim_queuer(build_obj)
+
+# Applies the repository's build policy before a build gets claimed. Returns "run", "debounce", "wait" or "superseded".
+# Builds told to wait stay unclaimed and hand_off_builds() offers them again, debounced builds get offered by a timer.
+def coalesce_build(build_obj, repo):
+    namespace = build_obj['metadata']['namespace']
+    build_name = build_obj['metadata']['name']
+    policy = repo['spec'].get('buildPolicy', "run-all")
+    debounce = repo['spec'].get('debounceSeconds', 0)
+
+    if policy not in BUILD_POLICIES:
+        print("Unknown build policy:", namespace, repo['metadata']['name'], policy)
+        policy = "run-all"
+
+    # Too young, newer triggers may still come in. Keep it pending and look again once the window is over.
+    age = build_age(build_obj)
+    if debounce > 0 and age < debounce:
+        timer = threading.Timer(debounce - age, requeue_claim, [ (namespace, build_name) ])
+        timer.daemon = True
+        timer.start()
+        return "debounce"
+
+    if policy == "run-all":
+        return "run"
+
+    builds = repository_builds(namespace, repo['metadata']['name'])
+    newer = [ other for other in builds if build_order(other) > build_order(build_obj) ]
+    older = [ other for other in builds if build_order(other) < build_order(build_obj) ]
+
+    if len(newer) > 0:
+        cancel_build(build_obj, "Superseded by " + newer[-1]['metadata']['name'], [ "Pending" ])
+        return "superseded"
+
+    statuses = [ "Pending", "Queued" ]
+    if policy == "cancel-in-progress":
+        statuses.append("Running")
+
+    running = False
+    for other in older:
+        if not cancel_build(other, "Superseded by " + build_name, statuses):
+            running = True
+
+    # "queue" runs one build at a time, the ones we couldn't cancel have started.
+    if policy == "queue" and running:
+        return "wait"
+    return "run"
+
+# Claims a build and works out its pipelines. Returns (repo, pipelines), or False when there is nothing to run.
+def plan_build(build_obj):
+    build_key = (build_obj['metadata']['namespace'], build_obj['metadata']['name'])
+
+    # Load the repo configuration
+    repo = get_repo(build_obj['metadata']['namespace'], build_obj['spec']['repository'])
+
+    # Orphans we take over were already let through.
+    first_claim = build_obj['claimedBy'] == ""
+    if repo != False and first_claim:
+        decision = coalesce_build(build_obj, repo)
+        if decision != "run":
+            # Debounced builds stay pending until their timer offers them again.
+            if decision != "debounce":
+                with shard_locker:
+                    claims_pending.discard(build_key)
+            return False
+
+    if not claim_build_atomically(build_obj):
+        return False
+
+    # Orphans we take over are as old as the replica that left them, they'd only skew the claim latency.
+    age = build_age(build_obj)
+    if first_claim:
+        CLAIM_SECONDS.observe(age)
+    active_builds[build_key] = time.time() - age
+    log_buffers.open(build_key[0], build_key[1])
+
+    print("Claimed build:", build_obj['claimedBy'], ":", build_obj['metadata']['namespace'], build_obj['metadata']['name'])
+
+    if repo == False:
+        build_log(build_obj['metadata']['namespace'], build_obj['metadata']['name'], '@jetci', '@jetci', "@jetci-log", "Repository not found", "failed")
+        set_build_status(build_obj['metadata']['namespace'], build_obj['metadata']['name'], "Failed")
+        return False
+
+    # Get the pipelines from .jetci.yaml
+    pipelines, reason = get_pipelines(repo['metadata']['namespace'], repo)
+
+    if pipelines == False:
+        build_log(build_obj['metadata']['namespace'], build_obj['metadata']['name'], '@jetci', '@jetci', "@jetci-log", reason, "failed")
+        set_build_status(build_obj['metadata']['namespace'], build_obj['metadata']['name'], "Failed")
+        return False
+
+    compile_pipelines(build_obj, repo, pipelines)
+
+    set_build_status(build_obj['metadata']['namespace'], build_obj['metadata']['name'], "Queued")
+    return repo, pipelines
+
+# Claims a build, works out its pipelines and queues them.
+def claim_build(build_obj):
+    build_key = (build_obj['metadata']['namespace'], build_obj['metadata']['name'])
+    start_build_work(build_key)
+    try:
+        planned = plan_build(build_obj)
+        if planned == False:
+            return
+        repo, pipelines = planned
+
+        # Run the pipelines.
+        execute_pipelines(build_obj['metadata']['namespace'], build_obj['metadata']['name'], repo['metadata']['name'], pipelines, build_obj['spec'].get('priority', 0))
+    finally:
+        end_build_work(build_key)
+
+# Claims builds from the backlog, but only while there's room in the pipeline queue.
+def claim_loop():
+    while True:
+        with scheduler_condition:
+            while len(claim_backlog) == 0 or len(pipeline_queue) >= MAX_QUEUED_PIPELINES:
+                scheduler_condition.wait()
+            build_obj = claim_backlog.popleft()
+
+        try:
+            claim_build(build_obj)
+        except Exception as err:
+            print("Failed to claim build:", build_obj['metadata']['namespace'], build_obj['metadata']['name'], ":", err)
+
+# Forgets everything about a deleted build and deletes the pods it generated.
+def delete_build(build_obj):
+    cancel_queued_pipelines(build_obj['metadata']['namespace'], build_obj['metadata']['name'])
+    release_build_lock(build_obj['metadata']['namespace'], build_obj['metadata']['name'])
+    active_builds.pop((build_obj['metadata']['namespace'], build_obj['metadata']['name']), None)
+    with shard_locker:
+        cancelled_builds.discard((build_obj['metadata']['namespace'], build_obj['metadata']['name']))
+    if log_store is not None:
+        log_store.delete(build_obj['metadata']['namespace'], build_obj['metadata']['name'])
+    log_buffers.drop(build_obj['metadata']['namespace'], build_obj['metadata']['name'])
+    delete_build_pods(build_obj['metadata']['namespace'], build_obj['metadata']['name'], build_obj['pods'])
+
+# Deletes the pods of a build. Pods that went back to the warm pool since, or that another build claimed from it, are left alone.
+def delete_build_pods(namespace, build_name, pod_names):
+    for pod_name in pod_names:
+        with pod_cache_condition:
+            pod = pod_cache.get((namespace, pod_name))
+        if pod is not None and (pod.metadata.labels or {}).get(BUILD_LABEL) != build_name:
+            continue
+        delete_pod(namespace, pod_name)
+
+# The reaper deletes pods nothing is going to use anymore, so a crash or a missed event doesn't leak cluster capacity.
+# Every REAPER_INTERVAL seconds it goes over the pod cache, which is one label selected list and watch of our pods, for:
+#   - pods of builds that finished or got deleted, those are the builds that aren't in tracked_builds,
+#   - pods without a build, like the ones get_jetci_yaml() makes, that are older than they could ever need to be,
+#   - idle pods of warm pools that their replica forgot about, because it restarted or went away.
+# Pods younger than REAPER_GRACE are left alone, their build may not have come in on the watch yet.
+# Replicas only reap the pods of builds they own on the hash ring. An interval of 0 turns the reaper off.
+REAPER_INTERVAL = float(os.environ.get("JETCI_REAPER_INTERVAL", "60"))
+REAPER_GRACE    = float(os.environ.get("JETCI_REAPER_GRACE", "120"))
+
+# Set once the builds we knew about at startup have been handled, tracked_builds means nothing before that.
+builds_synced = threading.Event()
+
+def reapable_pods():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with pod_cache_condition:
+        pods = list(pod_cache.values())
+    with shard_locker:
+        tracked = set(tracked_builds.keys())
+        pool_owners = set(pool_owner(identity) for identity in shard_members)
+
+    reapable = []
+    for pod in pods:
+        if pod.metadata.deletion_timestamp is not None or pod.metadata.creation_timestamp is None:
+            continue
+        age = (now - pod.metadata.creation_timestamp).total_seconds()
+        labels = pod.metadata.labels or {}
+        build_name = labels.get(BUILD_LABEL)
+
+        # Idle pool pods are only known to the replica that owns them.
+        if build_name is None and POOL_LABEL in labels:
+            if age <= REAPER_GRACE:
+                continue
+            if labels.get(POOL_OWNER_LABEL) == pool_owner(OPERATOR_IDENTITY):
+                if not warm_pools.knows(labels[POOL_LABEL], pod.metadata.name):
+                    reapable.append(pod)
+            elif labels.get(POOL_OWNER_LABEL) not in pool_owners and shard_owner(pod.metadata.namespace, pod.metadata.name) == OPERATOR_IDENTITY:
+                reapable.append(pod)
+        elif build_name is None:
+            if age > READINESS_TIMEOUT + FETCH_TIMEOUT + REAPER_GRACE and shard_owner(pod.metadata.namespace, pod.metadata.name) == OPERATOR_IDENTITY:
+                reapable.append(pod)
+        elif age > REAPER_GRACE and (pod.metadata.namespace, build_name) not in tracked and shard_owner(pod.metadata.namespace, build_name) == OPERATOR_IDENTITY:
+            reapable.append(pod)
+    return reapable
+
+def reaper_loop():
+    builds_synced.wait()
+    while True:
+        time.sleep(REAPER_INTERVAL)
+        try:
+            for pod in reapable_pods():
+                print("Reaping pod:", pod.metadata.namespace, pod.metadata.name)
+                delete_pod(pod.metadata.namespace, pod.metadata.name)
+        except Exception as err:
+            print("reaper_loop(): failed:", err)
+
+# Warm pool, see warmpool.py. Every replica has pools of its own, the pods are told apart by POOL_OWNER_LABEL.
+# Nothing in here fails a pipeline, a pod that can't be claimed or put back is deleted and a new one made.
+warm_pools = warmpool.WarmPools()
+
+# How often pools are topped up and their expired pods deleted.
+WARM_POOL_INTERVAL = 5
+
+# The container /usr/src is emptied from, every pipeline pod has it.
+WARM_POOL_RESET_CONTAINER = "clone-git-repository"
+WARM_POOL_RESET_COMMAND = [ "/bin/sh", "-c", "rm -rf /usr/src/..?* /usr/src/.[!.]* /usr/src/*" ]
+
+def pool_owner(identity):
+    return shard_hash(identity).to_bytes(8, 'big').hex()
+
+# Labels a pipeline pod as one that can go back to the pool. Returns the key of its pool.
+def warm_pool_pod_info(namespace, repo_name, pod_info):
+    key = warmpool.pool_key(namespace, repo_name, pod_info['spec'])
+    pod_info['metadata']['labels'][POOL_LABEL] = key
+    pod_info['metadata']['labels'][POOL_OWNER_LABEL] = pool_owner(OPERATOR_IDENTITY)
+    if repo_name is not None:
+        pod_info['metadata']['labels'][REPOSITORY_LABEL] = repo_name
+    return key
+
+# Hands an idle pod of the pool to a pipeline. Returns (pod name, created) or None when there is none.
+def warm_pool_claim(namespace, key, pod_info, build_name, pipeline_name):
+    # Pods started ahead of time are made from the pod of the last pipeline that wanted one.
+    template = copy.deepcopy(pod_info)
+    del template['metadata']['name']
+    template['metadata']['labels'].pop(BUILD_LABEL, None)
+    template['metadata']['labels'].pop(PIPELINE_LABEL, None)
+
+    while True:
+        candidate = warm_pools.take(key, namespace, template)
+        if candidate is None:
+            warm_pools.claimed(key, False)
+            return None
+        pod_name, created = candidate
+
+        with pod_cache_condition:
+            ready, seen = pod_ready_state(namespace, pod_name, True)
+        if ready != True:
+            print("Pool pod went bad, deleting it:", namespace, pod_name)
+            delete_pod(namespace, pod_name)
+            continue
+
+        with log_streams_locker:
+            pod_log_since[(namespace, pod_name)] = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            client.CoreV1Api(api_client).patch_namespaced_pod(pod_name, namespace, { "metadata": { "labels": { BUILD_LABEL: build_name, PIPELINE_LABEL: pipeline_name } } }, _content_type="application/merge-patch+json")
+        except client.exceptions.ApiException as err:
+            print("Failed to claim pool pod:", namespace, pod_name, ":", err)
+            with log_streams_locker:
+                pod_log_since.pop((namespace, pod_name), None)
+            delete_pod(namespace, pod_name)
+            continue
+
+        warm_pools.claimed(key, True)
+        print("Claimed pool pod:", namespace, pod_name, "for", build_name, pipeline_name)
+        return pod_name, created
+
+# Puts the pod of a pipeline back in the pool once its /usr/src is empty, or deletes it.
+def warm_pool_release(namespace, key, pod_name, created, reusable):
+    try:
+        if reusable and warm_pools.has_room(key, created) and warm_pool_reset(namespace, key, pod_name):
+            if warm_pools.put(key, pod_name, created):
+                return
+        delete_pod(namespace, pod_name)
+    finally:
+        warm_pools.released(key)
+
+# Empties /usr/src and takes the pod off its build. Returns True when it worked.
+def warm_pool_reset(namespace, key, pod_name):
+    # Counted as warming in the meantime, so the reaper doesn't take it for a forgotten pool pod.
+    warm_pools.warming(key, pod_name)
+    try:
+        res = pod_exec(namespace, pod_name, WARM_POOL_RESET_CONTAINER, WARM_POOL_RESET_COMMAND)
+        if res['status'] == 0:
+            client.CoreV1Api(api_client).patch_namespaced_pod(pod_name, namespace, { "metadata": { "labels": { BUILD_LABEL: None, PIPELINE_LABEL: None } } }, _content_type="application/merge-patch+json")
+            return True
+        print("Failed to reset pool pod:", namespace, pod_name, ":", res['output'])
+    except Exception as err:
+        print("Failed to reset pool pod:", namespace, pod_name, ":", err)
+    warm_pools.failed(key, pod_name)
+    return False
+
+# Starts a pod for a pool ahead of time. It joins the pool once it's ready.
+def warm_pool_start(key, namespace, template):
+    pod_info = copy.deepcopy(template)
+    pod_info['metadata']['name'] = "jetci-pool-" + key[:12] + "-" + secrets.token_hex(4)
+    created = time.monotonic()
+    try:
+        client.CoreV1Api(api_client).create_namespaced_pod(body=pod_info, namespace=namespace)
+    except client.exceptions.ApiException as err:
+        print("Failed to create pool pod:", namespace, pod_info['metadata']['name'], ":", err)
+        return
+    warm_pools.warming(key, pod_info['metadata']['name'])
+
+    def join():
+        if wait_for_pod_ready(namespace, pod_info['metadata']['name']) and warm_pools.put(key, pod_info['metadata']['name'], created):
+            return
+        warm_pools.failed(key, pod_info['metadata']['name'])
+        delete_pod(namespace, pod_info['metadata']['name'])
+    threading.Thread(target=join, daemon=True).start()
+
+def warm_pool_loop():
+    while True:
+        time.sleep(WARM_POOL_INTERVAL)
+        try:
+            expired, wanted = warm_pools.tend()
+            for namespace, pod_name in expired:
+                print("Pool pod expired:", namespace, pod_name)
+                delete_pod(namespace, pod_name)
+            for key, namespace, template, count in wanted:
+                for i in range(count):
+                    warm_pool_start(key, namespace, template)
+        except Exception as err:
+            print("warm_pool_loop(): failed:", err)
+
+# Images are pinned to their digests when a build is planned, so all of its pipelines run the same images. See images.py.
+# The images used most lately can be kept on every node with a DaemonSet in OPERATOR_NAMESPACE that has an init
+# container for each of them, so a pod on a node that never ran them doesn't wait for a pull either.
+# JETCI_PREPULL_IMAGES is how many images it keeps, 0 turns it off. Only one replica keeps it, the one that owns it
+# on the hash ring, from the builds it planned in the last JETCI_PREPULL_WINDOW seconds.
+GIT_IMAGE = "alpine/git:latest"
+
+PREPULL_IMAGES = int(os.environ.get("JETCI_PREPULL_IMAGES", "0"))
+PREPULL_WINDOW = float(os.environ.get("JETCI_PREPULL_WINDOW", "3600"))
+PREPULL_NAME   = "jetci-prepull"
+PREPULL_SLEEP_IMAGE = os.environ.get("JETCI_PREPULL_SLEEP_IMAGE", "busybox:musl")
+
+# How often the DaemonSet is brought up to date, and how many builds an image needs to be on it.
+PREPULL_INTERVAL  = 60
+PREPULL_MIN_BUILDS = 3
+
+image_digests = images.DigestCache()
+image_counts = images.ImageCounts(PREPULL_WINDOW)
+
+def pin_pipeline_images(pipelines):
+    for pipeline in pipelines:
+        for container in pipeline['containers']:
+            container['image'] = image_digests.pin(container['image'])
+    if PREPULL_IMAGES > 0:
+        image_counts.record(container['image'] for pipeline in pipelines for container in pipeline['containers'])
+
+# Only pinned images go on the DaemonSet, the others can't be pulled ahead of time for the same digest.
+# Every image gets a container of its own, so an image that can't be pulled doesn't hold up the others. They all sleep
+# with a static busybox an init container copies in, images without a shell like distroless ones included.
+def prepull_daemonset(pinned):
+    labels = { MANAGED_BY_LABEL: MANAGED_BY_VALUE, "app.kubernetes.io/name": PREPULL_NAME }
+    requests = { "requests": { "cpu": "1m", "memory": "8Mi" } }
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "DaemonSet",
+        "metadata": { "name": PREPULL_NAME, "labels": labels },
+        "spec": {
+            "selector": { "matchLabels": labels },
+            "template": {
+                "metadata": { "labels": labels },
+                "spec": {
+                    "initContainers": [
+                        {
+                            "name": "copy-sleep",
+                            "image": PREPULL_SLEEP_IMAGE,
+                            "command": [ "/bin/cp", "/bin/busybox", "/prepull/busybox" ],
+                            "volumeMounts": [ { "name": "prepull", "mountPath": "/prepull" } ],
+                            "resources": requests
+                        }
+                    ],
+                    "containers": [
+                        {
+                            "name": "image-" + str(i),
+                            "image": pinned[i],
+                            "imagePullPolicy": "IfNotPresent",
+                            "command": [ "/prepull/busybox", "sleep", "2147483647" ],
+                            "volumeMounts": [ { "name": "prepull", "mountPath": "/prepull", "readOnly": True } ],
+                            "resources": requests
+                        } for i in range(len(pinned))
+                    ],
+                    "volumes": [ { "name": "prepull", "emptyDir": {} } ]
+                }
+            }
+        }
+    }
+
+def prepull_loop():
+    applied = None
+    while True:
+        time.sleep(PREPULL_INTERVAL)
+        try:
+            if shard_owner(OPERATOR_NAMESPACE, PREPULL_NAME) != OPERATOR_IDENTITY:
+                applied = None
+                continue
+            pinned = [ image for image in image_counts.frequent(PREPULL_IMAGES, PREPULL_MIN_BUILDS) if "@" in image ]
+            if len(pinned) == 0 or pinned == applied:
+                continue
+
+            daemonset = prepull_daemonset(pinned)
+            try:
+                client.AppsV1Api(api_client).patch_namespaced_daemon_set(PREPULL_NAME, OPERATOR_NAMESPACE, daemonset, _content_type="application/merge-patch+json")
+            except client.exceptions.ApiException as err:
+                if err.status != 404:
+                    raise
+                client.AppsV1Api(api_client).create_namespaced_daemon_set(OPERATOR_NAMESPACE, daemonset)
+            print("Pre-pulling images:", ", ".join(pinned))
+            applied = pinned
+        except Exception as err:
+            print("prepull_loop(): failed:", err)
+
+# The build watch resumes where it left off instead of replaying every build in the cluster on restart.
+# The last resourceVersion we handled and the unfinished builds we know about are saved to a ConfigMap every
+# CHECKPOINT_INTERVAL seconds. On startup only those builds are read back, however many finished builds exist.
+# When the API server no longer has our resourceVersion (410 Gone) we relist once, in pages, and only handle what changed.
+# Every replica has a checkpoint of its own, named after its identity like its Lease, so replicas don't resume from each other's.
+CHECKPOINT_NAME     = "jetci-operator-checkpoint-" + shard_hash(OPERATOR_IDENTITY).to_bytes(8, 'big').hex()
+CHECKPOINT_INTERVAL = float(os.environ.get("JETCI_CHECKPOINT_INTERVAL", "10"))
+LIST_PAGE_SIZE      = int(os.environ.get("JETCI_LIST_PAGE_SIZE", "500"))
+WATCH_TIMEOUT       = int(os.environ.get("JETCI_WATCH_TIMEOUT", "300"))
+
+checkpoint_state = { 'saved': None, 'time': 0 }
+
+# Saves the checkpoint if it changed and the last save is old enough.
+def save_checkpoint(resource_version):
+    if resource_version == checkpoint_state['saved'] or time.monotonic() - checkpoint_state['time'] < CHECKPOINT_INTERVAL:
+        return
+
+    with shard_locker:
+        unfinished = sorted(tracked_builds.keys())
+
+    config_map = {
+        "metadata": {
+            "name": CHECKPOINT_NAME,
+            "labels": { MANAGED_BY_LABEL: MANAGED_BY_VALUE }
+        },
+        "data": {
+            "resourceVersion": resource_version,
+            "unfinishedBuilds": json.dumps(unfinished)
+        }
+    }
+
+    try:
+        try:
+            client.CoreV1Api(api_client).patch_namespaced_config_map(CHECKPOINT_NAME, OPERATOR_NAMESPACE, config_map)
+        except client.exceptions.ApiException as err:
+            if err.status != 404:
+                raise
+            client.CoreV1Api(api_client).create_namespaced_config_map(OPERATOR_NAMESPACE, config_map)
+    except client.exceptions.ApiException as err:
+        print("save_checkpoint(): Failed to save checkpoint:", err)
+        return
+
+    checkpoint_state['saved'] = resource_version
+    checkpoint_state['time'] = time.monotonic()
+
+# Reads the checkpoint. Returns (resource_version, events) where events are ADDED events for the unfinished builds.
+# resource_version is None when there is no usable checkpoint.
+def load_checkpoint():
+    try:
+        config_map = client.CoreV1Api(api_client).read_namespaced_config_map(CHECKPOINT_NAME, OPERATOR_NAMESPACE)
+    except client.exceptions.ApiException as err:
+        if err.status != 404:
+            print("load_checkpoint(): Failed to read checkpoint:", err)
+        return None, []
+
+    data = config_map.data or {}
+    if data.get("resourceVersion", "") == "":
+        return None, []
+
+    events = []
+    for namespace, build_name in json.loads(data.get("unfinishedBuilds", "[]")):
+        try:
+            build_obj = client.CustomObjectsApi(api_client).get_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "builds", build_name)
+        except client.exceptions.ApiException:
+            continue # Deleted while we weren't looking.
+        events.append({ "type": "ADDED", "object": build_obj })
+
+    print("Resuming build watch from", data["resourceVersion"], "with", len(events), "unfinished builds")
+    return data["resourceVersion"], events
+
+# Lists every build, page by page, and works out what changed compared to what we know.
+# Returns (resource_version, events). Finished builds we never tracked are skipped, there's nothing to do for them.
+def relist_builds():
+    resource_version = None
+    continue_token = None
+    seen = set()
+    events = []
+
+    while True:
+        if continue_token is None:
+            page = client.CustomObjectsApi(api_client).list_cluster_custom_object(API_GROUP, API_VERSION, "builds", limit=LIST_PAGE_SIZE)
+        else:
+            page = client.CustomObjectsApi(api_client).list_cluster_custom_object(API_GROUP, API_VERSION, "builds", limit=LIST_PAGE_SIZE, _continue=continue_token)
+
+        # Every page is from the same snapshot, the first one tells us which.
+        if resource_version is None:
+            resource_version = page['metadata']['resourceVersion']
+
+        for build_obj in page['items']:
+            build_key = (build_obj['metadata']['namespace'], build_obj['metadata']['name'])
+            seen.add(build_key)
+
+            with shard_locker:
+                known = tracked_builds.get(build_key)
+
+            if known is None:
+                if build_obj.get('status') not in FINISHED_BUILD_STATUSES:
+                    events.append({ "type": "ADDED", "object": build_obj })
+            elif known['metadata']['resourceVersion'] != build_obj['metadata']['resourceVersion']:
+                events.append({ "type": "MODIFIED", "object": build_obj })
+
+        continue_token = page['metadata'].get('continue')
+        if not continue_token:
+            break
+
+    # Builds we knew about that are gone were deleted while we weren't watching.
+    with shard_locker:
+        for build_key in list(tracked_builds.keys()):
+            if build_key not in seen:
+                events.append({ "type": "DELETED", "object": tracked_builds[build_key] })
+
+    print("Relisted builds at", resource_version, ":", len(events), "changes")
+    return resource_version, events
+
+# Handles one build event for the threaded engine.
+def handle_build_event(event):
+    if event["type"] == "DELETED":
+        delete_build(event['object'])
+
+    # Someone cancelled a build we're running.
+    if event["type"] != "DELETED" and event['object'].get('status') == "Cancelled" and event['object']['claimedBy'] == OPERATOR_IDENTITY:
+        cancel_local_build(event['object'])
+
+    # Claiming happens in claim_loop(), so a busy operator doesn't take builds it can't run.
+    if observe_build(event["type"], event['object']):
+        queue_claim(event['object'])
 
 # This is the event loop.
 def operator_loop():
-    for event in watch.Watch().stream(client.CustomObjectsApi().list_cluster_custom_object, API_GROUP, API_VERSION, "builds", resource_version=""):
-        if event["type"] == "DELETED":
-            for pod_name in event['object']['pods']:
-                try:
-                    client.CoreV1Api().delete_namespaced_pod(pod_name, event['object']['metadata']['namespace'])
-                except:
-                    continue
+    resource_version, events = load_checkpoint()
+
+    while True:
+        try:
+            if resource_version is None:
+                resource_version, events = relist_builds()
+
+            for event in events:
+                handle_build_event(event)
+            events = []
+            builds_synced.set()
 
-        if event["type"] == "ADDED" and event['object']["claimedBy"] == "":
-            event['object']['claimedBy'] = socket.getfqdn()
+            # Bookmarks move our resourceVersion forward even when no builds change, so it doesn't expire as quickly.
+            for event in watch.Watch().stream(client.CustomObjectsApi(api_client).list_cluster_custom_object, API_GROUP, API_VERSION, "builds", resource_version=resource_version, allow_watch_bookmarks=True, timeout_seconds=WATCH_TIMEOUT):
+                if event["type"] != "BOOKMARK":
+                    handle_build_event(event)
+                resource_version = event['object']['metadata']['resourceVersion']
+                save_checkpoint(resource_version)
+
+        except client.exceptions.ApiException as err:
+            if err.status == 410:
+                print("Build watch expired at", resource_version, ", relisting")
+                resource_version = None
+            else:
+                print("operator_loop(): Build watch failed:", err)
+                time.sleep(1)
+
+# claim_queuer for the threaded engine.
+def queue_claim(build_obj):
+    with scheduler_condition:
+        claim_backlog.append(build_obj)
+        scheduler_condition.notify_all()
+
+
+# The asyncio engine, picked with JETCI_OPERATOR_ENGINE=asyncio.
+# Builds, pipelines, commands and log streams are tasks on one event loop instead of threads, talking to the
+# API server with kubernetes_asyncio. Build writes and the .jetci.yaml work reuse the functions above, they run on
+# the event loop's default executor, which is a small fixed set of threads.
+OPERATOR_ENGINE = os.environ.get("JETCI_OPERATOR_ENGINE", "threads")
+
+# How many pipelines the asyncio engine runs at once.
+ASYNC_MAX_PIPELINES = int(os.environ.get("JETCI_ASYNC_MAX_PIPELINES", "1000"))
+
+# Set up by async_operator_main().
+async_api_client = None
+async_ws_client = None
+async_pod_event = None
+async_scheduler = None
+async_pipeline_slots = None
+
+# Pipelines waiting for a slot, builds waiting to be claimed, and the task of every build we run.
+async_queued_pipelines = 0
+async_claim_backlog = collections.deque()
+async_builds = {}
+
+# Keeps a reference to background tasks so they aren't garbage collected while running.
+async_tasks = set()
+
+def async_spawn(coroutine):
+    task = asyncio.get_running_loop().create_task(coroutine)
+    async_tasks.add(task)
+    task.add_done_callback(async_tasks.discard)
+    return task
+
+# Runs one of the blocking functions above on the executor.
+async def async_call(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+# Same as pod_informer(), it fills the same pod cache, but wakes up async_pod_event waiters.
+async def async_pod_informer():
+    v1 = async_client.CoreV1Api(api_client=async_api_client)
+    label_selector = MANAGED_BY_LABEL + "=" + MANAGED_BY_VALUE
+    backoff = 1
+    while True:
+        try:
+            pods = await v1.list_pod_for_all_namespaces(label_selector=label_selector)
+        except Exception as err:
+            print("async_pod_informer(): Failed to list pods, retrying in", backoff, "seconds:", err)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, POD_INFORMER_MAX_BACKOFF)
+            continue
+        backoff = 1
+
+        pod_cache_replace(pods.items)
+        async with async_pod_event:
+            async_pod_event.notify_all()
+        resource_version = pods.metadata.resource_version
+
+        try:
+            while True:
+                async for event in async_watch.Watch().stream(v1.list_pod_for_all_namespaces, label_selector=label_selector, resource_version=resource_version):
+                    pod_cache_update(event["type"], event["object"])
+                    resource_version = event["object"].metadata.resource_version
+                    async with async_pod_event:
+                        async_pod_event.notify_all()
+        except Exception as err:
+            print("async_pod_informer(): Watch failed, relisting:", err)
+
+async def async_wait_for_pod_ready(namespace, pod_name, timeout=READINESS_TIMEOUT):
+    seen = False
+    deadline = time.monotonic() + timeout
+    async with async_pod_event:
+        while True:
+            with pod_cache_condition:
+                ready, seen = pod_ready_state(namespace, pod_name, seen)
+            if ready is not None:
+                return ready
+            if time.monotonic() >= deadline:
+                print("Pod", pod_name, "wasn't ready after", timeout, "seconds")
+                return False
             try:
-                client.CustomObjectsApi().patch_namespaced_custom_object(API_GROUP, API_VERSION, event['object']['metadata']['namespace'], "builds", event['object']['metadata']['name'], event['object'])
-            except client.exceptions.ApiException:
+                await asyncio.wait_for(async_pod_event.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                # wait_for() gives the lock back before raising, the loop checks one last time.
+                pass
+
+# The tasks following the logs of a pod, (namespace, pod_name) -> set of tasks. A task per container is cheap here,
+# so the asyncio engine doesn't need a cap like LOG_FOLLOWERS.
+async_log_tasks = {}
+
+async def async_container_logging(namespace, build_name, pipeline_name, pod_name, container_name):
+    with log_streams_locker:
+        since = pod_log_since.get((namespace, pod_name))
+
+    task = asyncio.current_task()
+    async_log_tasks.setdefault((namespace, pod_name), set()).add(task)
+    batch = container_log_batch(namespace, build_name, pipeline_name, container_name)
+    try:
+        resp = await async_client.CoreV1Api(api_client=async_api_client).read_namespaced_pod_log(pod_name, namespace, container=container_name, follow=True, timestamps=True, _preload_content=False)
+        async for log_entry in resp.content:
+            timestamp, text = logbatch.split_timestamp(log_entry.decode('utf-8', 'replace'))
+            if since is not None and logged_before(timestamp, since):
                 continue
+            if batch.add(timestamp, text):
+                await async_call(batch.flush)
+    except Exception as err:
+        print("async_container_logging(): Log stream ended:", namespace, pod_name, container_name, ":", err)
+    finally:
+        tasks = async_log_tasks.get((namespace, pod_name), set())
+        tasks.discard(task)
+        if len(tasks) == 0:
+            async_log_tasks.pop((namespace, pod_name), None)
+        await async_call(log_batches.close, batch)
+
+# Ends the log streams of a pod that is still running.
+def async_stop_container_logging(namespace, pod_name):
+    with log_streams_locker:
+        pod_log_since.pop((namespace, pod_name), None)
+    for task in async_log_tasks.pop((namespace, pod_name), set()):
+        task.cancel()
+
+# Same as pod_exec(), but on_output is a coroutine function.
+async def async_pod_exec(namespace, pod_name, container, command, on_output=None, deadline=None):
+    argv = command_argv(command)
+    if argv is None:
+        return unparsable_command(command)
+
+    combinedout = BoundedOutput()
+    error = []
+    exec_start = time.monotonic()
+
+    websocket = await async_client.CoreV1Api(api_client=async_ws_client).connect_get_namespaced_pod_exec(pod_name, namespace, container=container, command=argv, stderr=True, stdin=False, stdout=True, tty=False, _preload_content=False)
+
+    async def read_messages():
+        async with websocket as ws:
+            async for message in ws:
+                # The first byte of every message is the channel it belongs to.
+                if len(message.data) < 2:
+                    continue
+                channel = message.data[0]
+                data = message.data[1:].decode('utf-8', 'replace')
 
-            print("Claimed build:", event['object']['claimedBy'], ":", event['object']['metadata']['namespace'], event['object']['metadata']['name'])
+                if channel == STDOUT_CHANNEL or channel == STDERR_CHANNEL:
+                    combinedout.write(data)
+                    if on_output is not None:
+                        await on_output(data)
+                elif channel == ERROR_CHANNEL:
+                    error.append(data)
 
-            # Load the repo configuration
-            repo = get_repo(event['object']['metadata']['namespace'], event['object']['spec']['repository'])
+    timed_out = False
+    try:
+        await asyncio.wait_for(read_messages(), None if deadline is None else max(0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        timed_out = True
+
+    if timed_out:
+        print("async_pod_exec(): timed out:", namespace, pod_name, container, command)
+        combinedout.write("\nTimed out.\n")
+        status = -1
+    else:
+        status = exec_returncode("".join(error))
+    EXEC_SECONDS.observe(time.monotonic() - exec_start, "success" if status == 0 else "failed")
 
-            # Get the contents of .jetci.yaml
-            jetci_obj = get_jetci_yaml(repo['metadata']['namespace'], repo)
+    return {
+        'output': combinedout.getvalue(),
+        'status': status,
+        'timedOut': timed_out,
+        'truncated': combinedout.dropped > 0
+    }
+
+# Same as CommandAgent, over the asyncio websocket. Made with async_start_command_agent().
+class AsyncCommandAgent:
+    def __init__(self):
+        self.token = secrets.token_hex(16)
+        self.stream = agent.AgentStream(self.token)
+        self.batches = itertools.count()
+        self.ids = itertools.count()
+        self.broken = False
+        self.websocket = None
+        self.ws = None
+
+    async def start(self, namespace, pod_name, container):
+        self.websocket = await async_client.CoreV1Api(api_client=async_ws_client).connect_get_namespaced_pod_exec(pod_name, namespace, container=container, command=agent.agent_command(self.token), stderr=True, stdin=True, stdout=True, tty=False, _preload_content=False)
+        self.ws = await self.websocket.__aenter__()
+        deadline = time.monotonic() + AGENT_START_TIMEOUT
+        while ("ready",) not in await self.read(deadline):
+            if time.monotonic() >= deadline:
+                raise AgentError("not ready after " + str(AGENT_START_TIMEOUT) + " seconds")
+
+    # Waits for the next message until deadline. Raises AgentError once the agent is gone.
+    async def read(self, deadline=None):
+        try:
+            message = await asyncio.wait_for(self.ws.receive(), None if deadline is None else max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            return []
+
+        # Close and error messages don't carry bytes.
+        if not isinstance(message.data, bytes):
+            raise AgentError("the agent exited")
+        if len(message.data) < 2:
+            return []
+
+        channel = message.data[0]
+        data = message.data[1:].decode('utf-8', 'replace')
+        if channel == STDOUT_CHANNEL:
+            return self.stream.feed(data)
+        if channel == STDERR_CHANNEL:
+            print("Command agent:", data.strip())
+        elif channel == ERROR_CHANNEL:
+            raise AgentError(data)
+        return []
+
+    # Like CommandAgent.run(), on_output is a coroutine function.
+    async def run(self, commands, on_output=None, deadline=None):
+        batch = next(self.batches)
+        ids = [ str(next(self.ids)) for command in commands ]
+        lines = "".join(agent.command_line(batch, ids[i], command_argv(commands[i])) for i in range(len(commands)))
+        try:
+            await self.ws.send_bytes(bytes([ STDIN_CHANNEL ]) + lines.encode("utf-8"))
+        except Exception as err:
+            print("Command agent went away:", err)
+            await self.close()
+            return []
+
+        results = []
+        combinedout = BoundedOutput()
+        exec_start = time.monotonic()
+        while len(results) < len(commands):
+            if deadline is not None and time.monotonic() >= deadline:
+                print("Command agent: timed out:", commands[len(results)])
+                combinedout.write("\nTimed out.\n")
+                results.append({ 'output': combinedout.getvalue(), 'status': -1, 'timedOut': True })
+                await self.close()
+                break
+
+            try:
+                events = await self.read(deadline)
+            except Exception as err:
+                print("Command agent went away:", err)
+                combinedout.write("\nThe command agent went away.\n")
+                results.append({ 'output': combinedout.getvalue(), 'status': -1, 'timedOut': False })
+                await self.close()
+                break
+
+            for event in events:
+                if event[0] == "output":
+                    combinedout.write(event[1])
+                    if on_output is not None:
+                        await on_output(len(results), event[1])
+                elif event[0] == "end" and event[1] == ids[len(results)]:
+                    status = int(event[2])
+                    EXEC_SECONDS.observe(time.monotonic() - exec_start, "success" if status == 0 else "failed")
+                    results.append({ 'output': combinedout.getvalue(), 'status': status, 'timedOut': False })
+                    combinedout = BoundedOutput()
+                    exec_start = time.monotonic()
+                    if status != 0:
+                        return results
+        return results
+
+    async def close(self):
+        self.broken = True
+        try:
+            await self.websocket.__aexit__(None, None, None)
+        except Exception:
+            pass
+
+async def async_start_command_agent(namespace, pod_name, container):
+    command_agent = AsyncCommandAgent()
+    try:
+        await command_agent.start(namespace, pod_name, container)
+        return command_agent
+    except Exception as err:
+        print("Command agent didn't start, exec'ing commands instead:", namespace, pod_name, container, ":", err)
+        if command_agent.websocket is not None:
+            await command_agent.close()
+        return None
+
+# Like run_commands().
+async def async_run_commands(namespace, pod_name, container, commands, on_output, deadline, command_agent=None):
+    results = []
+    while len(results) < len(commands) and (len(results) == 0 or results[-1]['status'] == 0):
+        i = len(results)
+        if command_agent is not None and not command_agent.broken and command_argv(commands[i]) is not None:
+            batch = []
+            for command in commands[i:]:
+                if command_argv(command) is None:
+                    break
+                batch.append(command)
+            results += await command_agent.run(batch, lambda j, output: on_output(i + j, output), deadline)
+        else:
+            results.append(await async_pod_exec(namespace, pod_name, container, commands[i], on_output=lambda output: on_output(i, output), deadline=deadline))
+    return results
+
+async def async_execute_pipeline(namespace, build_name, pipeline_specification, repo_name=None):
+    v1 = async_client.CoreV1Api(api_client=async_api_client)
+
+    # Generate the pod name
+    pod_name = build_name +  "-" + pipeline_specification['name'] + "-" + secrets.token_hex(4) # Max length is 253 characters
+    pod_info = pipeline_pod(pipeline_specification, pod_name)
+
+    # Same as execute_pipeline(), the pool only makes a few short API calls, so it runs in the thread pool.
+    pod_start = time.monotonic()
+    pool_key = None
+    pod_source = "new"
+    pod_created = pod_start
+    if warmpool.WARM_POOL_SIZE > 0:
+        pool_key = warm_pool_pod_info(namespace, repo_name, pod_info)
+        claimed = await async_call(warm_pool_claim, namespace, pool_key, pod_info, build_name, pipeline_specification['name'])
+        if claimed is not None:
+            pod_name, pod_created = claimed
+            pod_source = "pool"
+
+    # Add this pod to the build
+    await async_call(add_pod_to_build, namespace, build_name, pod_name)
+
+    # Create the pod in kubernetes
+    if pod_source == "new":
+        try:
+            await v1.create_namespaced_pod(namespace, pod_info)
+        except async_client.exceptions.ApiException as err:
+            print("Failed to create pod:", pod_name, ":", err)
+            if pool_key is not None:
+                warm_pools.released(pool_key)
+            return False
+
+    # The pod goes away however the pipeline ends, cancelled builds included, or back to the pool when it succeeded.
+    succeeded = False
+    try:
+        succeeded = await async_run_pipeline_pod(namespace, build_name, pipeline_specification, pod_name, pod_start, pod_source)
+        return succeeded
+    finally:
+        if pool_key is None:
+            await async_call(delete_pod, namespace, pod_name)
+        else:
+            async_stop_container_logging(namespace, pod_name)
+            await async_call(warm_pool_release, namespace, pool_key, pod_name, pod_created, succeeded and not build_cancelled(namespace, build_name))
+
+# Like run_pipeline_pod().
+async def async_run_pipeline_pod(namespace, build_name, pipeline_specification, pod_name, pod_start, pod_source="new"):
+    # Wait for pod to be ready
+    if not await async_wait_for_pod_ready(namespace, pod_name, pipeline_specification.get('readinessTimeout', READINESS_TIMEOUT)):
+        await async_call(build_log, namespace, build_name, pipeline_specification['name'], "", "@jetci-readiness", "The pod wasn't ready in time", "failed")
+        return False
+    if pod_source == "new":
+        POD_READY_SECONDS.observe(time.monotonic() - pod_start)
+    POD_CLAIM_SECONDS.observe(time.monotonic() - pod_start, pod_source)
 
-            if jetci_obj == False:
-                print("get_jetci_yaml() returned false.")
-                build_log(event['object']['metadata']['namespace'], event['object']['metadata']['name'], '@jetci', '@jetci', "@jetci-log", "Failed to pull .jetci.yaml", "failed")
-                set_build_status(event['object']['metadata']['namespace'], event['object']['metadata']['name'], "Failed")
+    deadline = time.monotonic() + pipeline_specification.get('pipelineTimeout', PIPELINE_TIMEOUT)
 
+    # Pod is ready, run commands in the containers. Each container is a task that waits for the containers it needs.
+    done = { container_specification['name']: asyncio.get_running_loop().create_future() for container_specification in pipeline_specification['containers'] }
+
+    async def run_container(container_specification):
+        succeeded = False
+        try:
+            needs = [ await done[need] for need in container_specification.get('needs', []) ]
+            if all(needs):
+                succeeded = await async_run_container_commands(namespace, build_name, pipeline_specification['name'], pod_name, container_specification, pipeline_specification.get('commit'), deadline)
             else:
-                # TODO: Need to lint.
-                try:
-                    jetci_obj = yaml.safe_load(jetci_obj)
-                except:
-                    print("Error loading contents from .jetci.yaml")
-                    set_build_status(event['object']['metadata']['namespace'], event['object']['metadata']['name'], "Failed")
+                await async_call(build_log, namespace, build_name, pipeline_specification['name'], container_specification['name'], "@jetci-needs", "A container this one needs failed", "cancelled")
+        finally:
+            done[container_specification['name']].set_result(succeeded)
+        return succeeded
+
+    results = await asyncio.gather(*[ run_container(container_specification) for container_specification in pipeline_specification['containers'] ])
+    return all(results)
+
+# Like run_container_commands().
+async def async_run_container_commands(namespace, build_name, pipeline_name, pod_name, container_specification, commit=None, deadline=None):
+    # capture container output
+    async_spawn(async_container_logging(namespace, build_name, pipeline_name, pod_name, container_specification['name']))
+
+    steps = [ stepcache.parse_step(step) for step in container_specification.get('commands', []) ]
+    command_agent = None
+    agent_tried = False
+    try:
+        i = 0
+        while i < len(steps):
+            command, cache_options = steps[i]
+
+            # The step cache only does a few short execs, so it runs in the thread pool.
+            step_key = None
+            if cache_options is not None:
+                step_key = await async_call(step_cache_key, namespace, pod_name, container_specification['name'], commit, cache_options, command)
+                record = await async_call(step_cache_restore, namespace, pod_name, container_specification['name'], step_key, cache_options)
+                if record is not None:
+                    await async_call(build_log, namespace, build_name, pipeline_name, container_specification['name'], command, STEP_CACHE_NOTE + record['output'], record['status'])
+                    i += 1
                     continue
 
-                # Pipeline convenience doctor
-                for i in range(len(jetci_obj['pipelines'])):
-                    # Ensure that volumes is set.
-                    if 'volumes' not in jetci_obj['pipelines'][i]:
-                        jetci_obj['pipelines'][i]['volumes'] = []
-
-                    # Build the repo cloning pod
-                    clone_git_repository = {
-                        "name": "clone-git-repository",
-                        "image": "alpine/git:latest",
-                        "entrypoint": [ "/bin/sh", "-c", "sleep 86000s" ],
-                        "env":[
-                            { "name": "GIT_SSH_COMMAND", "value": "ssh -o StrictHostKeyChecking=no" }
-                        ],
-                        "commands":
-                            [
-                                "git init",
-                                "git remote add origin -f " + repo['spec']["repoPath"],
-                                "git checkout origin/" + repo['spec']["repoBranch"] + " -- README.md"
-                            ],
-                    }
+            # Commands up to the next cached one are sent to the agent together.
+            batch = [ command ]
+            if cache_options is None:
+                while i + len(batch) < len(steps) and steps[i + len(batch)][1] is None:
+                    batch.append(steps[i + len(batch)][0])
+            i += len(batch)
+
+            if EXEC_MODE == "agent" and not agent_tried:
+                agent_tried = True
+                command_agent = await async_start_command_agent(namespace, pod_name, container_specification['name'])
+
+            # Output is sent to the build log in batches while the commands run, see command_log_batch().
+            output_batches = {}
+            async def log_output(j, output, batch=batch, output_batches=output_batches):
+                if j not in output_batches:
+                    for previous in output_batches.values():
+                        await async_call(log_batches.close, previous)
+                    output_batches[j] = command_log_batch(namespace, build_name, pipeline_name, container_specification['name'], batch[j])
+                if output_batches[j].add(None, output):
+                    await async_call(output_batches[j].flush)
+
+            try:
+                results = await async_run_commands(namespace, pod_name, container_specification['name'], batch, log_output, deadline, command_agent)
+            finally:
+                for output_batch in output_batches.values():
+                    await async_call(log_batches.close, output_batch)
+
+            for command, res in zip(batch, results):
+                # Human readable status.
+                if res['status'] == 0:
+                    status = 'success'
+                elif res.get('timedOut'):
+                    status = 'timeout'
+                else:
+                    status = 'failed'
+
+                # Update the build log. The output is already in there.
+                entry_status = await async_call(build_log, namespace, build_name, pipeline_name, container_specification['name'], command, "", status)
+                if entry_status == False:
+                    print("Unable to update build:", namespace, build_name)
+                    print("Stopping container", pipeline_name, container_specification['name'])
+                    return False
+
+                # Stop this container if it failed.
+                if res['status'] != 0:
+                    return False
+
+                if step_key is not None:
+                    await async_call(step_cache_save, namespace, pod_name, container_specification['name'], step_key, cache_options, command, res)
+
+        return True
+    finally:
+        if command_agent is not None:
+            await command_agent.close()
+
+# Runs a whole build: claim, pipelines, then waits for its pods to go away.
+async def async_run_build(build_obj):
+    global async_queued_pipelines
+    namespace = build_obj['metadata']['namespace']
+    build_name = build_obj['metadata']['name']
+
+    planned = await async_call(plan_build, build_obj)
+    if planned == False:
+        return
+    repo, pipelines = planned
+
+    # Pipelines wait for the pipelines they need, done holds how each one went.
+    started = False
+    done = { pipeline['name']: asyncio.get_running_loop().create_future() for pipeline in pipelines }
+
+    async def run_pipeline(pipeline):
+        succeeded = False
+        try:
+            needs = [ await done[need] for need in pipeline.get('needs', []) ]
+            if all(needs):
+                succeeded = await run_pipeline_in_slot(pipeline)
+            else:
+                print("Cancelling pipeline:", namespace, build_name, pipeline['name'], ": a pipeline it needs failed")
+                await async_call(build_log, namespace, build_name, pipeline['name'], "", "@jetci-needs", "A pipeline this one needs failed", "cancelled")
+        finally:
+            if not done[pipeline['name']].done():
+                done[pipeline['name']].set_result(succeeded)
+
+    async def run_pipeline_in_slot(pipeline):
+        global async_queued_pipelines
+        nonlocal started
+
+        async with async_scheduler:
+            async_queued_pipelines += 1
+        try:
+            await async_pipeline_slots.acquire()
+        finally:
+            async with async_scheduler:
+                async_queued_pipelines -= 1
+                async_scheduler.notify_all()
+
+        try:
+            if not started:
+                started = True
+                await async_call(set_build_status, namespace, build_name, "Running")
+            return await async_execute_pipeline(namespace, build_name, pipeline, repo['metadata']['name']) == True
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            print("Pipeline crashed:", namespace, build_name, pipeline['name'], ":", err)
+            return False
+        finally:
+            async_pipeline_slots.release()
+
+    await asyncio.gather(*[ run_pipeline(pipeline) for pipeline in pipelines ])
+
+    # Pods of failed pipelines may still be around.
+    async with async_pod_event:
+        while True:
+            with pod_cache_condition:
+                if build_pods_remaining(namespace, build_name) == 0:
+                    break
+            await async_pod_event.wait()
+
+    await async_call(set_build_status, namespace, build_name, "Complete")
+
+def async_build_done(build_key):
+    async_builds.pop(build_key, None)
+    end_build_work(build_key)
+
+# Claims builds from the backlog while there's room, like claim_loop().
+async def async_claim_loop():
+    while True:
+        async with async_scheduler:
+            while len(async_claim_backlog) == 0 or async_queued_pipelines >= MAX_QUEUED_PIPELINES:
+                await async_scheduler.wait()
+            build_obj = async_claim_backlog.popleft()
+
+        build_key = (build_obj['metadata']['namespace'], build_obj['metadata']['name'])
+        start_build_work(build_key)
+        async_builds[build_key] = async_spawn(async_run_build(build_obj))
+        async_builds[build_key].add_done_callback(lambda task, build_key=build_key: async_build_done(build_key))
+
+        # Give the build a chance to queue its pipelines before looking at the queue again.
+        await asyncio.sleep(0)
+
+async def async_handle_build_event(event):
+    build_key = (event['object']['metadata']['namespace'], event['object']['metadata']['name'])
+
+    if event["type"] == "DELETED":
+        async with async_scheduler:
+            for i in range(len(async_claim_backlog) - 1, -1, -1):
+                if (async_claim_backlog[i]['metadata']['namespace'], async_claim_backlog[i]['metadata']['name']) == build_key:
+                    del async_claim_backlog[i]
+        if build_key in async_builds:
+            async_builds[build_key].cancel()
+        await async_call(delete_build, event['object'])
+
+    if event["type"] != "DELETED" and event['object'].get('status') == "Cancelled" and event['object']['claimedBy'] == OPERATOR_IDENTITY:
+        if build_key in async_builds:
+            async_builds[build_key].cancel()
+        await async_call(cancel_local_build, event['object'])
+
+    if observe_build(event["type"], event['object']):
+        await async_queue_claim(event['object'])
+
+# Same as operator_loop(), checkpoints and relists use the blocking functions on the executor.
+async def async_operator_loop():
+    api = async_client.CustomObjectsApi(api_client=async_api_client)
+    resource_version, events = await async_call(load_checkpoint)
+
+    while True:
+        try:
+            if resource_version is None:
+                resource_version, events = await async_call(relist_builds)
+
+            for event in events:
+                await async_handle_build_event(event)
+            events = []
+            builds_synced.set()
+
+            async for event in async_watch.Watch().stream(api.list_cluster_custom_object, API_GROUP, API_VERSION, "builds", resource_version=resource_version, allow_watch_bookmarks=True, timeout_seconds=WATCH_TIMEOUT):
+                if event["type"] != "BOOKMARK":
+                    await async_handle_build_event(event)
+                resource_version = event['object']['metadata']['resourceVersion']
+                if resource_version != checkpoint_state['saved'] and time.monotonic() - checkpoint_state['time'] >= CHECKPOINT_INTERVAL:
+                    await async_call(save_checkpoint, resource_version)
+
+        except (client.exceptions.ApiException, async_client.exceptions.ApiException) as err:
+            if err.status == 410:
+                print("Build watch expired at", resource_version, ", relisting")
+                resource_version = None
+            else:
+                print("async_operator_loop(): Build watch failed:", err)
+                await asyncio.sleep(1)
+
+async def async_queue_claim(build_obj):
+    async with async_scheduler:
+        async_claim_backlog.append(build_obj)
+        async_scheduler.notify_all()
 
-                    # Inject repo ssh-key mount data into the pipeline
-                    if repo['spec']['authType'] == "ssh":
-                        jetci_obj['pipelines'][i]['volumes'].append({
-                                    "name": "git-ssh-key",
-                                    "secret": {
-                                        "secretName": repo['spec']['sshKey']['secretName'],
-                                        "defaultMode": yaml.safe_load('0400') # TODO: 0400 becomes 256 in yaml? There's probably a data type for this.
-                                    },
-                                })
-
-                        clone_git_repository['volumeMounts'] = [
-                            {
-                                "name": "git-ssh-key",
-                                "mountPath": "/root/.ssh/id_rsa",
-                                "subPath": repo['spec']['sshKey']['secretKeyPath'],
-                                "readOnly": True,
-                            }
-                        ]
-
-                    # Inject the clone-git-repository pod into the pipeline.
-                    jetci_obj['pipelines'][i]['containers'].insert(0, clone_git_repository)
-
-                # Run the pipelines.
-                execute_pipelines(event['object']['metadata']['namespace'], event['object']['metadata']['name'], jetci_obj['pipelines'])
-
-operator_loop()
+async def async_operator_main():
+    global async_api_client, async_ws_client, async_pod_event, async_scheduler, async_pipeline_slots, claim_queuer
+
+    try:
+        await async_config.load_kube_config()
+    except:
+        # Same as for the threaded engine, we can't rely on any particular exception type here.
+        async_config.load_incluster_config()
+
+    async_configuration = async_client.Configuration.get_default_copy()
+    async_configuration.connection_pool_maxsize = API_POOL_SIZE
+    async_api_client = async_client.ApiClient(configuration=async_configuration)
+    async_ws_client = WsApiClient(configuration=async_configuration)
+    async_pod_event = asyncio.Condition()
+    async_scheduler = asyncio.Condition()
+    async_pipeline_slots = asyncio.Semaphore(ASYNC_MAX_PIPELINES)
+
+    # Hand offs come from the membership thread.
+    loop = asyncio.get_running_loop()
+    claim_queuer = lambda build_obj: asyncio.run_coroutine_threadsafe(async_queue_claim(build_obj), loop)
+    threading.Thread(target=membership_loop, daemon=True).start()
+    await async_call(membership_ready.wait)
+
+    async_spawn(async_pod_informer())
+    async_spawn(async_claim_loop())
+    if REAPER_INTERVAL > 0:
+        threading.Thread(target=reaper_loop, daemon=True).start()
+    if warmpool.WARM_POOL_SIZE > 0:
+        threading.Thread(target=warm_pool_loop, daemon=True).start()
+    if PREPULL_IMAGES > 0:
+        threading.Thread(target=prepull_loop, daemon=True).start()
+    await async_operator_loop()
+
+
+# Gauges are read when /metrics is scraped, the hot paths don't pay for them.
+metrics.Callback("jetci_active_builds", "Builds this replica claimed and hasn't finished.", lambda: len(active_builds))
+metrics.Callback("jetci_threads", "Threads running in the operator.", threading.active_count)
+metrics.Callback("jetci_queued_pipelines", "Pipelines waiting for a worker.", lambda: async_queued_pipelines if OPERATOR_ENGINE == "asyncio" else len(pipeline_queue))
+metrics.Callback("jetci_claim_backlog", "Builds waiting to be claimed.", lambda: len(async_claim_backlog) if OPERATOR_ENGINE == "asyncio" else len(claim_backlog))
+metrics.Callback("jetci_jetci_yaml_cache_hits_total", ".jetci.yaml cache hits.", lambda: jetci_cache_stats['hits'], metric_type="counter")
+metrics.Callback("jetci_jetci_yaml_cache_misses_total", ".jetci.yaml cache misses.", lambda: jetci_cache_stats['misses'], metric_type="counter")
+metrics.Callback("jetci_step_cache_hits_total", "Cached steps that were replayed.", lambda: stepcache.step_cache.stats['hits'] if stepcache.step_cache else 0, metric_type="counter")
+metrics.Callback("jetci_step_cache_misses_total", "Cached steps that had to run.", lambda: stepcache.step_cache.stats['misses'] if stepcache.step_cache else 0, metric_type="counter")
+metrics.Callback("jetci_step_cache_evictions_total", "Steps evicted from the step cache.", lambda: stepcache.step_cache.stats['evictions'] if stepcache.step_cache else 0, metric_type="counter")
+metrics.Callback("jetci_step_cache_bytes", "Size of the cached step records and outputs.", lambda: stepcache.step_cache.bytes if stepcache.step_cache else 0)
+metrics.Callback("jetci_log_buffers", "Builds with a live log buffer.", lambda: log_buffers.stats()[0])
+metrics.Callback("jetci_log_buffer_bytes", "Bytes held by the live log buffers.", lambda: log_buffers.stats()[1])
+metrics.Callback("jetci_log_batch_lines", "Container log lines waiting to be written to build logs.", log_batches.pending)
+metrics.Callback("jetci_warm_pool_hits_total", "Pipelines that got a pod from the warm pool.", lambda: warm_pools.stats['hits'], metric_type="counter")
+metrics.Callback("jetci_warm_pool_misses_total", "Pipelines that had to make a pod with the warm pool on.", lambda: warm_pools.stats['misses'], metric_type="counter")
+metrics.Callback("jetci_warm_pool_idle_pods", "Idle pods in the warm pools.", warm_pools.idle_pods)
+metrics.Callback("jetci_image_digest_hits_total", "Images pinned with a digest from the cache.", lambda: image_digests.stats['hits'], metric_type="counter")
+metrics.Callback("jetci_image_digest_misses_total", "Images whose digest had to be looked up.", lambda: image_digests.stats['misses'], metric_type="counter")
+metrics.Callback("jetci_image_digest_failures_total", "Digest look ups that failed.", lambda: image_digests.stats['failures'], metric_type="counter")
+metrics.start_server()
+logstream.start_server(log_buffers, log_store)
+log_batches.start()
+
+if OPERATOR_ENGINE == "asyncio":
+    if async_client is None:
+        raise SystemExit("JETCI_OPERATOR_ENGINE=asyncio needs kubernetes_asyncio installed")
+    asyncio.run(async_operator_main())
+
+else:
+    threading.Thread(target=pod_informer, daemon=True).start()
+    threading.Thread(target=build_monitor, daemon=True).start()
+    threading.Thread(target=claim_loop, daemon=True).start()
+    for i in range(PIPELINE_WORKERS):
+        threading.Thread(target=pipeline_worker, daemon=True).start()
+    if REAPER_INTERVAL > 0:
+        threading.Thread(target=reaper_loop, daemon=True).start()
+    if warmpool.WARM_POOL_SIZE > 0:
+        threading.Thread(target=warm_pool_loop, daemon=True).start()
+    if PREPULL_IMAGES > 0:
+        threading.Thread(target=prepull_loop, daemon=True).start()
+
+    claim_queuer = queue_claim
+    threading.Thread(target=membership_loop, daemon=True).start()
+    membership_ready.wait()
+    operator_loop()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# Code shared by operator.py and endpoint.py.
+#
+# Both talk to the API server through the one ApiClient in here, so connections are pooled and kept alive
+# instead of every call making its own client. Every request made through it is rate limited, retried with
+# jittered backoff when the API server is busy, and counted per verb and resource. Exec, which goes over a
+# websocket, is rate limited and counted too, see exec_stream().
+#
+# Settings:
+#   JETCI_API_POOL_SIZE       - connections kept open to the API server.
+#   JETCI_API_QPS             - requests per second allowed on average, 0 turns off rate limiting.
+#   JETCI_API_BURST           - requests allowed at once before QPS kicks in.
+#   JETCI_API_RETRIES         - how often a request is retried on 429, or on 5xx and network errors for reads.
+#   JETCI_API_STATS_INTERVAL  - seconds between printing the call counters, 0 turns it off.
+from kubernetes import client, config
+from kubernetes.stream import stream
+from urllib.parse import urlparse, parse_qs
+import urllib3
+import os
+import time
+import random
+import threading
+import metrics
+
+# API Information for custom resources
+API_VERSION = "v1alpha1"
+API_GROUP   = "future.jetci.xyz"
+
+API_POOL_SIZE      = int(os.environ.get("JETCI_API_POOL_SIZE", "32"))
+API_QPS            = float(os.environ.get("JETCI_API_QPS", "50"))
+API_BURST          = int(os.environ.get("JETCI_API_BURST", "100"))
+API_RETRIES        = int(os.environ.get("JETCI_API_RETRIES", "5"))
+API_STATS_INTERVAL = float(os.environ.get("JETCI_API_STATS_INTERVAL", "300"))
+
+# Upper bounds of the latency histogram buckets, in seconds.
+API_LATENCY_BUCKETS = [ 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10 ]
+
+try:
+    config.load_kube_config()
+except:
+    # load_kube_config throws if there is no config, but does not document what it throws, so I can't rely on any particular type here
+    config.load_incluster_config()
+
+
+# Token bucket. acquire() blocks until a request may go out.
+class RateLimiter:
+    def __init__(self, qps, burst):
+        self.qps = qps
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.locker = threading.Lock()
+
+    def acquire(self):
+        if self.qps <= 0:
+            return
+
+        with self.locker:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.qps)
+            self.last = now
+
+            # Taking a token we don't have yet reserves it, we wait until it would have been there.
+            self.tokens -= 1
+            wait = -self.tokens / self.qps if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+api_rate_limiter = RateLimiter(API_QPS, API_BURST)
+
+# Call counters, (verb, resource) -> { count, errors, retries, seconds, buckets }. Buckets are cumulative, like Prometheus.
+api_call_stats = {}
+api_call_stats_locker = threading.Lock()
+
+def api_stats():
+    with api_call_stats_locker:
+        return { key: dict(stats, buckets=list(stats['buckets'])) for key, stats in api_call_stats.items() }
+
+def record_api_call(verb, resource, seconds, failed, retried):
+    with api_call_stats_locker:
+        if (verb, resource) not in api_call_stats:
+            api_call_stats[(verb, resource)] = { 'count': 0, 'errors': 0, 'retries': 0, 'seconds': 0.0, 'buckets': [0] * len(API_LATENCY_BUCKETS) }
+        stats = api_call_stats[(verb, resource)]
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        if failed:
+            stats['errors'] += 1
+        if retried:
+            stats['retries'] += 1
+        for i in range(len(API_LATENCY_BUCKETS)):
+            if seconds <= API_LATENCY_BUCKETS[i]:
+                stats['buckets'][i] += 1
+
+# The part of a request path after the API group and namespace, like ["pods", "{name}", "log"].
+def api_path_parts(url):
+    parts = [ part for part in urlparse(url).path.split('/') if part != '' ]
+
+    # /api/{version}/... and /apis/{group}/{version}/...
+    if len(parts) > 0 and parts[0] == "api":
+        parts = parts[2:]
+    else:
+        parts = parts[3:]
+
+    if len(parts) > 2 and parts[0] == "namespaces":
+        parts = parts[2:]
+    return parts
+
+# Works out the resource of a request, like "pods", "pods/log" or "builds".
+def api_resource(url):
+    parts = api_path_parts(url)
+    if len(parts) == 0:
+        return ""
+    if len(parts) > 2:
+        return parts[0] + "/" + parts[2]
+    return parts[0]
+
+# Works out the verb of a request, like kubectl names them.
+def api_verb(method, url, query_params):
+    if method == "GET":
+        if parse_qs(urlparse(url).query).get("watch", [""])[0] == "true" or ("watch", True) in (query_params or []):
+            return "watch"
+        return "get" if len(api_path_parts(url)) > 1 else "list"
+
+    return { "POST": "create", "PUT": "update", "PATCH": "patch", "DELETE": "delete" }.get(method, method.lower())
+
+# Wraps the request function of the ApiClient's REST client.
+def instrument_request(request):
+    def instrumented_request(method, url, *args, **kwargs):
+        verb = api_verb(method, url, kwargs.get('query_params'))
+        resource = api_resource(url)
+        attempt = 0
+
+        while True:
+            api_rate_limiter.acquire()
+            start = time.monotonic()
+            resp = None
+            error = None
+
+            # Depending on the version of the client, a failed request raises here or later on.
+            # Requests that never got an answer, like when the connection broke, have no status.
+            try:
+                resp = request(method, url, *args, **kwargs)
+                status = resp.status
+            except client.exceptions.ApiException as err:
+                error = err
+                status = err.status
+            except urllib3.exceptions.HTTPError as err:
+                error = err
+                status = None
+
+            # Busy API servers ask us to back off. Server and network errors are only retried for reads, a write may
+            # have gone through.
+            retry = attempt < API_RETRIES and (status == 429 or ((status is None or status in [500, 502, 503, 504]) and method in ["GET", "HEAD"]))
+            record_api_call(verb, resource, time.monotonic() - start, status is None or not 200 <= status <= 299, retry)
+
+            if not retry:
+                if error is not None:
+                    raise error
+                return resp
+
+            # Give the connection back to the pool before trying again.
+            if resp is not None and hasattr(getattr(resp, 'response', resp), 'release_conn'):
+                getattr(resp, 'response', resp).release_conn()
+
+            attempt += 1
+            time.sleep(random.uniform(0, min(30, 0.1 * (2 ** attempt))))
+
+    return instrumented_request
+
+api_configuration = client.Configuration.get_default_copy()
+api_configuration.connection_pool_maxsize = API_POOL_SIZE
+
+def new_api_client():
+    new_client = client.ApiClient(api_configuration)
+    new_client.rest_client.request = instrument_request(new_client.rest_client.request)
+    return new_client
+
+# The ApiClient to use for everything, except exec. stream() swaps out methods of the ApiClient it is given
+# while it runs, so exec calls need a client of their own, see exec_stream().
+api_client = new_api_client()
+
+# Exec clients, one per thread since a thread only runs one stream() at a time. Websockets don't use the
+# connection pool, so they're only kept to not make a client for every exec.
+exec_clients = threading.local()
+
+# Starts an exec in a pod, like stream(client.CoreV1Api(...).connect_get_namespaced_pod_exec, ...). Exec goes over a
+# websocket past the request() of the REST client, so it is rate limited and counted here instead.
+def exec_stream(pod_name, namespace, **kwargs):
+    if getattr(exec_clients, 'client', None) is None:
+        exec_clients.client = client.ApiClient(api_configuration)
+
+    api_rate_limiter.acquire()
+    start = time.monotonic()
+    failed = True
+    try:
+        resp = stream(client.CoreV1Api(exec_clients.client).connect_get_namespaced_pod_exec, pod_name, namespace, **kwargs)
+        failed = False
+        return resp
+    finally:
+        record_api_call("create", "pods/exec", time.monotonic() - start, failed, False)
+
+def api_stats_logger():
+    while True:
+        time.sleep(API_STATS_INTERVAL)
+        for (verb, resource), stats in sorted(api_stats().items()):
+            print("API calls:", verb, resource, ": count", stats['count'], "errors", stats['errors'], "retries", stats['retries'], "avg", round(stats['seconds'] / stats['count'], 4), "s")
+
+if API_STATS_INTERVAL > 0:
+    threading.Thread(target=api_stats_logger, daemon=True).start()
+
+metrics.Callback("jetci_api_requests_total", "Requests made to the API server.", lambda: { key: stats['count'] for key, stats in api_stats().items() }, labels=("verb", "resource"), metric_type="counter")
+metrics.Callback("jetci_api_request_errors_total", "Requests to the API server that failed.", lambda: { key: stats['errors'] for key, stats in api_stats().items() }, labels=("verb", "resource"), metric_type="counter")
+metrics.Callback("jetci_api_request_retries_total", "Requests to the API server that were retried.", lambda: { key: stats['retries'] for key, stats in api_stats().items() }, labels=("verb", "resource"), metric_type="counter")
+metrics.HistogramCallback("jetci_api_request_seconds", "Time API server requests took.", lambda: { key: (stats['buckets'], stats['count'], stats['seconds']) for key, stats in api_stats().items() }, labels=("verb", "resource"), buckets=API_LATENCY_BUCKETS)
+
+
+def get_repo(namespace, reponame):
+    try:
+        repo = client.CustomObjectsApi(api_client).get_namespaced_custom_object(API_GROUP, API_VERSION, namespace, "repositories", reponame)
+    except:
+        print("repo not found:", namespace, reponame)
+        return False
+    return repo
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# Step result cache for the operator.
+#
+# Commands that give the same result for the same inputs, like dependency installs and code generation, can
+# opt in to being cached in .jetci.yaml:
+#
+#   commands:
+#   - run: npm ci
+#     cache:
+#       inputs: [ package.json, package-lock.json ] # hashed in the container, the commit is used without them
+#       outputs: [ node_modules ]                    # saved to and restored from the cache volume
+#
+# `cache: true` caches the status and output of a command, keyed on the commit. A step is keyed on the
+# namespace, the commit or the hash of its inputs, the image digest, the environment and the command (see
+# step_key()). Only steps that succeeded are kept, so a flaky failure is retried on the next build.
+#
+# The records live in the operator under JETCI_STEP_CACHE_DIR, one JSON file per step, and the least recently
+# used ones are evicted once they add up to more than JETCI_STEP_CACHE_BYTES. Outputs are tarballs on the
+# PersistentVolumeClaim named by JETCI_STEP_CACHE_CLAIM, which has to exist in the namespaces of the builds.
+# The tarball of an evicted step is removed the next time a step of its namespace is saved.
+#
+# Settings:
+#   JETCI_STEP_CACHE_DIR   - where the records are kept.
+#   JETCI_STEP_CACHE_BYTES - size the records and outputs are evicted down to, 0 turns the cache off.
+#   JETCI_STEP_CACHE_CLAIM - PersistentVolumeClaim outputs are kept on, outputs aren't cached without it.
+import os
+import json
+import shlex
+import hashlib
+import threading
+import collections
+
+STEP_CACHE_DIR   = os.environ.get("JETCI_STEP_CACHE_DIR", "/var/lib/jetci/step-cache")
+STEP_CACHE_BYTES = int(os.environ.get("JETCI_STEP_CACHE_BYTES", str(10 * 1024 * 1024 * 1024)))
+STEP_CACHE_CLAIM = os.environ.get("JETCI_STEP_CACHE_CLAIM", "")
+
+# Where the cache volume is mounted in containers with cached outputs, and where the outputs are relative to.
+STEP_CACHE_VOLUME = "jetci-step-cache"
+STEP_CACHE_MOUNT  = "/jetci-step-cache"
+SOURCE_DIR        = "/usr/src"
+
+
+# Splits a command from .jetci.yaml into what gets run and its cache settings.
+# Returns (command, None) for commands that aren't cached, or (command, { 'inputs': [...], 'outputs': [...] }).
+def parse_step(step):
+    if not isinstance(step, dict):
+        return step, None
+
+    cache = step.get('cache', False)
+    if cache == False or cache is None:
+        return step['run'], None
+    if cache == True:
+        cache = {}
+
+    return step['run'], {
+        'inputs': list(cache.get('inputs', [])),
+        'outputs': list(cache.get('outputs', []))
+    }
+
+# True when a container has a command with outputs to cache, and so needs the cache volume.
+def caches_outputs(container_specification):
+    for step in container_specification.get('commands', []):
+        command, cache = parse_step(step)
+        if cache is not None and len(cache['outputs']) > 0:
+            return True
+    return False
+
+# The key of a step. env is a list of (name, value) pairs, the order doesn't matter.
+def step_key(namespace, source, image_id, env, command):
+    key_data = json.dumps([ namespace, source, image_id, sorted(env), command ], sort_keys=True)
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+
+# Shell commands run in the container for a step. They all need /bin/sh, and the outputs need tar.
+
+# Prints one hash of the contents and names of every file under the inputs.
+def inputs_hash_command(inputs):
+    paths = " ".join(shlex.quote(path) for path in inputs)
+    return [ "/bin/sh", "-c", "cd " + SOURCE_DIR + " && find " + paths + " -type f -exec sha256sum {} + | LC_ALL=C sort -k 2 | sha256sum" ]
+
+def archive_path(key):
+    return STEP_CACHE_MOUNT + "/" + key + ".tar"
+
+# Unpacks the outputs of a step over the source directory.
+def restore_command(key):
+    return [ "/bin/sh", "-c", "cd " + SOURCE_DIR + " && tar -xf " + archive_path(key) ]
+
+# Packs the outputs of a step and prints the size of the tarball. Tarballs of evicted steps are removed first.
+def save_command(key, outputs, removals):
+    script = ""
+    for removal in removals:
+        script += "rm -f " + archive_path(removal) + "; "
+    paths = " ".join(shlex.quote(path) for path in outputs)
+    script += "cd " + SOURCE_DIR + " && tar -cf " + archive_path(key) + ".tmp -- " + paths + " && mv " + archive_path(key) + ".tmp " + archive_path(key) + " && wc -c < " + archive_path(key)
+    return [ "/bin/sh", "-c", script ]
+
+
+# Records are { 'namespace', 'command', 'status', 'output', 'outputs': True/False, 'bytes' }.
+# They are kept in memory in least recently used order, and as a file each so they survive restarts.
+class StepCache:
+    def __init__(self, root=STEP_CACHE_DIR, max_bytes=STEP_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.locker = threading.Lock()
+
+        self.records = collections.OrderedDict()
+        self.bytes = 0
+        self.stats = { "hits": 0, "misses": 0, "evictions": 0 }
+
+        # Tarballs of evicted steps, namespace -> set of keys.
+        self.removals = {}
+
+        os.makedirs(self.root, exist_ok=True)
+        self.load()
+
+    def record_path(self, key):
+        return os.path.join(self.root, key + ".json")
+
+    # Reads the records back in, oldest use first. Files are touched on every hit, so mtime is the last use.
+    def load(self):
+        paths = []
+        for name in os.listdir(self.root):
+            if name.endswith(".json"):
+                path = os.path.join(self.root, name)
+                paths.append((os.path.getmtime(path), name[:-len(".json")], path))
+
+        for mtime, key, path in sorted(paths):
+            try:
+                with open(path) as record_file:
+                    record = json.load(record_file)
+            except (OSError, ValueError):
+                continue
+            self.records[key] = record
+            self.bytes += record['bytes']
+
+    def get(self, key):
+        with self.locker:
+            record = self.records.get(key)
+            if record is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self.records.move_to_end(key)
+
+        try:
+            os.utime(self.record_path(key))
+        except OSError:
+            pass
+        return record
+
+    def put(self, key, record):
+        # Two builds can save the same step at once, so each writes a file of its own first.
+        record_path = self.record_path(key)
+        temporary_path = record_path + "." + str(threading.get_ident()) + ".tmp"
+        with open(temporary_path, "w") as record_file:
+            json.dump(record, record_file)
+        os.replace(temporary_path, record_path)
+
+        with self.locker:
+            if key in self.records:
+                self.bytes -= self.records.pop(key)['bytes']
+            self.records[key] = record
+            self.bytes += record['bytes']
+            self.removals.get(record['namespace'], set()).discard(key)
+
+            # The newest record stays even when it's bigger than the whole cache.
+            while self.bytes > self.max_bytes and len(self.records) > 1:
+                evicted_key, evicted = self.records.popitem(last=False)
+                self.drop(evicted_key, evicted)
+                self.stats['evictions'] += 1
+
+    # Forgets a step, like when its tarball turned out to be gone. Caller must not hold the lock.
+    def forget(self, key):
+        with self.locker:
+            record = self.records.pop(key, None)
+            if record is not None:
+                self.drop(key, record)
+
+    # Caller must hold the lock.
+    def drop(self, key, record):
+        self.bytes -= record['bytes']
+        if record.get('outputs'):
+            self.removals.setdefault(record['namespace'], set()).add(key)
+        try:
+            os.remove(self.record_path(key))
+        except OSError:
+            pass
+
+    # Tarballs to remove from the cache volume of a namespace. They are handed out once.
+    def take_removals(self, namespace):
+        with self.locker:
+            return sorted(self.removals.pop(namespace, set()))
+
+    # Takes back removals that were handed out but didn't get done, unless their step was saved again since.
+    def return_removals(self, namespace, keys):
+        with self.locker:
+            pending = self.removals.setdefault(namespace, set())
+            for key in keys:
+                if key not in self.records:
+                    pending.add(key)
+
+
+# None when the cache is turned off. Made on first use, so the directory is only needed when a step is cached.
+step_cache = None
+step_cache_locker = threading.Lock()
+
+def get_step_cache():
+    global step_cache
+    if STEP_CACHE_BYTES <= 0:
+        return None
+    with step_cache_locker:
+        if step_cache is None:
+            step_cache = StepCache()
+        return step_cache
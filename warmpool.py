@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# Warm executor pod pool for the operator.
+#
+# Most of a short pipeline is its pod being scheduled, pulling images and becoming ready. With the pool turned
+# on, the pod of a pipeline that succeeded isn't deleted. Its /usr/src is emptied and it waits for the next
+# pipeline of the same repository that would make the exact same pod, which claims it instead of making one.
+#
+# Pools are keyed on the namespace, the repository and the pod spec (see pool_key()), so only pods with the same
+# images, environment and volumes are shared, and never between repositories. Every pool keeps as many idle pods
+# as it had pipelines running at once in the last JETCI_WARM_POOL_WINDOW seconds, up to JETCI_WARM_POOL_SIZE.
+# Pods are started ahead of time when it has fewer.
+#
+# Only /usr/src is reset between pipelines. Whatever a pipeline changed anywhere else in its containers, like
+# packages it installed, is still there for the next one.
+#
+# Settings:
+#   JETCI_WARM_POOL_SIZE    - most idle pods a pool keeps, 0 turns the pool off.
+#   JETCI_WARM_POOL_IDLE    - seconds an idle pod is kept without being claimed.
+#   JETCI_WARM_POOL_MAX_AGE - seconds after creation a pod stops being handed out.
+#   JETCI_WARM_POOL_WINDOW  - seconds of claims the size of a pool is worked out from.
+import os
+import json
+import time
+import hashlib
+import threading
+import collections
+
+WARM_POOL_SIZE    = int(os.environ.get("JETCI_WARM_POOL_SIZE", "0"))
+WARM_POOL_IDLE    = float(os.environ.get("JETCI_WARM_POOL_IDLE", "300"))
+WARM_POOL_MAX_AGE = int(os.environ.get("JETCI_WARM_POOL_MAX_AGE", "3600"))
+WARM_POOL_WINDOW  = float(os.environ.get("JETCI_WARM_POOL_WINDOW", "600"))
+
+# The key of the pool a pod belongs in. Short enough to be a label value.
+def pool_key(namespace, repo_name, pod_spec):
+    key_data = json.dumps([ namespace, repo_name, pod_spec ], sort_keys=True)
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()[:32]
+
+
+# The pods of one pool. Guarded by the lock of WarmPools.
+class Pool:
+    def __init__(self, namespace, template):
+        self.namespace = namespace
+        # The pod to start ahead of time, without a name.
+        self.template = template
+        # (pod name, created, idle since) triples, the most recently used last. Times are time.monotonic().
+        self.idle = []
+        # Pods started ahead of time that aren't ready yet.
+        self.warming = set()
+        self.in_use = 0
+        # (time, pods in use) for every claim in the window, what the pool is sized by.
+        self.demand = collections.deque()
+        # When a pipeline last wanted a pod.
+        self.used = time.monotonic()
+
+    def wanted(self, now, window):
+        while len(self.demand) > 0 and now - self.demand[0][0] > window:
+            self.demand.popleft()
+        return max([ in_use for claimed, in_use in self.demand ] + [ 0 ])
+
+
+class WarmPools:
+    def __init__(self, size=WARM_POOL_SIZE, idle=WARM_POOL_IDLE, max_age=WARM_POOL_MAX_AGE, window=WARM_POOL_WINDOW):
+        self.size = size
+        self.idle = idle
+        self.max_age = max_age
+        self.window = window
+        self.pools = {}
+        self.locker = threading.Lock()
+        self.stats = { "hits": 0, "misses": 0 }
+
+    # A pipeline wants a pod from a pool. Returns (pod name, created) of an idle pod, or None when it has to make one.
+    # The pod is only a candidate, the caller checks it's still good and counts the claim with claimed().
+    def take(self, key, namespace, template):
+        now = time.monotonic()
+        with self.locker:
+            pool = self.pools.setdefault(key, Pool(namespace, template))
+            pool.template = template
+            pool.used = now
+            while len(pool.idle) > 0:
+                pod_name, created, idle_since = pool.idle.pop()
+                if now - created < self.max_age:
+                    return pod_name, created
+            return None
+
+    # Counts a pipeline that got its pod, from the pool or not, until released().
+    def claimed(self, key, hit):
+        with self.locker:
+            pool = self.pools[key]
+            pool.in_use += 1
+            pool.demand.append((time.monotonic(), pool.in_use))
+            self.stats['hits' if hit else 'misses'] += 1
+
+    def released(self, key):
+        with self.locker:
+            self.pools[key].in_use -= 1
+
+    # True when a pod made at created would be kept by put().
+    def has_room(self, key, created):
+        with self.locker:
+            pool = self.pools.get(key)
+            return pool is not None and len(pool.idle) < self.size and time.monotonic() - created < self.max_age
+
+    # Puts a pod back in its pool. Returns False when the pool doesn't want it, the caller deletes it then.
+    def put(self, key, pod_name, created):
+        with self.locker:
+            pool = self.pools.get(key)
+            if pool is None:
+                return False
+            pool.warming.discard(pod_name)
+            if len(pool.idle) >= self.size or time.monotonic() - created >= self.max_age:
+                return False
+            pool.idle.append((pod_name, created, time.monotonic()))
+            return True
+
+    # A pod started ahead of time.
+    def warming(self, key, pod_name):
+        with self.locker:
+            self.pools[key].warming.add(pod_name)
+
+    # A pod started ahead of time that never got ready.
+    def failed(self, key, pod_name):
+        with self.locker:
+            self.pools[key].warming.discard(pod_name)
+
+    # Goes over the pools. Returns the idle pods that expired as (namespace, pod name) pairs, the caller deletes them,
+    # and how many pods each pool should start as (key, namespace, template, count). Forgets pools nobody uses.
+    def tend(self):
+        now = time.monotonic()
+        expired = []
+        wanted = []
+        with self.locker:
+            for key in list(self.pools.keys()):
+                pool = self.pools[key]
+                for entry in list(pool.idle):
+                    if now - entry[2] > self.idle or now - entry[1] >= self.max_age:
+                        pool.idle.remove(entry)
+                        expired.append((pool.namespace, entry[0]))
+
+                count = min(self.size, pool.wanted(now, self.window) - pool.in_use) - len(pool.idle) - len(pool.warming)
+                if count > 0:
+                    wanted.append((key, pool.namespace, pool.template, count))
+
+                if now - pool.used > self.window and pool.in_use == 0 and len(pool.idle) == 0 and len(pool.warming) == 0:
+                    del self.pools[key]
+        return expired, wanted
+
+    # Whether a pod is one of ours, idle or warming.
+    def knows(self, key, pod_name):
+        with self.locker:
+            pool = self.pools.get(key)
+            return pool is not None and (pod_name in pool.warming or any(entry[0] == pod_name for entry in pool.idle))
+
+    def idle_pods(self):
+        with self.locker:
+            return sum(len(pool.idle) for pool in self.pools.values())